@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import timeit
+import tracemalloc
+
+import tunnel_gen
+
+# Benchmark harness for tunnel_gen. Run locally and keep the JSON output to
+# compare against later runs:
+#
+#   python bench_tunnel.py --out bench.json
+#   python bench_tunnel.py --compare bench.json
+
+DEFAULT_SIZES = [1, 100, 10000, 100000]
+
+def bench_generation(length_miles, tunnel_type, engine, seed, fmt='text'):
+    # One pass over the stream, timing rendering (to /dev/null) separately from the generator
+    section_iter = tunnel_gen.ENGINES[engine]
+    num_sections = 0
+    format_time = 0.0
+    perf = time.perf_counter
+    with open(os.devnull, 'w') as sink:
+        renderer = tunnel_gen.RENDERERS[fmt](sink)
+        start = perf()
+        for s in section_iter(length_miles, tunnel_type, seed=seed):
+            num_sections += 1
+            t0 = perf()
+            renderer.write(num_sections, s)
+            format_time += perf() - t0
+        t0 = perf()
+        renderer.flush()
+        format_time += perf() - t0
+        total_time = perf() - start
+    gen_time = total_time - format_time
+    return {
+        'sections': num_sections,
+        'total_s': total_time,
+        'generate_s': gen_time,
+        'format_s': format_time,
+        'sections_per_s': num_sections / gen_time if gen_time > 0 else None,
+    }
+
+def bench_chunks(length_miles, tunnel_type, engine, seed):
+    # One pass over the stream as SectionChunks, the columns --export, --store
+    # and --stats consume; nothing is rendered
+    num_sections = 0
+    perf = time.perf_counter
+    start = perf()
+    for chunk in tunnel_gen.iter_chunks(length_miles, tunnel_type, engine=engine, seed=seed):
+        num_sections += len(chunk)
+    total_time = perf() - start
+    return {
+        'sections': num_sections,
+        'total_s': total_time,
+        'generate_s': total_time,
+        'format_s': 0.0,
+        'sections_per_s': num_sections / total_time if total_time > 0 else None,
+    }
+
+def bench_memory(length_miles, tunnel_type, engine, seed):
+    # Peak traced allocation while streaming (sections are not kept)
+    section_iter = tunnel_gen.ENGINES[engine]
+    tracemalloc.start()
+    for _ in section_iter(length_miles, tunnel_type, seed=seed):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def bench_micro(number):
+    # Cost per call of the building blocks, in microseconds
+    rng = tunnel_gen.make_rng(0)
+    cases = {
+        'load_tables': lambda: tunnel_gen.load_tables(),
+        'get_config_dry': lambda: tunnel_gen.get_config('dry'),
+        'get_config_wet': lambda: tunnel_gen.get_config('wet'),
+        'build_config_dry': lambda: tunnel_gen._build_config('dry'),
+        'build_config_wet': lambda: tunnel_gen._build_config('wet'),
+        'gen_dry_special_feature': lambda: tunnel_gen.gen_dry_special_feature(rng),
+        'gen_wet_special_feature': lambda: tunnel_gen.gen_wet_special_feature(rng),
+        'gen_flow_rate': lambda: tunnel_gen.gen_flow_rate(rng),
+        'gen_water_temp': lambda: tunnel_gen.gen_water_temp(rng),
+        'roll_3d6': lambda: tunnel_gen.roll(3, 6, rng),
+        'roll_10d6': lambda: tunnel_gen.roll(10, 6, rng),
+        'roll_10d20': lambda: tunnel_gen.roll(10, 20, rng),
+    }
+    results = {}
+    for name, fn in cases.items():
+        best = min(timeit.repeat(fn, number=number, repeat=3))
+        results[name] = best / number * 1e6
+    return results
+
+def run(sizes, types, engine, seed, memory, micro_number, fmt='text', chunks=False):
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'engine': engine,
+            'format': fmt,
+            'chunks': chunks,
+            'seed': seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'generation': {},
+        'micro_us': bench_micro(micro_number),
+    }
+    for tunnel_type in types:
+        for length in sizes:
+            name = f"{tunnel_type}_{length:g}mi"
+            print(f"Benchmarking {name}...", file=sys.stderr)
+            if chunks:
+                row = bench_chunks(length, tunnel_type, engine, seed)
+            else:
+                row = bench_generation(length, tunnel_type, engine, seed, fmt)
+            if memory:
+                row['tracemalloc_peak_bytes'] = bench_memory(length, tunnel_type, engine, seed)
+            results['generation'][name] = row
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['meta']['peak_rss_bytes'] = rss if sys.platform == 'darwin' else rss * 1024
+    return results
+
+def print_report(results, baseline=None):
+    print(f"{'case':<18}{'sections':>10}{'sect/s':>12}{'gen s':>9}{'fmt s':>9}{'peak KiB':>10}{'vs base':>9}")
+    for name, row in results['generation'].items():
+        peak = row.get('tracemalloc_peak_bytes')
+        peak_txt = f"{peak / 1024:.0f}" if peak is not None else "-"
+        ratio_txt = "-"
+        base_row = (baseline or {}).get('generation', {}).get(name)
+        if base_row and base_row.get('sections_per_s') and row['sections_per_s']:
+            ratio_txt = f"{row['sections_per_s'] / base_row['sections_per_s']:.2f}x"
+        print(f"{name:<18}{row['sections']:>10}{row['sections_per_s'] or 0:>12,.0f}{row['generate_s']:>9.2f}{row['format_s']:>9.2f}{peak_txt:>10}{ratio_txt:>9}")
+    print()
+    print(f"{'micro (us/call)':<26}{'now':>10}{'base':>10}")
+    for name, us in results['micro_us'].items():
+        base_us = (baseline or {}).get('micro_us', {}).get(name)
+        base_txt = f"{base_us:.2f}" if base_us is not None else "-"
+        print(f"{name:<26}{us:>10.2f}{base_txt:>10}")
+    print(f"\nPeak RSS: {results['meta']['peak_rss_bytes'] / 2**20:.1f} MiB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark tunnel generation throughput and memory.")
+    parser.add_argument("--sizes", type=float, nargs='+', default=DEFAULT_SIZES, help="Tunnel lengths in miles")
+    parser.add_argument("--types", nargs='+', choices=['dry', 'wet'], default=['dry', 'wet'], help="Tunnel types")
+    parser.add_argument("--engine", choices=sorted(tunnel_gen.ENGINES), default='python', help="Section engine")
+    parser.add_argument("--format", choices=sorted(tunnel_gen.RENDERERS), default='text', help="Output format to render")
+    parser.add_argument("--chunks", action='store_true', help="Time the stream as SectionChunks instead of rendering sections")
+    parser.add_argument("--seed", type=int, default=1, help="Seed, keep it fixed to compare runs")
+    parser.add_argument("--no-memory", action='store_true', help="Skip the tracemalloc pass")
+    parser.add_argument("--micro-number", type=int, default=2000, help="Calls per micro benchmark repeat")
+    parser.add_argument("--out", help="Write results as JSON")
+    parser.add_argument("--compare", metavar="JSON", help="Baseline results to compare against")
+
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.types, args.engine, args.seed, not args.no_memory, args.micro_number, args.format, args.chunks)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,67 @@
+import pytest
+
+import tunnel_gen as tg
+
+np = pytest.importorskip('numpy')
+
+
+def as_dicts(sections):
+    return [s.as_dict() for s in sections]
+
+
+@pytest.fixture(params=['dry', 'wet'])
+def chunks(request):
+    # A small chunk_size so the tunnel spans several chunks
+    return request.param, list(tg.iter_chunks_numpy(60, request.param, seed=3, chunk_size=100))
+
+
+def test_chunks_decode_to_the_engine_sections(chunks):
+    tunnel_type, chunks = chunks
+    want = list(tg.iter_sections_numpy(60, tunnel_type, seed=3, chunk_size=100))
+    assert len(chunks) > 2
+    assert as_dicts(s for chunk in chunks for s in chunk.sections()) == as_dicts(want)
+    assert [w for chunk in chunks for w in chunk.width().tolist()] == [s.width for s in want]
+
+
+@pytest.mark.parametrize('tunnel_type', ['dry', 'wet'])
+def test_chunk_sections_round_trip(tunnel_type):
+    sections = list(tg.iter_sections(40, tunnel_type, seed=9))
+    chunks = list(tg.chunk_sections(iter(sections), chunk_size=64))
+    assert sum(len(chunk) for chunk in chunks) == len(sections)
+    assert as_dicts(s for chunk in chunks for s in chunk.sections()) == as_dicts(sections)
+
+
+def test_store_from_chunks(chunks, tmp_path):
+    _, chunks = chunks
+    sections = [s for chunk in chunks for s in chunk.sections()]
+    for every in (1, 7, 1024):
+        tg.write_store(iter(chunks), tmp_path / 'chunks.store', every=every)
+        tg.write_store(iter(sections), tmp_path / 'sections.store', every=every)
+        assert (tmp_path / 'chunks.store').read_bytes() == (tmp_path / 'sections.store').read_bytes()
+
+
+def test_export_from_chunks(chunks, tmp_path):
+    _, chunks = chunks
+    sections = [s for chunk in chunks for s in chunk.sections()]
+    assert tg.export_columns(iter(chunks), str(tmp_path / 'chunks.npz')) == len(sections)
+    tg.export_columns(iter(sections), str(tmp_path / 'sections.npz'))
+    got = np.load(tmp_path / 'chunks.npz')
+    want = np.load(tmp_path / 'sections.npz')
+    assert sorted(got.files) == sorted(want.files)
+    for name in want.files:
+        assert np.array_equal(got[name], want[name]), name
+
+
+def test_stats_from_chunks():
+    # The numpy engine is tallied from chunks; the tallies match its sections
+    for tunnel_type in ('dry', 'wet'):
+        by_chunk, by_section = tg.RunningStats(), tg.RunningStats()
+        got = tg._tally_chunks(tg.iter_chunks_numpy(80, tunnel_type, seed=2), by_chunk)
+        want = tg._tally_sections(tg.iter_sections_numpy(80, tunnel_type, seed=2), by_section)
+        assert got[1:3] == want[1:3] and got[4:] == want[4:]
+        assert got[3] == pytest.approx(want[3])
+        assert by_chunk.as_dict() == pytest.approx(by_section.as_dict())
+    stats = tg.simulate_stats(20, 'wet', runs=5, seed=1, engine='numpy')
+    assert stats['section_len']['count'] == stats['sections_per_tunnel']['mean'] * 5
+    for shares in stats['feet_share'].values():
+        assert sum(shares.values()) == pytest.approx(1)
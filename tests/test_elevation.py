@@ -0,0 +1,25 @@
+import pytest
+
+import tunnel_gen as tg
+
+ENGINES = sorted(tg.ENGINES)
+
+
+def signed_degree(s):
+    return -s.degree if 'Down' in s['slope']['name'] else s.degree
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('seed', range(8))
+def test_dry_elevation_follows_the_slope(engine, seed):
+    # Every section without a special feature climbs or drops exactly
+    # len * sin(angle), in the direction its slope names
+    if engine != 'python':
+        pytest.importorskip('numpy')
+    checked = 0
+    for s in tg.ENGINES[engine](50, 'dry', seed=seed):
+        if s.special is not None:
+            continue
+        assert s.elev == pytest.approx(s.len * tg.SIN_BY_DEGREE[signed_degree(s)], abs=1e-6), s
+        checked += 1
+    assert checked > 100
@@ -0,0 +1,34 @@
+from itertools import islice
+
+import pytest
+
+import tunnel_gen as tg
+
+ENGINES = {
+    'python': tg.iter_sections,
+    'numpy': tg.iter_sections_numpy,
+    'markov': tg.iter_sections_markov,
+}
+
+
+def sections(engine, length, tunnel_type):
+    if engine != 'python':
+        pytest.importorskip('numpy')
+    # Bounded, so a tunnel that never ends fails instead of hanging
+    return list(islice(ENGINES[engine](length, tunnel_type, seed=3), 10000))
+
+
+@pytest.mark.parametrize('engine', sorted(ENGINES))
+@pytest.mark.parametrize('tunnel_type', ['dry', 'wet'])
+@pytest.mark.parametrize('length', [0.0001, 0.00001, 1.00003])
+def test_fractional_length_ends(engine, tunnel_type, length):
+    # A remainder under a foot used to clip the last section to 0 ft forever
+    got = sections(engine, length, tunnel_type)
+    assert sum(s.len for s in got) == tg.miles_to_feet(length)
+    assert all(s.len > 0 for s in got)
+
+
+def test_miles_to_feet_rounds_to_whole_feet():
+    assert tg.miles_to_feet(0.0001) == 1
+    assert tg.miles_to_feet(0.00001) == 0
+    assert tg.miles_to_feet(2.5) == 13200
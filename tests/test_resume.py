@@ -0,0 +1,55 @@
+import pytest
+
+import tunnel_gen as tg
+
+
+class Interrupted(Exception):
+    pass
+
+
+class KillAfter(tg.Checkpointer):
+    # Stops the run right after the given number of checkpoints, like a kill
+    def __init__(self, path, every, saves):
+        super().__init__(path, every)
+        self.kill_after = saves
+
+    def save(self, snapshot):
+        super().save(snapshot)
+        if self.saves == self.kill_after:
+            raise Interrupted
+
+
+@pytest.mark.parametrize('fmt', ['text', 'jsonl', 'csv'])
+@pytest.mark.parametrize('tunnel_type', ['dry', 'wet'])
+def test_resume_is_byte_identical(tmp_path, fmt, tunnel_type):
+    settings = dict(length_miles=20, tunnel_type=tunnel_type, seed=11, fmt=fmt)
+    full = tmp_path / 'full.out'
+    with open(full, 'w', encoding='utf-8') as out:
+        tg.generate_tunnel(out=out, **settings)
+
+    output = tmp_path / 'resumed.out'
+    checkpoint = tmp_path / 'tunnel.ckpt'
+    with open(output, 'w', encoding='utf-8') as out:
+        with pytest.raises(Interrupted):
+            tg.generate_tunnel(out=out, checkpointer=KillAfter(checkpoint, 25, 2), **settings)
+
+    # Resume the way the CLI does: cut the output back, then append
+    snapshot = tg.load_snapshot(checkpoint)
+    assert snapshot['emitted'] == 50
+    tg.os.truncate(output, snapshot['out_offset'])
+    with open(output, 'a', encoding='utf-8') as out:
+        totals = tg.generate_tunnel(out=out, checkpointer=tg.Checkpointer(checkpoint, 25), resume=snapshot, **settings)
+
+    assert output.read_bytes() == full.read_bytes()
+    assert totals['feet'] == tg.miles_to_feet(20)
+    assert not checkpoint.exists()
+
+
+def test_resume_rejects_other_settings(tmp_path):
+    checkpoint = tmp_path / 'tunnel.ckpt'
+    with pytest.raises(Interrupted):
+        for _ in tg.iter_sections(20, 'dry', seed=11, checkpointer=KillAfter(checkpoint, 25, 1)):
+            pass
+    snapshot = tg.load_snapshot(checkpoint)
+    with pytest.raises(ValueError, match='different settings'):
+        next(tg.iter_sections(20, 'dry', seed=12, resume=snapshot))
@@ -0,0 +1,21 @@
+import pytest
+
+import tunnel_gen as tg
+
+
+@pytest.mark.parametrize('slack', [tg.SHARED_SLACK, 0.001])
+def test_share_tunnel_round_trip(monkeypatch, slack):
+    # A tiny slack makes the block regrow several times on the way
+    monkeypatch.setattr(tg, 'SHARED_SLACK', slack)
+    spec = tg.normalize_spec({'length': 5, 'type': 'wet', 'seed': 7}, 0)
+    with tg.SharedTunnel(tg.share_tunnel(spec)) as shared:
+        got = [s.as_dict() for s in shared]
+    want = [s.as_dict() for s in tg.iter_sections(5, 'wet', seed=spec['seed'])]
+    assert got == want
+
+
+def test_share_tunnel_empty():
+    result = tg.share_tunnel(tg.normalize_spec({'length': 0, 'seed': 1}, 0))
+    assert result['name'] is None
+    with tg.SharedTunnel(result) as shared:
+        assert list(shared) == []
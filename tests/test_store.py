@@ -0,0 +1,53 @@
+import pytest
+
+import tunnel_gen as tg
+
+
+@pytest.fixture(params=['dry', 'wet'])
+def stored(request, tmp_path):
+    sections = list(tg.iter_sections(30, request.param, seed=5))
+    path = tmp_path / 'tunnel.store'
+    count = tg.write_store(sections, path, every=16, meta={'seed': 5})
+    assert count == len(sections)
+    with tg.TunnelStore(path) as store:
+        yield sections, store
+
+
+def test_round_trip(stored):
+    sections, store = stored
+    assert len(store) == len(sections)
+    assert [s.as_dict() for s in store] == [s.as_dict() for s in sections]
+    assert store[-1].as_dict() == sections[-1].as_dict()
+    for item in (slice(3, 7), slice(5, 2, -1), slice(None, None, -3), slice(-4, None, 2), slice(7, 3), slice(2, 9, -1)):
+        assert [s.as_dict() for s in store[item]] == [s.as_dict() for s in sections[item]], item
+
+
+def test_totals_and_filter(stored):
+    sections, store = stored
+    totals = store.totals()
+    assert totals['sections'] == len(sections)
+    assert totals['feet'] == sum(s.len for s in sections)
+    assert totals['elev'] == pytest.approx(sum(s.elev for s in sections))
+    got = [number for number, _ in store.filter(special='')]
+    want = [i for i, s in enumerate(sections, 1) if s.special is not None]
+    assert got == want
+    with pytest.raises(ValueError):
+        store.totals(colour='red')
+
+
+def test_locate(stored):
+    sections, store = stored
+    feet = 0
+    for number, s in enumerate(sections, 1):
+        if number % 7 == 0:
+            assert store.locate((feet + s.len / 2) / 5280)[:2] == (number, feet)
+        feet += s.len
+    # The very end belongs to the last section
+    assert store.locate(feet / 5280)[0] == len(sections)
+
+
+def test_empty_store(tmp_path):
+    path = tmp_path / 'empty.store'
+    assert tg.write_store(iter(()), path) == 0
+    with tg.TunnelStore(path) as store:
+        assert len(store) == 0 and list(store) == []
@@ -0,0 +1,60 @@
+import copy
+import json
+import os
+
+import pytest
+
+import tunnel_gen as tg
+
+TABLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'underdark_tables.json')
+
+
+@pytest.fixture
+def data():
+    with open(TABLES, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_bundled_tables_are_valid(data):
+    tg.validate_tables(data)
+
+
+def break_num_changes(data):
+    data['num_changes'][0]['value'] = 1.5
+
+def break_bool_changes(data):
+    data['num_changes'][0]['value'] = True
+
+def break_weight(data):
+    data['lengths'][0]['weight'] = 0
+
+def break_missing_key(data):
+    del data['types']
+
+def break_die_coverage(data):
+    table = next(iter(data['die_tables'].values()))
+    table['entries'] = table['entries'][:-1]
+
+def break_unknown_table(data):
+    attr = next(a for t in data['types'].values() for a in t['attributes'] if 'table' in a)
+    attr['table'] = 'no_such_table'
+
+def break_range(data):
+    row = next(r for rows in data['tables'].values() for r in rows if r.get('values'))
+    row['values'][next(iter(row['values']))] = [5, 1]
+
+
+@pytest.mark.parametrize('breaker, message', [
+    (break_num_changes, 'whole number of changes'),
+    (break_bool_changes, 'whole number of changes'),
+    (break_weight, 'positive weight'),
+    (break_missing_key, "missing 'types'"),
+    (break_die_coverage, 'cover 1'),
+    (break_unknown_table, 'unknown table'),
+    (break_range, r'\[low, high\]'),
+])
+def test_validate_tables_errors(data, breaker, message):
+    broken = copy.deepcopy(data)
+    breaker(broken)
+    with pytest.raises(tg.TableError, match=message):
+        tg.validate_tables(broken)
@@ -1,100 +1,730 @@
 import random
 import argparse
+import asyncio
 import math
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+import threading
+import time
+import bisect
+import zipfile
+import pickle
+import urllib.parse
+from functools import partial
+from itertools import accumulate, islice, repeat
+from collections import OrderedDict
+from types import MappingProxyType
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
 
-def roll(num_dice, sides):
-    return sum(random.randint(1, sides) for _ in range(num_dice))
+try:
+    import numpy as np
+except ImportError: # Optional, only needed for the numpy engine and .npz export
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Optional, only needed for Parquet export
+    pa = None
+
+# --- Seeding ---
+# Every generator, mutator and special feature takes an explicit rng (a
+# random.Random, defaulting to the global module state), so a seeded run is
+# reproducible and independent runs never share a stream.
+
+def derive_seed(seed, *path):
+    # Stable 64-bit sub-seed for a tunnel/chunk/branch, same in every process
+    text = repr((seed,) + path).encode()
+    return int.from_bytes(hashlib.sha256(text).digest()[:8], 'big')
+
+def make_rng(seed=None):
+    return random.Random(seed)
+
+def tunnel_seed(seed, index):
+    # Seed of the index-th tunnel of a seeded run (batch entries, side branches)
+    return derive_seed(seed, 'tunnel', index)
+
+def miles_to_feet(length_miles):
+    # Whole feet, so clipping the last section to what remains always ends the tunnel
+    return int(round(length_miles * 5280))
+
+# --- Dice ---
+# A pool of two or more dice is not rolled die by die: its sum is drawn from
+# the exact distribution of sums, worked out once per (num_dice, sides) by
+# convolving one die at a time and compiled into a WeightedSampler, so a
+# 10d6 costs one uniform instead of ten randint calls. Pools with more than
+# DICE_TABLE_MAX possible sums are still rolled die by die.
+
+DICE_TABLE_MAX = 10000
+_dice_samplers = {}
+
+def dice_distribution(num_dice, sides):
+    # Number of ways to roll each sum num_dice..num_dice * sides (exact ints);
+    # each step adds a die as a sliding window sum over the previous counts
+    counts = [1]
+    for _ in range(num_dice):
+        window = 0
+        new = []
+        for k in range(len(counts) + sides - 1):
+            if k < len(counts):
+                window += counts[k]
+            if k >= sides:
+                window -= counts[k - sides]
+            new.append(window)
+        counts = new
+    return counts
+
+def dice_sampler(num_dice, sides):
+    # Cached WeightedSampler over the sums of num_dice dice, None when the
+    # pool is too small or too large to be worth a table
+    key = (num_dice, sides)
+    sampler = _dice_samplers.get(key)
+    if sampler is None:
+        if num_dice < 2 or sides < 2 or num_dice * (sides - 1) + 1 > DICE_TABLE_MAX:
+            return None
+        counts = dice_distribution(num_dice, sides)
+        total = sides ** num_dice
+        # int / int is correctly rounded, so every weight is exact up to the last bit
+        sampler = WeightedSampler(range(num_dice, num_dice * sides + 1), [c / total for c in counts])
+        sampler = _dice_samplers.setdefault(key, sampler)
+    return sampler
+
+def roll(num_dice, sides, rng=random):
+    sampler = _dice_samplers.get((num_dice, sides)) or dice_sampler(num_dice, sides)
+    if sampler is not None:
+        return sampler.draw(rng)
+    return sum(rng.randint(1, sides) for _ in range(num_dice))
+
+def roll_many(num_dice, sides, count, gen):
+    # 'count' sums of num_dice dice drawn with a numpy Generator
+    sampler = dice_sampler(num_dice, sides)
+    if sampler is not None:
+        return sampler.draw_many(count, gen) + num_dice
+    return gen.integers(1, sides + 1, size=(count, num_dice)).sum(axis=1)
+
+class WeightedSampler:
+    # Vose alias table for a weighted list, compiled once per table.
+    # A draw is a single random() call whatever the table size, instead of
+    # random.choices rebuilding cumulative weights on every call.
+    __slots__ = ('items', 'weights', 'prob', 'alias', 'n', '_np_tables')
+
+    def __init__(self, items, weights):
+        items = list(items)
+        weights = list(weights)
+        if not items or len(items) != len(weights):
+            raise ValueError("WeightedSampler needs one weight per item")
+        total = float(sum(weights))
+        if total <= 0 or min(weights) < 0:
+            raise ValueError("WeightedSampler weights must be non-negative with a positive sum")
+
+        n = len(items)
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Whatever is left is 1.0 up to float error
+
+        self.items = items
+        self.weights = weights
+        self.prob = prob
+        self.alias = alias
+        self.n = n
+        self._np_tables = None
+
+    @classmethod
+    def from_alias(cls, items, weights, prob, alias):
+        # Rebuild from a saved prob/alias pair without recompiling
+        self = cls.__new__(cls)
+        self.items = list(items)
+        self.weights = list(weights)
+        self.prob = list(prob)
+        self.alias = list(alias)
+        self.n = len(self.items)
+        self._np_tables = None
+        return self
+
+    def draw(self, rng=random):
+        # One uniform picks the column (integer part) and the coin (fraction)
+        u = rng.random() * self.n
+        i = int(u)
+        if u - i < self.prob[i]:
+            return self.items[i]
+        return self.items[self.alias[i]]
+
+    def draw_many(self, count, gen):
+        # Vectorized draw with a numpy Generator, returns item indices
+        if self._np_tables is None:
+            self._np_tables = (np.array(self.prob), np.array(self.alias))
+        prob, alias = self._np_tables
+        u = gen.random(count) * self.n
+        i = u.astype(np.int64)
+        return np.where(u - i < prob[i], i, alias[i])
+
+
+# --- Table Files ---
+# Every table lives in a JSON file (underdark_tables.json by default, or a
+# campaign's own set). A file is validated and compiled into a TableSet once;
+# the compiled set is pickled under __pycache__ next to the file, keyed by the
+# file's hash, so later starts skip parsing and compiling entirely.
+#
+# Rows of weighted tables and entries of die tables share a small format:
+#   "name" / "text"   what the row produces ("none": true produces nothing)
+#   "values"          named values rolled in order, see eval_value
+#   "table"           roll on a sub-table, its text becomes {result}
+#   "format"          text built from the values, e.g. "Pit ({depth}' deep)"
+#   "elev_drop"       name of a value to drop the floor by (special features)
+
+DEFAULT_TABLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'underdark_tables.json')
+
+# Bump when the compiled layout changes so stale caches are ignored
+TABLES_CACHE_VERSION = 2
+
+class TableError(ValueError):
+    pass
+
+class DieTable:
+    # A table rolled with one die, each entry covering a range of faces.
+    # codes maps every face to its entry's position (codes[0] is unused) and
+    # index maps every face to the entry itself, so a roll resolves with one
+    # lookup instead of walking the ranges.
+    __slots__ = ('die', 'entries', 'codes', 'index', 'fixed', '_codes_np')
+
+    def __init__(self, die, entries):
+        self.die = die
+        self.entries = sorted(entries, key=lambda e: e['roll'][0])
+        codes = [0] * (die + 1)
+        for i, e in enumerate(self.entries):
+            lo, hi = e['roll']
+            codes[lo:hi + 1] = [i] * (hi - lo + 1)
+        self.codes = tuple(codes)
+        self.index = tuple(self.entries[c] for c in codes)
+        # Attribute value of entries that roll nothing, computed once (see TableSet)
+        self.fixed = (None,) * len(self.entries)
+        self._codes_np = None
+
+    def lookup(self, r):
+        return self.index[r]
+
+    def roll(self, rng=random):
+        return self.index[rng.randint(1, self.die)]
+
+    def roll_many(self, count, gen):
+        # Entry positions for 'count' rolls drawn with a numpy Generator
+        if self._codes_np is None:
+            self._codes_np = np.array(self.codes, dtype=np.int64)
+        return self._codes_np[gen.integers(1, self.die + 1, size=count)]
+
+    def probabilities(self):
+        # Chance of each entry, in entry order
+        return [(e['roll'][1] - e['roll'][0] + 1) / self.die for e in self.entries]
+
+class TableSet:
+    # Validated and compiled contents of one table file. 'compiled' is the
+    # output of compiled_state() from an earlier load, it skips rebuilding the
+    # alias tables and fixed die table values.
+    def __init__(self, data, digest, path=None, compiled=None):
+        self.data = data
+        self.digest = digest
+        self.path = path
+        self.tables = data['tables']
+        self.lengths = data['lengths']
+        self.wet_width = data['wet_width']
+        self.types = data['types']
+        num_changes = data['num_changes']
+
+        def sampler(key, items, weights):
+            if compiled is None:
+                return WeightedSampler(items, weights)
+            return WeightedSampler.from_alias(items, weights, *compiled['samplers'][key])
+
+        self.samplers = {name: sampler(name, rows, [r['weight'] for r in rows]) for name, rows in self.tables.items()}
+        self.length_sampler = sampler('/lengths', self.lengths, [c['weight'] for c in self.lengths])
+        self.num_change_sampler = sampler('/num_changes', [c['value'] for c in num_changes], [c['weight'] for c in num_changes])
+        self.die_tables = {name: DieTable(t['die'], t['entries']) for name, t in data['die_tables'].items()}
+        for name, die_table in self.die_tables.items():
+            if compiled is None:
+                die_table.fixed = tuple(entry_value(e, None, self) if _is_fixed(e) else None for e in die_table.entries)
+            else:
+                die_table.fixed = compiled['fixed'][name]
+
+    def compiled_state(self):
+        # Compiled parts as plain builtins, so the cache does not depend on
+        # which module (script or import) the classes were loaded from
+        samplers = dict(self.samplers, **{'/lengths': self.length_sampler, '/num_changes': self.num_change_sampler})
+        return {
+            'samplers': {key: (s.prob, s.alias) for key, s in samplers.items()},
+            'fixed': {name: t.fixed for name, t in self.die_tables.items()},
+        }
+
+    def roll_on(self, name, rng=random):
+        # Entry from a weighted or die table
+        if name in self.samplers:
+            return self.samplers[name].draw(rng)
+        return self.die_tables[name].roll(rng)
+
+    def entries_of(self, name):
+        # Rows of a weighted table or entries of a die table, as indexed by roll_many_on
+        if name in self.samplers:
+            return self.samplers[name].items
+        return self.die_tables[name].entries
+
+    def roll_many_on(self, name, count, gen):
+        # Positions into entries_of(name) for 'count' rolls with a numpy Generator
+        if name in self.samplers:
+            return self.samplers[name].draw_many(count, gen)
+        return self.die_tables[name].roll_many(count, gen)
+
+def _frozen_rows(rows):
+    # Lists inside rows become tuples so row values can be interned
+    return [{k: tuple(v) if isinstance(v, list) and k != 'values' else v for k, v in row.items()} for row in rows]
+
+def _check(cond, msg):
+    if not cond:
+        raise TableError(msg)
+
+def _check_value_spec(spec, where, table_names):
+    if isinstance(spec, (int, str)):
+        return
+    if isinstance(spec, list):
+        _check(len(spec) == 2 and all(isinstance(v, int) for v in spec) and spec[0] <= spec[1], f"{where}: a range must be [low, high]")
+        return
+    _check(isinstance(spec, dict), f"{where}: unknown value {spec!r}")
+    if 'dice' in spec:
+        _check(len(spec['dice']) == 2 and min(spec['dice']) >= 1, f"{where}: dice must be [count, sides]")
+    elif 'chance' in spec:
+        _check(len(spec['chance']) == 2 and 0 <= spec['chance'][0] <= spec['chance'][1], f"{where}: chance must be [k, die]")
+        _check_value_spec(spec.get('then', 1), where, table_names)
+        _check_value_spec(spec.get('else', 0), where, table_names)
+    elif 'repeat' in spec:
+        if not isinstance(spec['repeat'], str):
+            _check_value_spec(spec['repeat'], where, table_names)
+        _check_value_spec(spec.get('each'), where, table_names)
+    elif 'format' in spec:
+        _check(isinstance(spec['format'], str), f"{where}: format must be text")
+    else:
+        raise TableError(f"{where}: unknown value {spec!r}")
+
+def _check_row(row, where, table_names, type_names=()):
+    values = row.get('values', {})
+    for name, spec in values.items():
+        _check_value_spec(spec, f"{where} value {name!r}", table_names)
+    if 'table' in row:
+        _check(row['table'] in table_names, f"{where}: unknown sub-table {row['table']!r}")
+    if 'elev_drop' in row:
+        _check(row['elev_drop'] in values, f"{where}: elev_drop names an unknown value")
+    if 'branch' in row:
+        # A tunnel leading off here: {"type": type or {"value": name, "map": {value: type}},
+        # "miles": value name or value spec, "through": true if it does not dead-end}
+        branch = row['branch']
+        branch_type = branch.get('type')
+        if isinstance(branch_type, dict):
+            _check(branch_type.get('value') in values, f"{where}: branch type names an unknown value")
+            branch_types = list(branch_type.get('map', {}).values())
+            _check(branch_types, f"{where}: branch type needs a map")
+        else:
+            branch_types = [branch_type]
+        _check(all(t in type_names for t in branch_types), f"{where}: unknown branch type")
+        miles = branch.get('miles')
+        if isinstance(miles, str):
+            _check(miles in values, f"{where}: branch miles names an unknown value")
+        else:
+            _check_value_spec(miles, f"{where} branch miles", table_names)
+
+def validate_tables(data):
+    # Raises TableError describing the first problem found
+    _check(isinstance(data, dict), "Table file must hold a JSON object")
+    for key in ('num_changes', 'lengths', 'wet_width', 'tables', 'die_tables', 'types'):
+        _check(key in data, f"Table file is missing {key!r}")
+    table_names = set(data['tables']) | set(data['die_tables'])
+
+    for key in ('num_changes', 'lengths'):
+        _check(data[key] and all(row.get('weight', 0) > 0 for row in data[key]), f"{key}: every row needs a positive weight")
+    for row in data['num_changes']:
+        value = row.get('value')
+        _check(isinstance(value, int) and not isinstance(value, bool) and value >= 0, "num_changes: every value must be a whole number of changes (0 or more)")
+    for row in data['lengths']:
+        _check(len(row.get('dice', ())) == 2 and 'mult' in row and 'add' in row, "lengths: rows need dice, mult and add")
+
+    for name, rows in data['tables'].items():
+        _check(isinstance(rows, list) and rows, f"Table {name!r} must be a non-empty list")
+        for i, row in enumerate(rows):
+            _check(row.get('weight', 0) > 0, f"Table {name!r} row {i}: weight must be positive")
+            _check('name' in row, f"Table {name!r} row {i}: missing name")
+            _check_row(row, f"Table {name!r} row {i}", table_names, data['types'])
+
+    for name, table in data['die_tables'].items():
+        die = table.get('die')
+        _check(isinstance(die, int) and die >= 1, f"Die table {name!r}: die must be a positive int")
+        covered = []
+        for i, entry in enumerate(table.get('entries', [])):
+            lo, hi = entry.get('roll', (0, -1))
+            _check(1 <= lo <= hi <= die, f"Die table {name!r} entry {i}: roll must be within 1..{die}")
+            covered.extend(range(lo, hi + 1))
+            _check_row(entry, f"Die table {name!r} entry {i}", table_names, data['types'])
+        _check(sorted(covered) == list(range(1, die + 1)), f"Die table {name!r}: entries must cover 1..{die} exactly once")
+
+    for type_name, spec in data['types'].items():
+        _check('attributes' in spec and 'special' in spec, f"Type {type_name!r} needs attributes and special")
+        for attr in spec['attributes']:
+            where = f"Type {type_name!r} attribute {attr.get('name')!r}"
+            _check(attr.get('weight_in_change', 0) > 0, f"{where}: weight_in_change must be positive")
+            if attr.get('name') == 'special':
+                continue
+            if 'table' in attr:
+                _check(attr['table'] in data['tables'], f"{where}: unknown table")
+            elif 'die_table' in attr:
+                _check(attr['die_table'] in data['die_tables'], f"{where}: unknown die table")
+            else:
+                _check(attr.get('generator') in GENERATORS, f"{where}: needs a table, die_table or known generator")
+            _check(attr.get('mutator') in (None,) + tuple(MUTATORS), f"{where}: unknown mutator")
+        special = spec['special']
+        _check(special.get('table', special.get('die_table')) in table_names, f"Type {type_name!r}: unknown special table")
+
+def compile_tables(data, digest, path=None):
+    validate_tables(data)
+    data = dict(data)
+    data['tables'] = {name: _frozen_rows(rows) for name, rows in data['tables'].items()}
+    return TableSet(data, digest, path)
+
+def _tables_cache_path(path, digest):
+    directory = os.path.join(os.path.dirname(os.path.abspath(path)), '__pycache__')
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(directory, f"{stem}.{digest[:16]}.tables.pickle")
+
+# TableSets already loaded in this process, by (path, mtime, size) and by digest
+_tables_by_stat = {}
+_tables_by_digest = {}
+_tables_lock = threading.Lock()
+
+def load_tables(path=None, use_cache=True):
+    # Loads (or returns the already loaded) TableSet for a table file
+    path = os.path.abspath(path or DEFAULT_TABLES_PATH)
+    st = os.stat(path)
+    stat_key = (path, st.st_mtime_ns, st.st_size)
+    with _tables_lock:
+        tables = _tables_by_stat.get(stat_key)
+        if tables is not None:
+            return tables
+
+        with open(path, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw + f"/v{TABLES_CACHE_VERSION}".encode()).hexdigest()
+        tables = _tables_by_digest.get(digest)
+
+        cache_path = _tables_cache_path(path, digest)
+        if tables is None and use_cache:
+            # The cache is trusted like the .pyc files next to it
+            try:
+                with open(cache_path, 'rb') as f:
+                    cached = pickle.load(f)
+                tables = TableSet(cached['data'], digest, path, cached['compiled'])
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError, KeyError, TypeError):
+                tables = None
+
+        if tables is None:
+            try:
+                data = json.loads(raw)
+            except ValueError as e:
+                raise TableError(f"{path}: {e}") from None
+            tables = compile_tables(data, digest, path)
+            if use_cache:
+                try:
+                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                    tmp = f"{cache_path}.{os.getpid()}.tmp"
+                    with open(tmp, 'wb') as f:
+                        pickle.dump({'data': tables.data, 'compiled': tables.compiled_state()}, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmp, cache_path)
+                except OSError:
+                    pass # Read-only location, compile again next time
+
+        _tables_by_digest[digest] = tables
+        _tables_by_stat[stat_key] = tables
+        return tables
+
+def resolve_tables(tables=None):
+    # None means the default file, a str is a table file path and a dict comes
+    # from table_source (built once per process and digest)
+    if isinstance(tables, TableSet):
+        return tables
+    if isinstance(tables, dict):
+        with _tables_lock:
+            found = _tables_by_digest.get(tables['digest'])
+            if found is None:
+                found = _tables_by_digest[tables['digest']] = TableSet(tables['data'], tables['digest'], None, tables['compiled'])
+        return found
+    return load_tables(tables)
+
+def table_source(tables=None):
+    # What to send to worker processes for them to resolve the same tables:
+    # the file path, or for a TableSet built in memory its data and compiled
+    # samplers
+    if not isinstance(tables, TableSet):
+        return tables
+    if tables.path is not None:
+        return tables.path
+    return {'digest': tables.digest, 'data': tables.data, 'compiled': tables.compiled_state()}
+
+def eval_value(spec, values, rng, tables):
+    # One value spec:
+    #   7 / "text"                       constant
+    #   [low, high]                      rng.randint(low, high)
+    #   {"dice": [n, s], "mult", "add"}  roll(n, s) * mult + add
+    #   {"chance": [k, die], "then", "else"}  then-value if 1d<die> <= k
+    #   {"repeat": count, "each": spec}  sum of 'each' rolled count times
+    #                                    (count is a spec or an earlier value)
+    #   {"format": "..."}                text from the earlier values
+    if isinstance(spec, (int, str)):
+        return spec
+    if isinstance(spec, (list, tuple)):
+        return rng.randint(spec[0], spec[1])
+    if 'dice' in spec:
+        return roll(spec['dice'][0], spec['dice'][1], rng) * spec.get('mult', 1) + spec.get('add', 0)
+    if 'chance' in spec:
+        k, die = spec['chance']
+        branch = spec.get('then', 1) if rng.randint(1, die) <= k else spec.get('else', 0)
+        return eval_value(branch, values, rng, tables)
+    if 'repeat' in spec:
+        count = values[spec['repeat']] if isinstance(spec['repeat'], str) else eval_value(spec['repeat'], values, rng, tables)
+        return sum(eval_value(spec['each'], values, rng, tables) for _ in range(count))
+    return spec['format'].format(**values)
+
+def eval_value_many(spec, values, count, gen):
+    # eval_value for 'count' rows at once, drawn with a numpy Generator: an
+    # array of results, given the earlier values as arrays. None for specs
+    # that cannot be drawn as columns (formats and what depends on them).
+    if isinstance(spec, (int, str)):
+        return np.full(count, spec, dtype=object if isinstance(spec, str) else np.int64)
+    if isinstance(spec, (list, tuple)):
+        return gen.integers(spec[0], spec[1] + 1, size=count)
+    if 'dice' in spec:
+        return roll_many(spec['dice'][0], spec['dice'][1], count, gen) * spec.get('mult', 1) + spec.get('add', 0)
+    if 'chance' in spec:
+        k, die = spec['chance']
+        hit = gen.integers(1, die + 1, size=count) <= k
+        then = eval_value_many(spec.get('then', 1), values, count, gen)
+        other = eval_value_many(spec.get('else', 0), values, count, gen)
+        if then is None or other is None:
+            return None
+        return np.where(hit, then, other)
+    if 'repeat' in spec:
+        counts = values.get(spec['repeat']) if isinstance(spec['repeat'], str) else eval_value_many(spec['repeat'], values, count, gen)
+        if counts is None:
+            return None
+        each = eval_value_many(spec['each'], {}, int(counts.sum()), gen)
+        if each is None:
+            return None
+        # Sum of each row's run of draws, from the running total
+        ends = np.cumsum(counts)
+        running = np.concatenate(([0], np.cumsum(each)))
+        return running[ends] - running[ends - counts]
+    return None
+
+def resolve_entry(entry, rng, tables):
+    # Rolls an entry's values (and sub-table) and returns (text, values)
+    values = {}
+    for name, spec in entry.get('values', {}).items():
+        values[name] = eval_value(spec, values, rng, tables)
+    if 'table' in entry:
+        values['result'] = resolve_entry(tables.roll_on(entry['table'], rng), rng, tables)[0]
+    return _entry_text(entry, values), values
+
+def _entry_text(entry, values):
+    if entry.get('none'):
+        return None
+    if 'format' in entry:
+        return entry['format'].format(**values)
+    return entry.get('text', entry.get('name'))
+
+def entry_values_many(entry, count, gen, rng=random, tables=None):
+    # The rolled values of 'count' rolls of one entry as arrays, formats left
+    # out and the sub-table text as 'result', or None when the entry has to
+    # be resolved row by row
+    if entry.get('none'):
+        return None
+    values = {}
+    for name, spec in entry.get('values', {}).items():
+        if isinstance(spec, dict) and 'format' in spec:
+            continue
+        column = eval_value_many(spec, values, count, gen)
+        if column is None:
+            return None
+        values[name] = column
+    if 'table' in entry:
+        values['result'] = table_texts_many(entry['table'], count, gen, rng, tables)
+    return values
+
+def _rolled_rows(rolled, count):
+    # Names and per-row value tuples of entry_values_many's columns
+    names = list(rolled)
+    if not names:
+        return names, repeat((), count)
+    return names, zip(*[rolled[name].tolist() for name in names])
+
+def resolve_entry_from(entry, rolled):
+    # resolve_entry for an entry whose rolled values are known (one row of
+    # entry_values_many): the formats are filled in, in entry order
+    values = {}
+    for name, spec in entry.get('values', {}).items():
+        values[name] = spec['format'].format(**values) if isinstance(spec, dict) and 'format' in spec else rolled[name]
+    if 'table' in entry:
+        values['result'] = rolled['result']
+    return _entry_text(entry, values), values
+
+def table_texts_many(table_name, count, gen, rng=random, tables=None):
+    # resolve_entry's text for 'count' rolls on a table, as an object array
+    tables = resolve_tables(tables)
+    entry_pos = tables.roll_many_on(table_name, count, gen)
+    texts = np.empty(count, dtype=object)
+    for i, entry in enumerate(tables.entries_of(table_name)):
+        rows = np.flatnonzero(entry_pos == i)
+        if not len(rows):
+            continue
+        rolled = entry_values_many(entry, len(rows), gen, rng, tables)
+        if rolled is None:
+            texts[rows] = [resolve_entry(entry, rng, tables)[0] for _ in range(len(rows))]
+            continue
+        names, rolled_rows = _rolled_rows(rolled, len(rows))
+        seen = {}
+        for r, row in zip(rows.tolist(), rolled_rows):
+            text = seen.get(row)
+            if text is None:
+                text = seen[row] = resolve_entry_from(entry, dict(zip(names, row)))[0]
+            texts[r] = text
+    return texts
 
 # --- Generators for Dynamic Attributes ---
 
-def gen_wet_width():
+def _is_fixed(entry):
+    # True when an entry rolls nothing, so its value never changes
+    if entry.get('none') or not ('name' in entry or 'text' in entry or 'format' in entry):
+        return False
+    return 'table' not in entry and all(isinstance(v, (int, str)) or (isinstance(v, dict) and 'format' in v) for v in entry.get('values', {}).values())
+
+def gen_table_value(rng, tables, table_name):
+    # Attribute value from a die table: text for 'text'/'format' entries,
+    # otherwise {'name': ..., **values} (values starting with _ are scratch)
+    die_table = tables.die_tables.get(table_name)
+    if die_table is None:
+        return entry_value(tables.roll_on(table_name, rng), rng, tables)
+    i = die_table.codes[rng.randint(1, die_table.die)]
+    fixed = die_table.fixed[i]
+    if fixed is not None:
+        return fixed
+    return entry_value(die_table.entries[i], rng, tables)
+
+def entry_value(entry, rng, tables):
+    # Attribute value of one rolled entry
+    return _attribute_value(entry, *resolve_entry(entry, rng, tables))
+
+def _attribute_value(entry, text, values):
+    if 'format' in entry or 'text' in entry:
+        return text
+    value = {'name': entry['name']}
+    for k, v in values.items():
+        if not k.startswith('_'):
+            value[k] = v
+    return value
+
+class DieValueCodes:
+    # Die table attribute values in bulk, as codes into a ValueTable. The
+    # values of each rolled entry are drawn as columns with a numpy Generator
+    # (entry_values_many), and each distinct row of them is built and interned
+    # once. Entries that cannot be drawn as columns are resolved row by row
+    # with rng, as gen_table_value does.
+    def __init__(self, die_table, value_table, tables):
+        self.die_table = die_table
+        self.value_table = value_table
+        self.tables = tables
+        self.fixed = [None if v is None else value_table.intern(v) for v in die_table.fixed]
+        self.seen = [{} for _ in die_table.entries]
+
+    def roll_many(self, count, gen, rng):
+        entry_pos = self.die_table.roll_many(count, gen)
+        out = np.empty(count, dtype=np.int64)
+        intern = self.value_table.intern
+        for i, entry in enumerate(self.die_table.entries):
+            rows = np.flatnonzero(entry_pos == i)
+            if not len(rows):
+                continue
+            if self.fixed[i] is not None:
+                out[rows] = self.fixed[i]
+                continue
+            rolled = entry_values_many(entry, len(rows), gen, rng, self.tables)
+            if rolled is None:
+                out[rows] = [intern(entry_value(entry, rng, self.tables)) for _ in range(len(rows))]
+                continue
+            seen = self.seen[i]
+            names, rolled_rows = _rolled_rows(rolled, len(rows))
+            codes = []
+            for row in rolled_rows:
+                code = seen.get(row)
+                if code is None:
+                    code = seen[row] = intern(_attribute_value(entry, *resolve_entry_from(entry, dict(zip(names, row)))))
+                codes.append(code)
+            out[rows] = codes
+        return out
+
+def _wet_size(width, spec):
+    cat = "Narrow" if width <= spec['narrow_max'] else "Average"
+    h = spec['height']
+    return {'name': cat, 'dim': f"{h}'x{width}'", 'h': h, 'w': width}
+
+def gen_wet_width(rng=random, tables=None):
     # 5d12
     # 5-20: Narrow
     # 20+: Average (Actually 21+)
-    val = roll(5, 12)
-    cat = "Narrow" if val <= 20 else "Average"
     # Default height 10 for now
-    return {'name': cat, 'dim': f"10'x{val}'", 'h': 10, 'w': val}
+    spec = resolve_tables(tables).wet_width
+    return _wet_size(roll(spec['dice'][0], spec['dice'][1], rng), spec)
 
-def gen_water_depth():
+def gen_water_depth(rng=random, tables=None):
     # 1d10 table
     # 1: 1' or less
     # 2-3: 1-4' deep (User said 2 is 1-4', 3 was missing, assuming 3 is also 1-4')
     # 4-6: 5-9' deep
     # 7-9: 10' deep
     # 10: 15' deep
-    r = random.randint(1, 10)
-    if r == 1:
-        return {'name': "1' or less deep", 'depth_ft': 1}
-    elif 2 <= r <= 3:
-        val = random.randint(1, 4)
-        return {'name': "1-4' deep", 'depth_ft': val}
-    elif 4 <= r <= 6:
-        val = random.randint(5, 9)
-        return {'name': "5-9' deep", 'depth_ft': val}
-    elif 7 <= r <= 9:
-        return {'name': "10' deep", 'depth_ft': 10}
-    else: # 10
-        return {'name': "15' deep", 'depth_ft': 15}
-
-def gen_wet_ceiling():
+    return gen_table_value(rng, resolve_tables(tables), 'water_depth')
+
+def gen_wet_ceiling(rng=random, tables=None):
     # 1d10
     # 1: 1' or less
     # 2-3: 1-4'
     # 4-8: 5'
     # 9-10: 10'
-    r = random.randint(1, 10)
-    if r == 1:
-        return {'name': "1' or less", 'height_ft': 1}
-    elif 2 <= r <= 3:
-        val = random.randint(1, 4)
-        return {'name': "1-4'", 'height_ft': val}
-    elif 4 <= r <= 8:
-        return {'name': "5'", 'height_ft': 5}
-    else: # 9-10
-        return {'name': "10'", 'height_ft': 10}
-
-def gen_flow_rate():
+    return gen_table_value(rng, resolve_tables(tables), 'wet_ceiling')
+
+def gen_flow_rate(rng=random, tables=None):
     # 1d20
     # 1-4 Stagnant
     # 5-9 Placid (1-40' per rounnd)
     # 10-15 Medium (41-120' per round), 1-2 on a d6 means a drop-off 1-3' per mile
     # 16-19 Rapid (121-240' per round), 1-5 on a d6 means a drop-off of 1-4' per mile
     # 20 Cascade (241-600' per round), 3-18 drop offs of 1d8' of height per mile
-    
-    r = random.randint(1, 20)
-    drop_ft_per_mile = 0
-    
-    if r <= 4:
-        # Stagnant
-        return {'name': "Stagnant", 'speed': "0'", 'drop_ft_per_mile': 0}
-    elif r <= 9:
-        # Placid
-        speed = random.randint(1, 40)
-        return {'name': "Placid", 'speed': f"{speed}'/rnd", 'drop_ft_per_mile': 0}
-    elif r <= 15:
-        # Medium
-        speed = random.randint(41, 120)
-        # 1-2 on d6 for drop off
-        if random.randint(1, 6) <= 2:
-            drop_ft_per_mile = random.randint(1, 3)
-        return {'name': "Medium", 'speed': f"{speed}'/rnd", 'drop_ft_per_mile': drop_ft_per_mile}
-    elif r <= 19:
-        # Rapid
-        speed = random.randint(121, 240)
-        # 1-5 on d6 for drop off
-        if random.randint(1, 6) <= 5:
-            drop_ft_per_mile = random.randint(1, 4)
-        return {'name': "Rapid", 'speed': f"{speed}'/rnd", 'drop_ft_per_mile': drop_ft_per_mile}
-    else: # 20
-        # Cascade
-        speed = random.randint(241, 600)
-        # 3-18 drop offs of 1d8' per mile
-        num_drops = roll(3, 6)
-        total_drop = sum(random.randint(1, 8) for _ in range(num_drops))
-        return {'name': "Cascade", 'speed': f"{speed}'/rnd", 'drop_ft_per_mile': total_drop}
-
-def gen_water_temp():
+    return gen_table_value(rng, resolve_tables(tables), 'flow_rate')
+
+def gen_water_temp(rng=random, tables=None):
     # 1d20
     # 1 32 degrees
     # 2-3 33-35 degrees
@@ -104,24 +734,16 @@ def gen_water_temp():
     # 18 51-80 degrees
     # 19 81-100 degrees
     # 20 100+ degrees
-    r = random.randint(1, 20)
-    if r == 1: return "32 F"
-    if 2 <= r <= 3: return f"{random.randint(33, 35)} F"
-    if 4 <= r <= 12: return f"{random.randint(36, 40)} F"
-    if 13 <= r <= 15: return f"{random.randint(41, 45)} F"
-    if 16 <= r <= 17: return f"{random.randint(46, 50)} F"
-    if r == 18: return f"{random.randint(51, 80)} F"
-    if r == 19: return f"{random.randint(81, 100)} F"
-    return "100+ F"
-
-def mutate_wet_width(current_size_obj):
+    return gen_table_value(rng, resolve_tables(tables), 'water_temp')
+
+def mutate_wet_width(current_size_obj, rng=random, tables=None):
     # 1-4 Section Width (roll a d6: 1 decrease by 10' or by 5' if width is already 10', 2-5 no change, 6 increase width by 10)
     # Actually the d20 change table says "1-4 Section Width". IF we picked Width to change, THEN we do the d6 logic.
     
     current_w = current_size_obj['w']
     # If width not in object? It should be there.
     
-    d6 = random.randint(1, 6)
+    d6 = rng.randint(1, 6)
     new_w = current_w
     
     if d6 == 1:
@@ -134,10 +756,29 @@ def mutate_wet_width(current_size_obj):
     # 2-5 no change
     
     # Reconstruct size object
-    cat = "Narrow" if new_w <= 20 else "Average"
-    return {'name': cat, 'dim': f"10'x{new_w}'", 'h': 10, 'w': new_w}
+    return _wet_size(new_w, resolve_tables(tables).wet_width)
+
+def mutate_wet_width_many(current_size_obj, counts, gen, tables=None):
+    # mutate_wet_width applied counts[i] times in a row for each i in turn,
+    # with the d6 rolls drawn in bulk; one size per row, one dict per width
+    spec = resolve_tables(tables).wet_width
+    rolls = iter(gen.integers(1, 7, size=sum(counts)).tolist())
+    w = current_size_obj['w']
+    sizes = {}
+    out = []
+    for count in counts:
+        for d6 in islice(rolls, count):
+            if d6 == 1:
+                w = max(5, w - 5) if w <= 10 else w - 10
+            elif d6 == 6:
+                w += 10
+        size = sizes.get(w)
+        if size is None:
+            size = sizes[w] = _wet_size(w, spec)
+        out.append(size)
+    return out
 
-def gen_wet_condition():
+def gen_wet_condition(rng=random):
 
     # Wet tunnels are always wet? 
     # The prompt says "generation... is essentially the same... but attributes differ"
@@ -148,507 +789,1469 @@ def gen_wet_condition():
     # We should probably define a specific set for Wet tunnels. 
     # Let's assume they are "Water-filled" by definition, but maybe the *condition* describes the flow/smell/etc?
     # For now, I'll define a placeholder set that makes sense for "Wet" tunnels.
-    return random.choice([
+    return rng.choice([
         {'name': "Stagnant", 'weight': 20},
         {'name': "Flowing slowly", 'weight': 40},
         {'name': "Rushing", 'weight': 20},
         {'name': "Murky", 'weight': 20},
     ])
 
+# Code-backed attributes a table file can refer to by name
+GENERATORS = {
+    'wet_width': gen_wet_width,
+}
+MUTATORS = {
+    'wet_width': mutate_wet_width,
+}
+# Bulk versions of mutators for the numpy engine: (value, counts, gen) to one
+# value per count. Mutators without one are called row by row.
+BULK_MUTATORS = {
+    'wet_width': mutate_wet_width_many,
+}
+
 # --- Configuration Data ---
 
-def get_config(tunnel_type, min_height=0, min_width=0):
-    # Shared choices
-    
-    # Length Categories (Same for both)
-    len_choices = [
-        {'gen': lambda: roll(5, 8),                       'weight': 10},
-        {'gen': lambda: roll(10, 6) + 30,                 'weight': 20},
-        {'gen': lambda: roll(10, 4) * 10,                 'weight': 25},
-        {'gen': lambda: roll(10, 6) * 10 + 400,           'weight': 35},
-        {'gen': lambda: roll(10, 4) * 50,                 'weight': 10}
-    ]
-    
-    # Slopes (Shared relative weights? Or specific to type? Assuming shared for now)
-    slope_choices = [
-        {'name': "Steep Up",      'range': (51, 70),   'weight': 5},
-        {'name': "Moderate Up",   'range': (31, 50),   'weight': 10},
-        {'name': "Gentle Up",     'range': (15, 30),   'weight': 20},
-        {'name': "Level",         'range': (-14, 14),  'weight': 30},
-        {'name': "Gentle Down",   'range': (15, 30),   'weight': 20},
-        {'name': "Moderate Down", 'range': (31, 50),   'weight': 10},
-        {'name': "Steep Down",    'range': (51, 70),   'weight': 5},
-    ]
-
-    # Directions (Shared)
-    dir_choices = [
-        {'name': "Curving right",        'weight': 15},
-        {'name': "Curving left",         'weight': 15},
-        {'name': "Sharp right",          'weight': 5},
-        {'name': "Sharp left",           'weight': 5},
-        {'name': "Straight",             'weight': 40},
-        {'name': "Twisting and snaking", 'weight': 20},
-    ]
-
-    # Illumination (Shared)
-    illumination_choices = [
-        {'name': "None",                                           'weight': 50},
-        {'name': "Very weak (moonless)",                           'weight': 20},
-        {'name': "Weak light (moonlight with overcast clouds)",     'weight': 15},
-        {'name': "Moderate light (moonlight with no clouds)",      'weight': 10},
-        {'name': "Bright light (twlight)",                         'weight': 5},
-    ]
-
-    # Air (Shared)
-    air_choices = [
-        {'name': "Poison/noxious gas",                                  'weight': 5},
-        {'name': "Stale",                                               'weight': 5},
-        {'name': "Faint circulation",                                   'weight': 20},
-        {'name': "Normal",                                              'weight': 35},
-        {'name': "Drafty (1% chance of torch blowout a round)",         'weight': 15},
-        {'name': "Windy (10% chance of torch blowout per round)",       'weight': 10},
-        {'name': "Rushing air (50% chance of torch blowout per round)", 'weight': 5},
-        {'name': "Steam vapors",                                        'weight': 5},
-    ]
-
-    if tunnel_type == 'dry':
-        # Dry Specific Config
-        
-        # Dimensions (Standard Table)
-        size_choices_all = [
-            {'name': "Tiny",        'dim': "1'x1'",   'h': 1,  'w': 1,  'weight': 5},
-            {'name': "Tight",       'dim': "2'x2'",   'h': 2,  'w': 2,  'weight': 5},
-            {'name': "Crawl",       'dim': "3'x3'",   'h': 3,  'w': 3,  'weight': 10},
-            {'name': "Wide Crawl",  'dim': "3'x5'",   'h': 3,  'w': 5,  'weight': 10},
-            {'name': "Very Narrow", 'dim': "5'x3'",   'h': 5,  'w': 3,  'weight': 15},
-            {'name': "Narrow",      'dim': "5'x5'",   'h': 5,  'w': 5,  'weight': 20},
-            {'name': "Normal",      'dim': "10'x10'", 'h': 10, 'w': 10, 'weight': 25},
-            {'name': "Wide",        'dim': "15'x15'", 'h': 15, 'w': 15, 'weight': 5},
-            {'name': "Very Wide",   'dim': "20'x60'", 'h': 20, 'w': 60, 'weight': 5},
-        ]
-        
-        # Filter sizes
-        size_choices = [s for s in size_choices_all if s['h'] >= min_height and s['w'] >= min_width]
-        if not size_choices:
-            print(f"Warning: No size options match min_height={min_height} and min_width={min_width}. Reverting to default list.")
-            size_choices = size_choices_all
-
-        # Textures
-        texture_choices = [
-            {'name': "Slick and polished",      'weight': 10},
-            {'name': "Smooth",                  'weight': 15},
-            {'name': "Normal",                  'weight': 30},
-            {'name': "Rough",                   'weight': 15},
-            {'name': "Tiered",                  'weight': 10},
-            {'name': "Covered in large boulders", 'weight': 10},
-            {'name': "Covered in sharp rocks",  'weight': 5},
-        ]
-
-        # Conditions
-        condition_choices = [
-            {'name': "Water-filled (up to 1' deep)",                 'weight': 5},
-            {'name': "Slippery (wet and slimy)",                      'weight': 25},
-            {'name': "Slick (damp or wet)",                           'weight': 45},
-            {'name': "Dry, good looking",                             'weight': 20},
-            {'name': "Dusty (dead tunnel check for cave-in chances)", 'weight': 5},
-        ]
-
-        # Attribute Map with Getters
-        # Helper to make a getter for weighted choices
-        def make_picker(choices):
-            weights = [c['weight'] for c in choices]
-            return lambda: random.choices(choices, weights=weights, k=1)[0]
+def _len_gen(num_dice, sides, mult, add):
+    sampler = dice_sampler(num_dice, sides)
+    if sampler is not None:
+        draw = sampler.draw
+        return lambda rng=random: draw(rng) * mult + add
+    return lambda rng=random: roll(num_dice, sides, rng) * mult + add
 
-        return {
-            'len_choices': len_choices,
-            'len_weights': [c['weight'] for c in len_choices],
-            'attributes': {
-                'size': {'getter': make_picker(size_choices), 'weight_in_change': 20},
-                'slope': {'getter': make_picker(slope_choices), 'weight_in_change': 15},
-                'dir': {'getter': make_picker(dir_choices), 'weight_in_change': 20},
-                'tex': {'getter': make_picker(texture_choices), 'weight_in_change': 20},
-                'cond': {'getter': make_picker(condition_choices), 'weight_in_change': 10},
-                'air': {'getter': make_picker(air_choices), 'weight_in_change': 5},
-                'illum': {'getter': make_picker(illumination_choices), 'weight_in_change': 5},
-                'special': {'weight_in_change': 5}
-            },
-            'special_gen': gen_dry_special_feature
+def _bind(fn, tables):
+    # Getter/mutator bound to one TableSet, same call shape as before
+    return lambda *args: fn(*args, tables=tables)
+
+def _compile_config(tables, len_choices, attributes, special_gen):
+    # Compile the samplers shared by every section of a tunnel
+    len_choices = [dict(c, gen=_len_gen(c['dice'][0], c['dice'][1], c['mult'], c['add'])) for c in len_choices]
+
+    # Table backed attributes get a precompiled sampler as their getter
+    for attr in attributes.values():
+        if 'choices' in attr:
+            if 'sampler' not in attr:
+                attr['sampler'] = WeightedSampler(attr['choices'], [c['weight'] for c in attr['choices']])
+            attr['getter'] = attr['sampler'].draw
+
+    attr_keys = list(attributes.keys())
+    return _freeze({
+        'tables': tables,
+        'len_choices': len_choices,
+        'len_weights': [c['weight'] for c in len_choices],
+        'len_sampler': WeightedSampler(len_choices, [c['weight'] for c in len_choices]),
+        'num_change_sampler': tables.num_change_sampler,
+        'attributes': attributes,
+        'change_sampler': WeightedSampler(attr_keys, [attributes[k]['weight_in_change'] for k in attr_keys]),
+        'special_gen': special_gen
+    })
+
+def _freeze(obj, depth=0):
+    # Read-only view of a compiled config: mappings down to the attribute
+    # settings become MappingProxyType and every list (an attribute's choices
+    # too) becomes a tuple of its own, so no cached config shares a mutable
+    # list with the TableSet. Rows themselves stay plain dicts because they
+    # are handed out as section values; never mutate them.
+    if isinstance(obj, list):
+        return tuple(obj)
+    if depth > 2:
+        return obj
+    if isinstance(obj, dict):
+        return MappingProxyType({k: _freeze(v, depth + 1) for k, v in obj.items()})
+    return obj
+
+# Compiled configs by (table digest, tunnel_type, min_height, min_width), least recently used first
+CONFIG_CACHE_SIZE = 64
+_config_cache = OrderedDict()
+_config_lock = threading.Lock()
+
+def get_config(tunnel_type, min_height=0, min_width=0, tables=None):
+    # Memoized: tables, samplers and the size filter are compiled once per key
+    # and shared (read-only) by every tunnel and thread asking for that key.
+    # tables is a TableSet or table file path, None for the default tables.
+    tables = resolve_tables(tables)
+    key = (tables.digest, tunnel_type, min_height, min_width)
+    with _config_lock:
+        config = _config_cache.get(key)
+        if config is not None:
+            _config_cache.move_to_end(key)
+            return config
+        config = _build_config(tunnel_type, min_height, min_width, tables)
+        _config_cache[key] = config
+        if len(_config_cache) > CONFIG_CACHE_SIZE:
+            _config_cache.popitem(last=False)
+        return config
+
+def clear_config_cache():
+    with _config_lock:
+        _config_cache.clear()
+
+def _build_config(tunnel_type, min_height=0, min_width=0, tables=None):
+    tables = resolve_tables(tables)
+    if tunnel_type not in tables.types:
+        raise ValueError(f"Unknown tunnel type {tunnel_type!r} (expected one of {', '.join(sorted(tables.types))})")
+    type_spec = tables.types[tunnel_type]
+
+    attributes = {}
+    for spec in type_spec['attributes']:
+        name = spec['name']
+        attr = {'weight_in_change': spec['weight_in_change']}
+        if name == 'special':
+            attributes[name] = attr
+            continue
+
+        if 'table' in spec:
+            choices = tables.tables[spec['table']]
+            if spec.get('size_filter') and (min_height or min_width):
+                # Filter sizes
+                size_choices = [s for s in choices if s['h'] >= min_height and s['w'] >= min_width]
+                if not size_choices:
+                    print(f"Warning: No size options match min_height={min_height} and min_width={min_width}. Reverting to default list.", file=sys.stderr)
+                    size_choices = choices
+                choices = size_choices
+            if choices is tables.tables[spec['table']]:
+                attr['sampler'] = tables.samplers[spec['table']]
+            attr['choices'] = choices
+        elif 'die_table' in spec:
+            attr['die_table'] = tables.die_tables[spec['die_table']]
+            attr['getter'] = _bind(partial(gen_table_value_for, table_name=spec['die_table']), tables)
+        else:
+            attr['getter'] = _bind(GENERATORS[spec['generator']], tables)
+        if spec.get('mutator'):
+            attr['mutator'] = _bind(MUTATORS[spec['mutator']], tables)
+            if spec['mutator'] in BULK_MUTATORS:
+                attr['mutator_many'] = _bind(BULK_MUTATORS[spec['mutator']], tables)
+        attributes[name] = attr
+
+    special = type_spec['special']
+    special_gen = _bind(partial(gen_special_feature, table_name=special.get('table', special.get('die_table'))), tables)
+    return _compile_config(tables, tables.lengths, attributes, special_gen)
+
+def gen_table_value_for(rng=random, tables=None, table_name=None):
+    return gen_table_value(rng, resolve_tables(tables), table_name)
+
+# --- Section Records ---
+
+class ValueTable:
+    # Interns attribute values so equal values share one small integer code.
+    # Table values are pre-seeded and looked up by identity, generated values
+    # (wet widths, flows, ...) by content. Nothing is ever dropped, since
+    # sections already handed out decode through the table, so a wet tunnel's
+    # tables grow (slowly) with its length.
+    def __init__(self, values=()):
+        self.values = []
+        self.codes = {}
+        self.ids = {}
+        for v in values:
+            self.ids[id(v)] = self.intern(v)
+
+    def intern(self, value):
+        code = self.ids.get(id(value))
+        if code is not None:
+            return code
+        key = tuple(value.items()) if isinstance(value, dict) else value
+        code = self.codes.get(key)
+        if code is None:
+            code = len(self.values)
+            if code > CODE_MASK:
+                raise OverflowError(f"More than {CODE_MASK + 1} distinct values for one attribute")
+            self.codes[key] = code
+            self.values.append(value)
+        return code
+
+# Bits per attribute code in a packed section key; the slope degree (offset
+# to stay positive) sits in the field after the last attribute
+CODE_BITS = 20
+CODE_MASK = (1 << CODE_BITS) - 1
+DEGREE_OFFSET = 128
+
+class SectionSchema:
+    # Attribute layout shared by every section of one tunnel: the state keys
+    # in config order and one ValueTable per key.
+    #
+    # A packed key is the fingerprint of a section's state: two sections of
+    # the same tunnel have equal keys exactly when every attribute and the
+    # degree match, so merging, dedup and description caches compare one int.
+    def __init__(self, config):
+        self.keys = [k for k in config['attributes'] if k != 'special']
+        self.tables = {k: ValueTable(config['attributes'][k].get('choices', ())) for k in self.keys}
+        self.shifts = {k: i * CODE_BITS for i, k in enumerate(self.keys)}
+        self.degree_shift = len(self.keys) * CODE_BITS
+        self.has_degree = 'slope' in self.keys
+        self.section = _section_class(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['section']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.section = _section_class(self)
+
+    @classmethod
+    def from_values(cls, values):
+        # Schema over stored value lists ({key: values} in key order); seeding
+        # each table in order gives back the codes they were stored with
+        return cls({'attributes': {k: {'choices': v} for k, v in values.items()}})
+
+    def pack(self, codes, degree=None):
+        # Packs a code per key (in key order) and the degree into one int
+        key = 0
+        for i, code in enumerate(codes):
+            key |= code << (i * CODE_BITS)
+        if degree is not None:
+            key |= (degree + DEGREE_OFFSET) << self.degree_shift
+        return key
+
+    def set_code(self, key, pos, code):
+        # Key with the code at position pos replaced, for incremental updates
+        shift = pos * CODE_BITS
+        return (key & ~(CODE_MASK << shift)) | (code << shift)
+
+    def set_degree(self, key, degree):
+        return (key & ((1 << self.degree_shift) - 1)) | ((degree + DEGREE_OFFSET) << self.degree_shift)
+
+    def code(self, key, name):
+        return (key >> self.shifts[name]) & CODE_MASK
+
+    def value(self, key, name):
+        return self.tables[name].values[self.code(key, name)]
+
+class Section:
+    # Compact section record. Categorical attributes and the slope degree live
+    # in one packed int of codes into the schema's tables (also the state
+    # fingerprint, see SectionSchema); len and elev are plain numbers. degree
+    # and width (the size's) are read back from the key. The schema is a class
+    # attribute: each SectionSchema has its own subclass, schema.section, so a
+    # record holds only its four fields. Reads like the old section dicts
+    # (s['size'], 'slope' in s).
+    __slots__ = ('len', 'elev', 'special', 'key')
+
+    _FIELDS = ('len', 'elev', 'special')
+    schema = None
+
+    def __init__(self, length, elev, special, key):
+        self.len = length
+        self.elev = elev
+        self.special = special
+        self.key = key
+
+    @property
+    def degree(self):
+        schema = self.schema
+        if not schema.has_degree:
+            return None
+        return (self.key >> schema.degree_shift) - DEGREE_OFFSET
+
+    @property
+    def width(self):
+        return self.schema.value(self.key, 'size')['w']
+
+    def __reduce__(self):
+        return _make_section, (self.schema, self.len, self.elev, self.special, self.key)
+
+    def __getitem__(self, name):
+        if name in self._FIELDS or (name == 'degree' and self.schema.has_degree):
+            return getattr(self, name)
+        if name in self.schema.shifts:
+            return self.schema.value(self.key, name)
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self._FIELDS or name in self.schema.shifts or (name == 'degree' and self.schema.has_degree)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = list(self._FIELDS) + self.schema.keys
+        if self.schema.has_degree:
+            keys.append('degree')
+        return keys
+
+    def as_dict(self):
+        # The old section dict layout
+        return {k: self[k] for k in self.keys()}
+
+    def __repr__(self):
+        return f"Section({self.as_dict()!r})"
+
+def _section_class(schema):
+    return type('Section', (Section,), {'__slots__': (), 'schema': schema})
+
+def _make_section(schema, length, elev, special, key):
+    # Unpickles a Section onto its schema's class
+    return schema.section(length, elev, special, key)
+
+# --- Elevation ---
+# Slope degrees are whole numbers, so the sine of each one is looked up in
+# SIN_BY_DEGREE rather than computed for every section. An elevation profile
+# is the running elevation (feet relative to the entrance, negative is
+# deeper) against the distance along the tunnel. It is read lazily off any
+# section stream, so it can be written out for tunnels too long to keep.
+
+class _SinTable(dict):
+    # sin of an angle in whole degrees; angles outside the prefilled range are
+    # computed once on first use
+    def __missing__(self, degree):
+        value = self[degree] = math.sin(math.radians(degree))
+        return value
+
+SIN_BY_DEGREE = _SinTable((d, math.sin(math.radians(d))) for d in range(-90, 91))
+
+def elevation_profile(sections, every=None):
+    # Yields (feet, elevation) points from the entrance (0, 0) to the end: one
+    # per section end, or with every (feet) one per multiple of every plus the
+    # end of the tunnel, interpolated linearly within a section as
+    # TunnelIndex.elevation_at does
+    feet = 0
+    elev = 0.0
+    yield feet, elev
+    if every is None:
+        for s in sections:
+            feet += s.len
+            elev += s.elev
+            yield feet, elev
+        return
+    if every <= 0:
+        raise ValueError("every must be positive")
+    step = 1
+    last = 0
+    for s in sections:
+        start, start_elev = feet, elev
+        feet += s.len
+        elev += s.elev
+        # Multiples of every, not a running sum, so points do not drift
+        at = step * every
+        while at <= feet:
+            yield at, start_elev + s.elev * (at - start) / s.len
+            last = at
+            step += 1
+            at = step * every
+    if feet > last:
+        yield feet, elev
+
+def elevation_array(points):
+    # (n, 2) float64 array of (feet, elevation) rows from elevation_profile
+    if np is None:
+        raise ImportError("Elevation arrays require numpy (pip install numpy)")
+    flat = array('d')
+    for feet, elev in points:
+        flat.append(feet)
+        flat.append(elev)
+    return np.frombuffer(flat, dtype=np.float64).reshape(-1, 2)
+
+def write_elevation_profile(points, path):
+    # Writes elevation_profile points to a .npy array (needs numpy) or, for any
+    # other path, a feet,elevation CSV streamed point by point. Returns the
+    # number of points written.
+    if path.endswith('.npy'):
+        data = elevation_array(points)
+        np.save(path, data)
+        return len(data)
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        write = f.write
+        write("feet,elevation\n")
+        for feet, elev in points:
+            write(f"{feet:g},{elev:.3f}\n")
+            count += 1
+    return count
+
+# --- Checkpoints ---
+# iter_sections can snapshot itself at the top of its loop, where every
+# section handed out so far has been consumed. A snapshot holds plain data
+# only (attribute values rather than codes, the RNG state and the open
+# section), so it can be pickled by any process and resumed exactly.
+
+SNAPSHOT_VERSION = 3
+
+def _pack_rng_state(state):
+    # random.Random state with the 625 Mersenne Twister words as little
+    # endian bytes: 2.5 KiB instead of about 3.5 KiB of pickled ints
+    version, internal, gauss_next = state
+    words = array('I', internal)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return (version, words.tobytes(), gauss_next)
+
+def _unpack_rng_state(packed):
+    version, data, gauss_next = packed
+    words = array('I')
+    words.frombytes(data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return (version, tuple(words), gauss_next)
+
+def _take_snapshot(params, current_feet, state_values, degree, prev, rng, emitted, emitted_feet, emitted_elev):
+    return {
+        'version': SNAPSHOT_VERSION,
+        'params': params,
+        'current_feet': current_feet,
+        'state': state_values,
+        'degree': degree,
+        'prev': None if prev is None else {'len': prev.len, 'elev': prev.elev, 'special': prev.special},
+        'rng': _pack_rng_state(rng.getstate()),
+        'emitted': emitted,
+        'emitted_feet': emitted_feet,
+        'emitted_elev': emitted_elev,
+    }
+
+def load_snapshot(path):
+    with open(path, 'rb') as f:
+        snapshot = pickle.load(f)
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is not a tunnel checkpoint (or was written by another version)")
+    return snapshot
+
+def save_snapshot(snapshot, path):
+    # Atomic: a crash leaves either the old or the new checkpoint
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class SnapshotHook:
+    # Something iter_sections hands snapshots to (its checkpointer argument):
+    # start() once before the loop, due() at the top of every raw section with
+    # the sections and feet handed out so far, and save() with a fresh
+    # snapshot whenever due() said so. out/before_save
+    # let a hook record where the output stands (see output_offset).
+    out = None
+    before_save = None
+
+    def start(self, emitted):
+        pass
+
+    def due(self, emitted, emitted_feet):
+        return False
+
+    def save(self, snapshot):
+        pass
+
+    def finish(self):
+        pass
+
+    def output_offset(self):
+        # Flushes pending output to out and returns its offset, None when out
+        # is not a regular file (stdout pipe, StringIO)
+        if self.before_save is not None:
+            self.before_save()
+        if self.out is None:
+            return None
+        self.out.flush()
+        try:
+            os.fsync(self.out.fileno())
+            return self.out.tell()
+        except (OSError, AttributeError, io.UnsupportedOperation):
+            return None
+
+class Checkpointer(SnapshotHook):
+    # Decides when iter_sections snapshots itself and saves the snapshot to
+    # path: every 'every' sections handed out and/or every 'interval' seconds.
+    # If out is given it is flushed (after 'before_save', e.g. a renderer's
+    # flush) and its offset is stored as 'out_offset', so a resumed run can cut
+    # the output back to exactly the sections the checkpoint has emitted.
+    # 'meta' is stored with every snapshot for the caller's own settings.
+    def __init__(self, path, every=None, interval=None, out=None, before_save=None, meta=None):
+        if not every and not interval:
+            raise ValueError("Checkpointer needs 'every' and/or 'interval'")
+        self.path = path
+        self.every = every
+        self.interval = interval
+        self.out = out
+        self.before_save = before_save
+        self.meta = meta or {}
+        self.saves = 0
+        self._last_emitted = 0
+        self._last_time = time.monotonic()
+
+    def start(self, emitted):
+        # Count from here, used when resuming mid tunnel
+        self._last_emitted = emitted
+        self._last_time = time.monotonic()
+
+    def due(self, emitted, emitted_feet):
+        if emitted == self._last_emitted:
+            return False
+        if self.every and emitted - self._last_emitted >= self.every:
+            return True
+        return bool(self.interval) and time.monotonic() - self._last_time >= self.interval
+
+    def save(self, snapshot):
+        offset = self.output_offset()
+        if offset is not None:
+            snapshot['out_offset'] = offset
+        snapshot['meta'] = self.meta
+        save_snapshot(snapshot, self.path)
+        self.saves += 1
+        self._last_emitted = snapshot['emitted']
+        self._last_time = time.monotonic()
+
+    def finish(self):
+        # The tunnel is complete, nothing left to resume
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class SnapshotHooks(SnapshotHook):
+    # Several hooks on one generator; each gets its own copy of a snapshot
+    def __init__(self, *hooks):
+        self.hooks = [h for h in hooks if h is not None]
+        self._due = []
+
+    def start(self, emitted):
+        for h in self.hooks:
+            h.start(emitted)
+
+    def due(self, emitted, emitted_feet):
+        self._due = [h for h in self.hooks if h.due(emitted, emitted_feet)]
+        return bool(self._due)
+
+    def save(self, snapshot):
+        for h in self._due:
+            h.save(dict(snapshot))
+
+    def finish(self):
+        for h in self.hooks:
+            h.finish()
+
+# --- Sparse Index ---
+# A sidecar file mapping cumulative feet to section number, byte offset in
+# the output and elevation every K sections, each entry with the generator
+# snapshot taken there. A query bisects the entries and regenerates at most
+# K sections from the nearest snapshot, so "what is at mile X" costs
+# O(log n + K) whatever the tunnel length, without the tunnel itself.
+#
+# The file is a header pickle followed by one pickle per entry, appended as
+# generation goes (so it survives a crash alongside a checkpoint).
+
+INDEX_VERSION = 3
+
+class SectionIndexWriter(SnapshotHook):
+    # Writes the sparse index for one generation run (pass it to
+    # generate_tunnel). 'meta' is stored in the header (format, output path).
+    # resume (a checkpoint snapshot) keeps the entries up to that checkpoint
+    # and appends from there.
+    def __init__(self, path, every=1000, meta=None, resume=None):
+        if every < 1:
+            raise ValueError("Index interval must be at least one section")
+        self.path = path
+        self.every = every
+        self.meta = meta or {}
+        self.entries = 0
+        self._last_emitted = 0
+        self._file = None
+        if resume is not None:
+            header, entries = _read_index(path)
+            entries = [e for e in entries if e['section'] <= resume['emitted'] + 1]
+            self._open(header, entries)
+
+    def _open(self, header, entries=()):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for e in entries:
+                pickle.dump(e, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'ab')
+        self.entries = len(entries)
+
+    def _write(self, entry):
+        pickle.dump(entry, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+        self.entries += 1
+
+    def start(self, emitted):
+        self._last_emitted = emitted
+
+    def due(self, emitted, emitted_feet):
+        # The first entry is the snapshot before section 1
+        return self.entries == 0 or (emitted != self._last_emitted and emitted % self.every == 0)
+
+    def save(self, snapshot):
+        if self._file is None:
+            header = {'version': INDEX_VERSION, 'every': self.every, 'params': snapshot['params'], 'meta': self.meta}
+            self._open(header)
+        self._write({
+            'feet': snapshot['emitted_feet'],
+            'section': snapshot['emitted'] + 1,
+            'offset': self.output_offset(),
+            'elev': snapshot['emitted_elev'],
+            'snapshot': snapshot,
+        })
+        self._last_emitted = snapshot['emitted']
+
+    def finish(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def _read_index(path):
+    entries = []
+    with open(path, 'rb') as f:
+        header = pickle.load(f)
+        if not isinstance(header, dict) or header.get('version') != INDEX_VERSION:
+            raise ValueError(f"{path} is not a tunnel index (or was written by another version)")
+        while True:
+            try:
+                entries.append(pickle.load(f))
+            except EOFError:
+                break
+            except pickle.UnpicklingError:
+                break # Entry cut short by a crash, everything before it is good
+    return header, entries
+
+class TunnelIndex:
+    # Read side of the sparse index: section, elevation and output offset at
+    # any distance. Sections are regenerated from the nearest snapshot with
+    # the python engine and the index's table file (or tables=).
+    def __init__(self, header, entries, tables=None):
+        if not entries:
+            raise ValueError("The index has no entries")
+        self.header = header
+        self.params = header['params']
+        self.meta = header['meta']
+        self.entries = entries
+        self.feet = [e['feet'] for e in entries]
+        self.total_feet = miles_to_feet(self.params['length_miles'])
+        self.tables = tables if tables is not None else self.meta.get('tables')
+
+    @classmethod
+    def load(cls, path, tables=None):
+        header, entries = _read_index(path)
+        return cls(header, entries, tables)
+
+    def iter_from(self, entry):
+        # (section number, start feet, start elevation, section) from an entry on
+        p = self.params
+        number, feet, elev = entry['section'], entry['feet'], entry['elev']
+        for s in iter_sections(p['length_miles'], p['tunnel_type'], p['min_height'], p['min_width'], seed=p['seed'],
+                               tables=self.tables, resume=entry['snapshot']):
+            yield number, feet, elev, s
+            number += 1
+            feet += s.len
+            elev += s.elev
+
+    def _entry_for(self, feet):
+        if not 0 <= feet <= self.total_feet:
+            raise ValueError(f"{feet / 5280:g} miles is outside the tunnel (0 to {self.total_feet / 5280:g} miles)")
+        return self.entries[bisect.bisect_right(self.feet, feet) - 1]
+
+    def locate(self, miles):
+        # (section number, start feet, start elevation, section) at a distance;
+        # the very end of the tunnel belongs to the last section
+        feet = miles * 5280
+        for found in self.iter_from(self._entry_for(feet)):
+            end = found[1] + found[3].len
+            if feet < end or end >= self.total_feet:
+                return found
+
+    def section_at(self, miles):
+        # (section number, section) at a distance
+        number, _, _, s = self.locate(miles)
+        return number, s
+
+    def elevation_at(self, miles):
+        # Elevation relative to the tunnel start, spread evenly along each section
+        number, start, elev, s = self.locate(miles)
+        return elev + s.elev * (miles * 5280 - start) / s.len
+
+    def offset_at(self, miles):
+        # Byte offset in the output of the line for the section at a distance,
+        # None if the output was not a regular file
+        feet = miles * 5280
+        entry = self._entry_for(feet)
+        if entry['offset'] is None:
+            return None
+        # Render what generate_tunnel wrote after the entry's offset (a CSV
+        # header comes after the first entry, it is written with section 1)
+        buf = io.StringIO()
+        renderer = RENDERERS[self.meta.get('format', 'text')](buf, header=entry['section'] == 1)
+        for number, start, _, s in self.iter_from(entry):
+            if number == entry['section']:
+                renderer.bind(s.schema)
+            if feet < start + s.len or start + s.len >= self.total_feet:
+                break
+            renderer.write(number, s)
+        renderer.flush()
+        return entry['offset'] + len(buf.getvalue().encode('utf-8'))
+
+# --- Lazy Tunnels ---
+# A tunnel kept as its settings plus anchors: generator snapshots at the
+# first section boundary past every anchor interval. Spans between anchors
+# are regenerated on demand from their anchor and the recently used ones
+# are kept in an LRU cache. Anchors are found as spans are first generated
+# (or all at once with build_anchors) and save() stores only settings and
+# anchors, a few KiB per anchor instead of the tunnel text.
+
+LAZY_TUNNEL_VERSION = 2
+
+class _AnchorHook(SnapshotHook):
+    # Captures the first snapshot taken at or past 'feet'
+    def __init__(self, feet):
+        self.feet = feet
+        self.anchor = None
+
+    def due(self, emitted, emitted_feet):
+        return self.anchor is None and emitted_feet >= self.feet
+
+    def save(self, snapshot):
+        self.anchor = {
+            'feet': snapshot['emitted_feet'],
+            'section': snapshot['emitted'] + 1,
+            'elev': snapshot['emitted_elev'],
+            'snapshot': snapshot,
         }
-    
-    elif tunnel_type == 'wet':
-        # Wet Specific Config
-        
-        # Size uses a custom generator (5d12 width)
-        # Water Depth is new
-        # Texture - assuming same as dry for now unless specified? 
-        # But 'Dry' textures had "Slime/Polished". Let's reuse dry textures for now.
-        
-        texture_choices = [
-            {'name': "Slick and polished",      'weight': 10},
-            {'name': "Smooth",                  'weight': 15},
-            {'name': "Normal",                  'weight': 30},
-            {'name': "Rough",                   'weight': 15},
-            {'name': "Tiered",                  'weight': 10},
-            {'name': "Covered in large boulders", 'weight': 10},
-            {'name': "Covered in sharp rocks",  'weight': 5},
-        ]
-        
-        # Condition - Specific to wet?
-        # User didn't specify condition table, but "Wet" implies water.
-        # I'll use a placeholder getter or reuse a subset. 
-        # Actually, let's just use the 'gen_wet_condition' placeholder defined above
-        # or just label it "Submerged" if depth is high?
-        # Let's stick to the 'gen_water_depth' as the primary differentiator and maybe a simple condition.
-        # I will reuse the standard condition list BUT filter out "Dry" options?
-        # "Water-filled", "Slippery", "Slick" make sense. "Dry", "Dusty" do not.
-        wet_cond_choices = [
-            {'name': "Water-filled",       'weight': 30},
-            {'name': "Slippery (wet/slimy)", 'weight': 30},
-            {'name': "Slick (damp/wet)",    'weight': 40},
-        ]
-        
-        
-        def make_picker(choices):
-            weights = [c['weight'] for c in choices]
-            return lambda: random.choices(choices, weights=weights, k=1)[0]
-
-        # 1-15 None
-        # 16-18 Very weak (moonless)
-        # 19-20 Weak light (moonlight with overcast clouds)
-        wet_illum_choices = [
-            {'name': "None",                                       'weight': 15},
-            {'name': "Very weak (moonless)",                       'weight': 3},
-            {'name': "Weak light (moonlight with overcast clouds)", 'weight': 2},
-        ]
 
+class LazyTunnel:
+    # Random access to a seeded tunnel without storing it. A span is a list of
+    # (section number, start feet, start elevation, section).
+    def __init__(self, length_miles, tunnel_type='dry', min_height=0, min_width=0, seed=None, tables=None,
+                 anchor_miles=10, cache_size=64, anchors=None):
+        if seed is None:
+            raise ValueError("A lazy tunnel needs a seed to regenerate from")
+        self.params = {
+            'length_miles': length_miles, 'tunnel_type': tunnel_type, 'min_height': min_height,
+            'min_width': min_width, 'seed': seed,
+        }
+        self.tables = resolve_tables(tables)
+        self.total_feet = miles_to_feet(length_miles)
+        self.anchor_feet = max(1, miles_to_feet(anchor_miles))
+        self.cache_size = cache_size
+        self.complete = False
+        self._spans = OrderedDict()
+        self._lock = threading.Lock()
+        if anchors is None:
+            # Anchor 0 is the snapshot before section 1
+            hook = _AnchorHook(0)
+            sections = self._iter(None, hook)
+            next(sections, None)
+            sections.close()
+            anchors = [hook.anchor]
+        self.anchors = anchors
+        self._anchor_feet = [a['feet'] for a in anchors]
+
+    def _iter(self, snapshot, hook=None):
+        p = self.params
+        return iter_sections(p['length_miles'], p['tunnel_type'], p['min_height'], p['min_width'], seed=p['seed'],
+                             tables=self.tables, checkpointer=hook, resume=snapshot)
+
+    def _generate_span(self, i):
+        # Sections from anchor i up to the next one, finding that anchor
+        # first if this is the last known span
+        anchor = self.anchors[i]
+        last = i + 1 == len(self.anchors)
+        end_section = None if last else self.anchors[i + 1]['section']
+        hook = _AnchorHook(anchor['feet'] + self.anchor_feet) if last else None
+        number, feet, elev = anchor['section'], anchor['feet'], anchor['elev']
+        span = []
+        sections = self._iter(anchor['snapshot'], hook)
+        for s in sections:
+            if number == end_section or (hook is not None and hook.anchor is not None):
+                break # s opens the next span
+            span.append((number, feet, elev, s))
+            number += 1
+            feet += s.len
+            elev += s.elev
+        sections.close()
+        if last:
+            if hook.anchor is not None:
+                self.anchors.append(hook.anchor)
+                self._anchor_feet.append(hook.anchor['feet'])
+            else:
+                self.complete = True
+        return span
+
+    def span(self, i):
+        # The i-th span, from the cache when possible
+        with self._lock:
+            span = self._spans.get(i)
+            if span is not None:
+                self._spans.move_to_end(i)
+                return span
+            span = self._generate_span(i)
+            self._spans[i] = span
+            if len(self._spans) > self.cache_size:
+                self._spans.popitem(last=False)
+            return span
+
+    def _span_index(self, feet):
+        # Index of the span holding 'feet', finding anchors up to it
+        if not 0 <= feet <= self.total_feet:
+            raise ValueError(f"{feet / 5280:g} miles is outside the tunnel (0 to {self.total_feet / 5280:g} miles)")
+        while not self.complete and self._anchor_feet[-1] <= feet:
+            self.span(len(self.anchors) - 1)
+        return bisect.bisect_right(self._anchor_feet, feet) - 1
+
+    def build_anchors(self):
+        # Walks the rest of the tunnel once to find every anchor (spans found
+        # this way are not cached)
+        with self._lock:
+            while not self.complete:
+                self._generate_span(len(self.anchors) - 1)
+
+    def locate(self, miles):
+        # (section number, start feet, start elevation, section) at a distance;
+        # the very end of the tunnel belongs to the last section
+        feet = miles * 5280
+        i = self._span_index(feet)
+        span = self.span(i)
+        for found in span:
+            if feet < found[1] + found[3].len:
+                return found
+        return span[-1]
+
+    def section_at(self, miles):
+        number, _, _, s = self.locate(miles)
+        return number, s
+
+    def elevation_at(self, miles):
+        # Elevation relative to the tunnel start, spread evenly along each section
+        number, start, elev, s = self.locate(miles)
+        return elev + s.elev * (miles * 5280 - start) / s.len
+
+    def sections(self, start_miles=0, end_miles=None):
+        # Every section overlapping [start_miles, end_miles)
+        start = start_miles * 5280
+        end = self.total_feet if end_miles is None else end_miles * 5280
+        i = self._span_index(start)
+        while True:
+            for found in self.span(i):
+                if found[1] >= end:
+                    return
+                if found[1] + found[3].len > start:
+                    yield found
+            i += 1
+            if i >= len(self.anchors):
+                return
+
+    def save(self, path):
+        data = {
+            'version': LAZY_TUNNEL_VERSION, 'params': self.params, 'tables': self.tables.path,
+            'anchor_feet': self.anchor_feet, 'anchors': self.anchors, 'complete': self.complete,
+        }
+        save_snapshot(data, path)
+
+    @classmethod
+    def load(cls, path, tables=None, cache_size=64):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if not isinstance(data, dict) or data.get('version') != LAZY_TUNNEL_VERSION:
+            raise ValueError(f"{path} is not a lazy tunnel (or was written by another version)")
+        p = data['params']
+        tunnel = cls(p['length_miles'], p['tunnel_type'], p['min_height'], p['min_width'], p['seed'],
+                     tables if tables is not None else data['tables'], cache_size=cache_size, anchors=data['anchors'])
+        tunnel.anchor_feet = data['anchor_feet']
+        tunnel.complete = data['complete']
+        return tunnel
+
+# --- Profiling ---
+# Opt-in instrumentation for iter_sections. Given a Profiler, the loop runs
+# timed copies of its callables (the num_changes and attribute draws, every
+# getter and mutator, the special feature roll) and stamps the length,
+# elevation and merge steps of each raw section. Without one nothing is
+# wrapped and the loop only skips a few None checks.
+
+class Profiler:
+    # Call counts and cumulative seconds by name: phases ('num_changes',
+    # 'pick_attribute', 'special', 'length', 'elevation', 'merge', 'render'
+    # from generate_tunnel) and 'getter:<attr>' / 'mutator:<attr>'. Collects
+    # over every tunnel it is passed to; report() sums it up.
+    def __init__(self):
+        self.calls = {}
+        self.seconds = {}
+        self.sources = {}
+        self.generated = 0
+        self.emitted = 0
+        self.wall = 0.0
+        self.tunnels = 0
+
+    def add(self, name, seconds, calls=1):
+        self.calls[name] = self.calls.get(name, 0) + calls
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def wrap(self, name, fn):
+        perf = time.perf_counter
+        add = self.add
+        def timed(*args):
+            t0 = perf()
+            result = fn(*args)
+            add(name, perf() - t0)
+            return result
+        return timed
+
+    def instrument(self, config, tunnel_type):
+        # Timed copies of a config's callables:
+        # (attributes, draw_num_changes, draw_attr, special_gen)
+        type_spec = config['tables'].types[tunnel_type]
+        specs = {spec['name']: spec for spec in type_spec['attributes']}
+        attributes = {}
+        for name, attr in config['attributes'].items():
+            attr = dict(attr)
+            if name == 'special':
+                spec = type_spec['special']
+            else:
+                spec = specs[name]
+            self.sources[name] = spec.get('table') or spec.get('die_table') or spec.get('generator')
+            for role in ('getter', 'mutator'):
+                if role in attr:
+                    attr[role] = self.wrap(f'{role}:{name}', attr[role])
+            attributes[name] = attr
+        return (attributes, self.wrap('num_changes', config['num_change_sampler'].draw),
+                self.wrap('pick_attribute', config['change_sampler'].draw), self.wrap('special', config['special_gen']))
+
+    def section(self, t_length, t_elevation, t_merge):
+        # Length and elevation stamps of one raw section (merge is added as it
+        # ends, it may hand a section out in between)
+        self.generated += 1
+        self.add('length', t_elevation - t_length)
+        self.add('elevation', t_merge - t_elevation)
+
+    def _row(self, name):
+        calls, seconds = self.calls[name], self.seconds[name]
+        return {'calls': calls, 'seconds': seconds, 'us_per_call': seconds / calls * 1e6 if calls else None}
+
+    def report(self):
+        # Phases and getters, most expensive first; 'attributes' is the total
+        # of every getter and mutator, 'other' the wall time none of them cover
+        by_time = sorted(self.seconds, key=lambda name: -self.seconds[name])
+        phases = {name: self._row(name) for name in by_time if ':' not in name}
+        attributes = {}
+        for name in by_time:
+            if ':' in name:
+                role, attr = name.split(':', 1)
+                attributes.setdefault(attr, {'source': self.sources.get(attr)})[role] = self._row(name)
+        attr_calls = sum(c for name, c in self.calls.items() if ':' in name)
+        attr_seconds = sum(s for name, s in self.seconds.items() if ':' in name)
+        phases['attributes'] = {'calls': attr_calls, 'seconds': attr_seconds,
+                                'us_per_call': attr_seconds / attr_calls * 1e6 if attr_calls else None}
+        covered = sum(self.seconds.values())
         return {
-            'len_choices': len_choices,
-            'len_weights': [c['weight'] for c in len_choices],
-            'attributes': {
-                'size': {'getter': gen_wet_width, 'mutator': mutate_wet_width, 'weight_in_change': 4}, # 1-4 (4 slots)
-                'water_depth': {'getter': gen_water_depth, 'weight_in_change': 2}, # 5-6 (2 slots)
-                'ceiling_height': {'getter': gen_wet_ceiling, 'weight_in_change': 2}, # 7-8 (2 slots)
-                'flow': {'getter': gen_flow_rate, 'weight_in_change': 4}, # 9-12 (4 slots)
-                'dir': {'getter': make_picker(dir_choices), 'weight_in_change': 4}, # 13-16 (4 slots)
-                'temp': {'getter': gen_water_temp, 'weight_in_change': 1}, # 17 (1 slot)
-                'air': {'getter': make_picker(air_choices), 'weight_in_change': 1}, # 18 (1 slot)
-                'illum': {'getter': make_picker(wet_illum_choices), 'weight_in_change': 1}, # 19 (1 slot)
-                'special': {'weight_in_change': 1}, # 20 (1 slot)
-                
+            'tunnels': self.tunnels,
+            'wall_seconds': self.wall,
+            'other_seconds': max(self.wall - covered, 0.0) if self.wall else None,
+            'sections': {
+                'generated': self.generated,
+                'emitted': self.emitted,
+                'merge_ratio': self.generated / self.emitted if self.emitted else None,
             },
-            'special_gen': gen_wet_special_feature
+            'phases': phases,
+            'attributes': attributes,
         }
 
-def generate_tunnel(length_miles, tunnel_type='dry', min_height=0, min_width=0):
-    total_feet = length_miles * 5280
+    def write(self, path, meta=None):
+        report = self.report()
+        if meta:
+            report = {'meta': meta, **report}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+def iter_sections(length_miles, tunnel_type='dry', min_height=0, min_width=0, seed=None, rng=None, tables=None, checkpointer=None, resume=None, on_special=None, profiler=None):
+    # Streams finished sections one at a time. Only the section currently being
+    # merged into is held, so memory stays constant whatever the tunnel length.
+    # A section is yielded once the next raw section fails to merge into it.
+    # The same seed always gives the same tunnel; pass rng to drive it directly.
+    # tables is a TableSet or table file path (default: underdark_tables.json).
+    # checkpointer (a SnapshotHook such as a Checkpointer, a SectionIndexWriter
+    # or both in SnapshotHooks) snapshots the generator as it goes; resume
+    # (a snapshot) continues right after the sections it had handed out, with
+    # the same RNG stream, so the rest matches an uninterrupted run.
+    # on_special(feet, feature) is called for every special feature that ends
+    # up in a section, with the distance where its raw section starts.
+    # profiler (a Profiler) counts and times the steps of the loop.
+    if rng is None:
+        rng = make_rng(seed)
+    total_feet = miles_to_feet(length_miles)
     current_feet = 0
-    sections = []
-    total_elevation_change = 0
     
     # Load Configuration
-    config = get_config(tunnel_type, min_height, min_width)
+    config = get_config(tunnel_type, min_height, min_width, tables)
+    params = {
+        'length_miles': length_miles, 'tunnel_type': tunnel_type, 'min_height': min_height,
+        'min_width': min_width, 'seed': seed, 'tables': config['tables'].digest,
+    }
     attr_map = config['attributes']
-    len_choices = config['len_choices']
-    len_weights = config['len_weights']
     special_gen = config['special_gen']
     
     attr_keys = list(attr_map.keys())
     # Exclude 'special' from initial state generation loop as it's an event, not a persistent state usually?
     # In original code, 'special' was in the keys but used 'continue' in initialization loop.
 
-    attr_change_weights = [attr_map[k]['weight_in_change'] for k in attr_keys]
-    
-    # Change Logic defined in code (Frequency)
-    num_change_opts = [0, 1, 2, 3, 4, 5]
-    num_change_weights = [25, 25, 15, 15, 10, 5]
+    # Precompiled samplers (see _compile_config)
+    draw_num_changes = config['num_change_sampler'].draw
+    draw_attr = config['change_sampler'].draw
+    draw_len = config['len_sampler'].draw
+    prof = profiler
+    if prof is not None:
+        attr_map, draw_num_changes, draw_attr, special_gen = prof.instrument(config, tunnel_type)
+        perf = time.perf_counter
 
-    print(f"Generating {tunnel_type} tunnel of length {length_miles} miles ({total_feet:,.0f} feet)...")
+    # Initial State, one code per schema key
+    schema = SectionSchema(config)
+    new_section = schema.section
+    state_keys = schema.keys
+    state_pos = {k: i for i, k in enumerate(state_keys)}
+    tables = [schema.tables[k] for k in state_keys]
+    slope_pos = state_pos.get('slope')
+    flow_pos = state_pos.get('flow')
 
-    # Initial State
-    state = {}
-    for k in attr_keys:
-        if k == 'special': continue
-        state[k] = attr_map[k]['getter']()
-    
-    # Handle Slope Degree
-    if 'slope' in state:
-        min_deg, max_deg = state['slope']['range']
-        state['degree'] = random.randint(min_deg, max_deg)
+    # Last unmerged section, still open for merging
+    prev = None
+    # Sections handed out so far, for checkpoints
+    emitted = 0
+    emitted_feet = 0
+    emitted_elev = 0
+
+    if resume is None:
+        state = [tables[i].intern(attr_map[k]['getter'](rng)) for i, k in enumerate(state_keys)]
+
+        # Handle Slope Degree
+        degree = None
+        if schema.has_degree:
+            min_deg, max_deg = tables[slope_pos].values[state[slope_pos]]['range']
+            degree = rng.randint(min_deg, max_deg)
+
+        # Fingerprint of the current state, only touched when a roll changes it
+        key = schema.pack(state, degree)
+    else:
+        if resume['params'] != params:
+            raise ValueError(f"Checkpoint was taken with different settings: {resume['params']}")
+        rng.setstate(_unpack_rng_state(resume['rng']))
+        current_feet = resume['current_feet']
+        state = [tables[i].intern(v) for i, v in enumerate(resume['state'])]
+        degree = resume['degree']
+        key = schema.pack(state, degree)
+        if resume['prev'] is not None:
+            prev = new_section(resume['prev']['len'], resume['prev']['elev'], resume['prev']['special'], key)
+        emitted = resume['emitted']
+        emitted_feet = resume['emitted_feet']
+        emitted_elev = resume['emitted_elev']
+    if checkpointer is not None:
+        checkpointer.start(emitted)
 
     while current_feet < total_feet:
-        is_first = (len(sections) == 0)
+        if checkpointer is not None and checkpointer.due(emitted, emitted_feet):
+            state_values = [tables[i].values[code] for i, code in enumerate(state)]
+            checkpointer.save(_take_snapshot(params, current_feet, state_values, degree, prev, rng, emitted, emitted_feet, emitted_elev))
+
+        is_first = (prev is None)
         special_feature = None
 
         if not is_first:
             # Determine changes
-            num_changes = random.choices(num_change_opts, weights=num_change_weights, k=1)[0]
+            num_changes = draw_num_changes(rng)
             
             # Pick 'num_changes' unique attributes to change
             # We need to respect weights, so we can't just sample unique directly if we want weighted probability.
             # But standard way is loop N times. If we pick same one twice, does it count as 1 change or 2 (re-roll)?
-            # Original code used random.choices k=1 in a loop of num_changes. 
+            # Original code used random.choices k=1 in a loop of num_changes (now one sampler draw each).
             # It allowed picking same attribute multiple times (effectively just re-rolling it again).
             
             for _ in range(num_changes):
-                attr_to_change = random.choices(attr_keys, weights=attr_change_weights, k=1)[0]
+                attr_to_change = draw_attr(rng)
                 
                 if attr_to_change == 'special':
-                    special_feature = special_gen()
+                    special_feature = special_gen(rng)
                 else:
                     attr_config = attr_map[attr_to_change]
+                    pos = state_pos[attr_to_change]
                     
                     # Check for mutator (update based on previous value)
                     if 'mutator' in attr_config:
                         # Pass current state value
-                        new_val = attr_config['mutator'](state[attr_to_change])
+                        new_val = attr_config['mutator'](tables[pos].values[state[pos]], rng)
                     else:
                         # Standard re-roll
-                        new_val = attr_config['getter']()
+                        new_val = attr_config['getter'](rng)
                         
-                    state[attr_to_change] = new_val
+                    code = tables[pos].intern(new_val)
+                    if code != state[pos]:
+                        state[pos] = code
+                        key = schema.set_code(key, pos, code)
                     
                     # Update dependent data (Slope Degree)
                     if attr_to_change == 'slope':
                         min_d, max_d = new_val['range']
-                        state['degree'] = random.randint(min_d, max_d)
+                        new_degree = rng.randint(min_d, max_d)
+                        if new_degree != degree:
+                            degree = new_degree
+                            key = schema.set_degree(key, degree)
         
         # Length
-        selected_len_gen = random.choices(len_choices, weights=len_weights, k=1)[0]
-        section_len = selected_len_gen['gen']()
+        if prof is not None:
+            t_length = perf()
+        selected_len_gen = draw_len(rng)
+        section_len = selected_len_gen['gen'](rng)
         
         # Check total
         remaining = total_feet - current_feet
         if section_len > remaining:
-            section_len = int(remaining)
+            section_len = remaining
 
         # Elev Change
+        if prof is not None:
+            t_elevation = perf()
         elev_change = 0
-        if 'slope' in state:
-            effective_angle = state['degree']
-            if "Down" in state['slope']['name']:
-                effective_angle = -state['degree']
-            elev_change = section_len * math.sin(math.radians(effective_angle))
+        if degree is not None:
+            effective_angle = degree
+            if "Down" in tables[slope_pos].values[state[slope_pos]]['name']:
+                effective_angle = -degree
+            elev_change = section_len * SIN_BY_DEGREE[effective_angle]
             
         # Rate of Flow Drops
-        if 'flow' in state and state['flow']['drop_ft_per_mile'] > 0:
-            # Calculate portion of mile
-            miles = section_len / 5280.0
-            drop = miles * state['flow']['drop_ft_per_mile']
-            elev_change -= drop # It's a drop-off, so subtract
-            
-        total_elevation_change += elev_change
+        if flow_pos is not None:
+            drop_ft_per_mile = tables[flow_pos].values[state[flow_pos]]['drop_ft_per_mile']
+            if drop_ft_per_mile > 0:
+                # Calculate portion of mile
+                miles = section_len / 5280.0
+                drop = miles * drop_ft_per_mile
+                elev_change -= drop # It's a drop-off, so subtract
         
         # Apply Special Feature Elevation Change
         if special_feature and special_feature.get('elev_change'):
-             elev = special_feature['elev_change']
-             elev_change += elev
-             total_elevation_change += elev
-
-        # Prepare New Section Object
-        new_section = {
-            'len': section_len,
-            'elev': elev_change,
-            'special': special_feature['desc'] if special_feature else None
-        }
-        # Copy current state attributes
-        for k in state:
-            new_section[k] = state[k]
-
-        # Check for merge
-        merged = False
-        if len(sections) > 0:
-            prev = sections[-1]
-            
-            # Detect if attributes match
-            # We compare all keys in 'state' plus 'special'
-            match = True
-            if prev['special'] != new_section['special']:
-                match = False
-            else:
-                for k in state:
-                    if prev.get(k) != new_section[k]:
-                        match = False
-                        break
-            
-            if match:
-                prev['len'] += new_section['len']
-                prev['elev'] += new_section['elev']
-                merged = True
-        
-        if not merged:
-            sections.append(new_section)
+             elev_change += special_feature['elev_change']
+
+        special = special_feature['desc'] if special_feature else None
+        if special_feature and on_special is not None:
+            on_special(current_feet, special_feature)
+
+        # Check for merge: same fingerprint and special
+        if prof is not None:
+            t_merge = perf()
+            prof.section(t_length, t_elevation, t_merge)
+        if prev is not None and prev.key == key and prev.special == special:
+            prev.len += section_len
+            prev.elev += elev_change
+        else:
+            # The open section can no longer grow, hand it out
+            if prev is not None:
+                emitted += 1
+                emitted_feet += prev.len
+                emitted_elev += prev.elev
+                if prof is not None:
+                    # The consumer's time at the yield is not ours
+                    prof.add('merge', perf() - t_merge, 0)
+                    prof.emitted += 1
+                yield prev
+                if prof is not None:
+                    t_merge = perf()
+            prev = new_section(section_len, elev_change, special, key)
         
         current_feet += section_len
+        if prof is not None:
+            prof.add('merge', perf() - t_merge)
 
-    print(f"\nTunnel Generation Complete.")
-    print(f"Total Sections: {len(sections)}")
-    print(f"Actual Total Length: {current_feet:,.0f} feet")
-    print(f"Total Elevation Change: {total_elevation_change:+.1f} feet")
-    print(f"\n--- Section Breakdown ---")
-    
-    for i, s in enumerate(sections):
-        special_txt = f" [Special: {s['special']}]" if s['special'] else ""
-        
-        # Format Size
-        # If Wet, calculate total height from water + ceiling
-        h = s['size']['h']
-        if 'water_depth' in s and 'ceiling_height' in s:
-            h = s['water_depth']['depth_ft'] + s['ceiling_height']['height_ft']
-            
-        dim_str = s['size']['dim']
-        if 'water_depth' in s and 'ceiling_height' in s:
-            dim_str = f"{h}'x{s['size']['w']}'"
+    if prev is not None:
+        if prof is not None:
+            prof.emitted += 1
+        yield prev
 
-        size_str = f"{s['size']['name']} ({dim_str})"
-        
-        # Format Slope
-        slope_str = ""
-        if 'slope' in s:
-            slope_str = f", {s['slope']['name']} ({s['degree']} deg)"
-        
-        # Optional Water Depth / Ceiling
-        extra_str = ""
-        if 'water_depth' in s:
-            extra_str += f", Water: {s['water_depth']['name']}"
-        if 'ceiling_height' in s:
-            extra_str += f", Ceiling: {s['ceiling_height']['name']}"
-        if 'flow' in s:
-            extra_str += f", Flow: {s['flow']['name']} ({s['flow']['speed']})" 
-            if s['flow']['drop_ft_per_mile'] > 0:
-                 extra_str += f" [-{s['flow']['drop_ft_per_mile']}'/mi]"
-        if 'temp' in s:
-            extra_str += f", Temp: {s['temp']}"
-
-        # Adjust comma logic for slope
-        main_desc = f"{size_str}"
-        if slope_str: main_desc += f"{slope_str}"
-        
-        # Format Texture/Condition (Conditional)
-        tex_str = f", {s['tex']['name']}" if 'tex' in s else ""
-        cond_str = f", {s['cond']['name']}" if 'cond' in s else ""
+# --- Rendering ---
+# A section line is built from fragments (", Curving right", ", Air: Stale").
+# Each fragment depends on a few attributes and is cached by their value
+# codes, so rendering a section joins cached strings and only formats the
+# numbers that change every section. Renderers collect lines and hand them to
+# the output in blocks, one write call per block.
 
-        print(f"Section {i+1}: {s['len']} feet, {main_desc}, {s['dir']['name']}{tex_str}{cond_str}{extra_str}, Light: {s['illum']['name']}, Air: {s['air']['name']} [Elev: {s['elev']:+.1f} ft]{special_txt}")
+def _size_fragment(size, water_depth, ceiling_height):
+    # If Wet, calculate total height from water + ceiling
+    dim_str = size['dim']
+    if water_depth is not None and ceiling_height is not None:
+        dim_str = f"{water_depth['depth_ft'] + ceiling_height['height_ft']}'x{size['w']}'"
+    return f", {size['name']} ({dim_str})"
 
- 
+def _flow_fragment(flow):
+    text = f", Flow: {flow['name']} ({flow['speed']})"
+    if flow['drop_ft_per_mile'] > 0:
+        text += f" [-{flow['drop_ft_per_mile']}'/mi]"
+    return text
 
-def gen_dry_special_feature():
-    # Wrapper for legacy/dry logic returning dict
-    desc = gen_special_feature_text_dry()
-    if desc:
-        return {'desc': desc, 'elev_change': 0}
-    return None
+# (attributes, fragment) in line order. A fragment is left out when its first
+# attribute is not part of the tunnel; later ones are passed as None if missing.
+TEXT_FRAGMENTS = [
+    (('size', 'water_depth', 'ceiling_height'), _size_fragment),
+    (('slope', 'degree'), lambda slope, degree: f", {slope['name']} ({degree} deg)"),
+    (('dir',), lambda d: f", {d['name']}"),
+    (('tex',), lambda tex: f", {tex['name']}"),
+    (('cond',), lambda cond: f", {cond['name']}"),
+    (('water_depth',), lambda depth: f", Water: {depth['name']}"),
+    (('ceiling_height',), lambda ceiling: f", Ceiling: {ceiling['name']}"),
+    (('flow',), _flow_fragment),
+    (('temp',), lambda temp: f", Temp: {temp}"),
+    (('illum',), lambda illum: f", Light: {illum['name']}"),
+    (('air',), lambda air: f", Air: {air['name']}"),
+]
 
-def gen_special_feature_text_dry():
-    # Original 'gen_special_feature' code logic
-    choices = [
-        {'name': "None", 'weight': 30},
-        {'name': "Side ledges or tiers", 'weight': 5},
-        {'name': "Minor side rooms", 'weight': 7},
-        {'name': "Stairs (natural or man-made)", 'weight': 3},
-        {'name': "Side tunnels", 'weight': 7},
-        {'name': "Pits", 'weight': 5},
-        {'name': "Chasms", 'weight': 6},
-        {'name': "Cliffs", 'weight': 3},
-        {'name': "Geothermal activity", 'weight': 5},
-        {'name': "Blockages", 'weight': 9},
-        {'name': "Habitation signs", 'weight': 10},
-        {'name': "Minor mineral vein", 'weight': 3},
-        {'name': "DM's choice!", 'weight': 2},
-    ]
-    weights = [c['weight'] for c in choices]
-    
-    selected = random.choices(choices, weights=weights, k=1)[0]['name']
-    
-    if selected == "None": return None
-        
-    if selected == "Minor side rooms":
-        width = random.randint(3, 60)
-        length = roll(10, 20) * 10
-        return f"Minor side room ({width}' wide x {length}' long)"
-        
-    if selected == "Side tunnels":
-        miles = random.randint(1, 6)
-        is_stream = (random.randint(1, 100) <= 20)
-        stream_txt = " (small underground stream)" if is_stream else ""
-        return f"Side tunnel (dead-ends in {miles} miles, 5'x5' or less){stream_txt}"
-        
-    if selected == "Pits":
-        depth = roll(3, 6)
-        return f"Pit ({depth}' deep)"
-        
-    if selected == "Chasms":
-        depth = random.randint(20, 200)
-        width = random.randint(4, 40)
-        return f"Chasm ({depth}' deep x {width}' wide)"
-        
-    if selected == "Cliffs":
-        height = random.randint(10, 100)
-        return f"Cliff ({height}' high)"
-        
-    if selected == "Geothermal activity":
-        geo_choices = [
-            {'name': "Hot or boiling pool of water", 'weight': 40},
-            {'name': "Poisonous/noxious gas vent",   'weight': 10},
-            {'name': "Steam Vent",                   'weight': 15},
-            {'name': "Hot air",                      'weight': 25},
-            {'name': "Lava pool",                    'weight': 5},
-        ]
-        geo_w = [c['weight'] for c in geo_choices]
-        geo_type = random.choices(geo_choices, weights=geo_w, k=1)[0]['name']
-        return f"Geothermal: {geo_type}"
-
-    if selected == "Blockages":
-        block_choices = [
-            {'name': "Large boulder field",                     'weight': 15},
-            {'name': "Minor cave-in",                           'weight': 15},
-            {'name': "Water pool",                              'weight': 15},
-            {'name': "Quicksand",                               'weight': 5},
-            {'name': "Oil pool",                                'weight': 5},
-            {'name': "Tar pit",                                 'weight': 5},
-            {'name': "Large stalactites, stalagmites, or columns", 'weight': 25},
-            {'name': "Balconies",                               'weight': 5},
-            {'name': "Water way",                               'weight': 5},
-            {'name': "DM's choice!",                            'weight': 5},
-        ]
-        block_w = [c['weight'] for c in block_choices]
-        block_type = random.choices(block_choices, weights=block_w, k=1)[0]['name']
-        
-        if block_type == "Water way":
-            width = random.randint(5, 30)
-            depth = random.randint(3, 15)
-            return f"Blockage: Water way ({width}' wide x {depth}' deep)"
-            
-        return f"Blockage: {block_type}"
-    
-    if selected == "Habitation signs":
-        hab_choices = [
-            {'name': "Cairn marking territory",           'weight': 5},
-            {'name': "Ruined building",                   'weight': 1},
-            {'name': "Old campsite",                      'weight': 5},
-            {'name': "Small abandoned shrine",            'weight': 1},
-            {'name': "Dead bodies",                       'weight': 2},
-            {'name': "Shallow grave",                     'weight': 2},
-            {'name': "Burial mound",                      'weight': 2},
-            {'name': "Secret stash",                      'weight': 2},
-            {'name': "Broken tools, weapons, or armor",   'weight': 13},
-            {'name': "Intact tools, weapons, or armor",   'weight': 2},
-            {'name': "Battlefield",                       'weight': 3},
-            {'name': "Worked stone surfaces",             'weight': 20},
-            {'name': "Abandoned adventurers gear",        'weight': 7},
-            {'name': "Intact bridge",                     'weight': 18},
-            {'name': "Ruined bridge",                     'weight': 10},
-        ]
-        hab_w = [c['weight'] for c in hab_choices]
-        hab_type = random.choices(hab_choices, weights=hab_w, k=1)[0]['name']
-        return f"Habitation: {hab_type}"
-
-    return selected 
-
-def gen_wet_special_feature():
-    # 01-25 None
-    # 26-31 Sandy Beaches
-    # 32-40 Side ledges or tiers allowing landings
-    # 41-46 Side rooms that are 90% likely to be dry (3-60' wide by 10d20x10' long)
+def format_section(index, s):
+    # One text line for a section (a Section or an old style section dict)
+    parts = [f"Section {index}: {s['len']} feet"]
+    for names, fragment in TEXT_FRAGMENTS:
+        if names[0] in s:
+            parts.append(fragment(*(s.get(name) for name in names)))
+    parts.append(f" [Elev: {s['elev']:+.1f} ft]")
+    if s['special']:
+        parts.append(f" [Special: {s['special']}]")
+    return ''.join(parts)
+
+def _csv_field(text):
+    if any(c in text for c in ',"\r\n'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+class SectionRenderer:
+    # Base renderer: buffers rendered lines and caches fragments per schema.
+    # Subclasses set up self._parts in bind() and implement render().
+    def __init__(self, out=None, block=4096, header=True):
+        self.out = out if out is not None else sys.stdout
+        self.block = block
+        self.header = header
+        self._lines = []
+        self._schema = None
+
+    def _fragment_cache(self, schema, names, fragment):
+        # Returns (mask, cache, build): the bits of a section key that
+        # 'fragment' depends on, the cache and a builder for a missed key
+        mask = 0
+        for name in names:
+            if name == 'degree':
+                mask |= CODE_MASK << schema.degree_shift
+            elif name in schema.shifts:
+                mask |= CODE_MASK << schema.shifts[name]
+
+        def build(key):
+            args = []
+            for name in names:
+                if name == 'degree':
+                    args.append((key >> schema.degree_shift) - DEGREE_OFFSET)
+                elif name in schema.shifts:
+                    args.append(schema.value(key, name))
+                else:
+                    args.append(None)
+            return fragment(*args)
+        return mask, {}, build
+
+    def bind(self, schema):
+        self._schema = schema
+
+    def write_text(self, text):
+        # Raw text (headers, totals) kept in order with the buffered lines
+        self._lines.append(text)
+
+    def write(self, index, s):
+        if s.schema is not self._schema:
+            self.bind(s.schema)
+        self._lines.append(self.render(index, s))
+        if len(self._lines) >= self.block:
+            self.flush()
+
+    def _fragments(self, key):
+        parts = []
+        for mask, cache, build in self._parts:
+            k = key & mask
+            text = cache.get(k)
+            if text is None:
+                text = cache[k] = build(k)
+            parts.append(text)
+        return ''.join(parts)
+
+    def flush(self):
+        if self._lines:
+            self.out.write(''.join(self._lines))
+            self._lines = []
+
+class TextRenderer(SectionRenderer):
+    # The format_section lines
+    def bind(self, schema):
+        super().bind(schema)
+        present = set(schema.keys) | ({'degree'} if schema.has_degree else set())
+        self._parts = [self._fragment_cache(schema, names, fragment) for names, fragment in TEXT_FRAGMENTS if names[0] in present]
+
+    def render(self, index, s):
+        special = f" [Special: {s.special}]\n" if s.special else "\n"
+        return f"Section {index}: {s.len} feet{self._fragments(s.key)} [Elev: {s.elev:+.1f} ft]{special}"
+
+class JsonLinesRenderer(SectionRenderer):
+    # One JSON object per section with the --export columns (attribute labels)
+    def bind(self, schema):
+        super().bind(schema)
+        self._parts = [self._fragment_cache(schema, (name,), lambda v, name=name: f', "{name}": {json.dumps(value_label(v))}') for name in schema.keys]
+
+    def render(self, index, s):
+        degree = f', "degree": {s.degree}' if self._schema.has_degree else ''
+        special = json.dumps(s.special) if s.special is not None else 'null'
+        return f'{{"section": {index}, "len": {s.len}, "elev": {s.elev!r}{self._fragments(s.key)}{degree}, "width": {s.width}, "special": {special}}}\n'
+
+class CsvRenderer(SectionRenderer):
+    # Comma separated values with a header row, same columns as JSON Lines
+    def bind(self, schema):
+        super().bind(schema)
+        columns = ['section', 'len', 'elev'] + schema.keys + (['degree'] if schema.has_degree else []) + ['width', 'special']
+        if self.header:
+            self.write_text(','.join(columns) + '\n')
+        self._parts = [self._fragment_cache(schema, (name,), lambda v: ',' + _csv_field(value_label(v))) for name in schema.keys]
+
+    def render(self, index, s):
+        degree = f',{s.degree}' if self._schema.has_degree else ''
+        special = _csv_field(s.special) if s.special is not None else ''
+        return f'{index},{s.len},{s.elev!r}{self._fragments(s.key)}{degree},{s.width},{special}\n'
+
+RENDERERS = {
+    'text': TextRenderer,
+    'jsonl': JsonLinesRenderer,
+    'csv': CsvRenderer,
+}
+
+def generate_tunnel(length_miles, tunnel_type='dry', min_height=0, min_width=0, engine='python', seed=None, out=None, tables=None, fmt='text', checkpointer=None, resume=None, index=None, on_special=None, profiler=None):
+    # Printing consumer for iter_sections. Sections are printed as they are
+    # produced, so the totals come after the breakdown instead of before it.
+    # out defaults to stdout. fmt is a RENDERERS key; only text output gets
+    # the header and totals, jsonl and csv hold nothing but sections.
+    # checkpointer/resume are passed to iter_sections (python engine only);
+    # the checkpointer records the offset of out, and a resumed run writes
+    # neither the header nor the sections before the snapshot again. index
+    # (a SectionIndexWriter) records the sparse index of the output.
+    # on_special goes to the engine as is. profiler (a Profiler, python engine
+    # only) also gets the rendering time and the wall time. Returns the
+    # totals: {'sections', 'feet', 'elev'}.
+    start_time = time.perf_counter()
+    hooks = [h for h in (checkpointer, index) if h is not None]
+    if (hooks or resume is not None) and engine != 'python':
+        raise ValueError("Checkpoints and indexes are only supported by the python engine")
+    if profiler is not None and engine != 'python':
+        raise ValueError("Profiling is only supported by the python engine")
+    renderer = RENDERERS[fmt](out, header=resume is None)
+    write = renderer.write
+    text = fmt == 'text'
+    total_feet = miles_to_feet(length_miles)
+    if text and resume is None:
+        renderer.write_text(f"Generating {tunnel_type} tunnel of length {length_miles} miles ({total_feet:,.0f} feet)...\n")
+        if seed is not None:
+            renderer.write_text(f"Seed: {seed}\n")
+        renderer.write_text(f"\n--- Section Breakdown ---\n")
+
+    num_sections = 0
+    actual_feet = 0
+    total_elevation_change = 0
+    section_iter = ENGINES[engine]
+    kwargs = {}
+    if on_special is not None:
+        kwargs['on_special'] = on_special
+    if profiler is not None:
+        kwargs['profiler'] = profiler
+        write = profiler.wrap('render', write)
+    for hook in hooks:
+        hook.out = renderer.out
+        hook.before_save = renderer.flush
+    if hooks:
+        kwargs['checkpointer'] = hooks[0] if len(hooks) == 1 else SnapshotHooks(*hooks)
+    if resume is not None:
+        num_sections = resume['emitted']
+        actual_feet = resume['emitted_feet']
+        total_elevation_change = resume['emitted_elev']
+        kwargs['resume'] = resume
+    for s in section_iter(length_miles, tunnel_type, min_height, min_width, seed=seed, tables=tables, **kwargs):
+        num_sections += 1
+        actual_feet += s.len
+        total_elevation_change += s.elev
+        write(num_sections, s)
+
+    if text:
+        renderer.write_text(f"\nTunnel Generation Complete.\n")
+        renderer.write_text(f"Total Sections: {num_sections}\n")
+        renderer.write_text(f"Actual Total Length: {actual_feet:,.0f} feet\n")
+        renderer.write_text(f"Total Elevation Change: {total_elevation_change:+.1f} feet\n")
+    renderer.flush()
+    for hook in hooks:
+        hook.finish()
+    if profiler is not None:
+        profiler.wall += time.perf_counter() - start_time
+        profiler.tunnels += 1
+    return {'sections': num_sections, 'feet': actual_feet, 'elev': total_elevation_change}
+
+def gen_special_feature(rng=random, tables=None, table_name='dry_special'):
+    # Special feature from a weighted or die table: {'desc', 'elev_change'} or
+    # None, plus 'branch' ({'type', 'miles', 'through'}) for features that lead
+    # into another tunnel. 'miles' is a value spec when the entry does not roll
+    # it, left for whoever generates the branch to roll with its own rng.
+    tables = resolve_tables(tables)
+    return special_feature(tables.roll_on(table_name, rng), rng, tables)
+
+def special_feature(entry, rng=random, tables=None):
+    # The special feature of one rolled entry, see gen_special_feature
+    return _special_feature(entry, *resolve_entry(entry, rng, resolve_tables(tables)))
+
+def _special_feature(entry, desc, values):
+    if desc is None:
+        return None
+    elev_change = -values[entry['elev_drop']] if 'elev_drop' in entry else 0
+    feature = {'desc': desc, 'elev_change': elev_change}
+    if 'branch' in entry:
+        branch = entry['branch']
+        branch_type = branch['type']
+        if isinstance(branch_type, dict):
+            branch_type = branch_type['map'][values[branch_type['value']]]
+        miles = branch['miles']
+        feature['branch'] = {
+            'type': branch_type,
+            'miles': values[miles] if isinstance(miles, str) else miles,
+            'through': bool(branch.get('through')),
+        }
+    return feature
+
+class SpecialFeatures:
+    # gen_special_feature in bulk for one table. Entries and their values
+    # (sub-tables too) are rolled as columns with a numpy Generator; entries
+    # that cannot be are resolved row by row with rng. Equal rolls of an entry
+    # give the same feature dict, so never mutate one.
+    def __init__(self, table_name, tables=None):
+        self.tables = resolve_tables(tables)
+        self.table_name = table_name
+        self.entries = self.tables.entries_of(table_name)
+        self.seen = [{} for _ in self.entries]
+
+    def roll_many(self, count, gen, rng=random):
+        # A feature (or None) per row
+        entry_pos = self.tables.roll_many_on(self.table_name, count, gen)
+        features = [None] * count
+        for i, entry in enumerate(self.entries):
+            rows = np.flatnonzero(entry_pos == i).tolist()
+            if not rows or entry.get('none'):
+                continue
+            rolled = entry_values_many(entry, len(rows), gen, rng, self.tables)
+            if rolled is None:
+                for r in rows:
+                    features[r] = special_feature(entry, rng, self.tables)
+                continue
+            seen = self.seen[i]
+            names, rolled_rows = _rolled_rows(rolled, len(rows))
+            for r, row in zip(rows, rolled_rows):
+                feature = seen.get(row)
+                if feature is None:
+                    feature = seen[row] = _special_feature(entry, *resolve_entry_from(entry, dict(zip(names, row))))
+                features[r] = feature
+        return features
+
+def gen_dry_special_feature(rng=random, tables=None):
+    # Wrapper for legacy/dry logic returning dict
+    return gen_special_feature(rng, tables, 'dry_special')
+
+def gen_special_feature_text_dry(rng=random, tables=None):
+    # Original 'gen_special_feature' code logic, text only
+    feature = gen_special_feature(rng, tables, 'dry_special')
+    return feature['desc'] if feature else None
+
+def gen_wet_special_feature(rng=random, tables=None):
+    # 01-25 None
+    # 26-31 Sandy Beaches
+    # 32-40 Side ledges or tiers allowing landings
+    # 41-46 Side rooms that are 90% likely to be dry (3-60' wide by 10d20x10' long)
     # 47-55 Side tunnels that dead-end in 1-6 miles that are 40% likely to be dry
     # 56-63 Obstacles/Blockages
     # 64-66 Rapids (in addition to any drop offs from rate of flow)
@@ -660,104 +2263,2155 @@ def gen_wet_special_feature():
     # 84-97 Habitation signs
     # 98-00 DM's Choice
     # GAPS: 67-68, 79-83 mapped to None
-    
-    r = random.randint(1, 100)
-    
-    if 1 <= r <= 25: return None
-    if 26 <= r <= 31: return {'desc': "Sandy Beaches", 'elev_change': 0}
-    if 32 <= r <= 40: return {'desc': "Side ledges or tiers allowing landings", 'elev_change': 0}
-    
-    if 41 <= r <= 46:
-        is_dry = (random.randint(1, 100) <= 90)
-        width = random.randint(3, 60)
-        length = roll(10, 20) * 10
-        cond = "Dry" if is_dry else "Wet"
-        return {'desc': f"Side room ({cond}, {width}' wide x {length}' long)", 'elev_change': 0}
-        
-    if 47 <= r <= 55:
-        is_dry = (random.randint(1, 100) <= 40)
-        miles = random.randint(1, 6)
-        cond = "Dry" if is_dry else "Wet"
-        return {'desc': f"Side tunnel ({cond}, dead-ends in {miles} miles)", 'elev_change': 0}
-        
-    if 56 <= r <= 63:
-        # Obstacles (Blockages d20)
-        # 1-3 Large boulder field
-        # 4-6 Minor Cave-in
-        # 7-9 small whirlpool
-        # 10-11 oil seepage forms scum on water
-        # 12-18 Large stalactites, stlagmites, or columns
-        # 19-20 DM's Choice
-        b_roll = random.randint(1, 20)
-        b_desc = "DM's Choice"
-        if b_roll <= 3: b_desc = "Large boulder field"
-        elif b_roll <= 6: b_desc = "Minor Cave-in"
-        elif b_roll <= 9: b_desc = "Small whirlpool"
-        elif b_roll <= 11: b_desc = "Oil seepage/scum on water"
-        elif b_roll <= 18: b_desc = "Large stalactites, stalagmites, or columns"
-        return {'desc': f"Blockage: {b_desc}", 'elev_change': 0}
-        
-    if 64 <= r <= 66:
-        # Rapids
-        drop = random.randint(5, 10) # Assumed extra drop
-        return {'desc': "Rapids", 'elev_change': -drop}
-        
-    if 67 <= r <= 68: return None
-    
-    if r == 69:
-        # Minor waterfalls (1-4) of 1-10' each
-        count = random.randint(1, 4)
-        total_drop = sum(random.randint(1, 10) for _ in range(count))
-        return {'desc': f"Minor waterfalls ({count} drops, total {total_drop}')", 'elev_change': -total_drop}
-        
-    if r == 70: return {'desc': "Large waves (earthquake/cave-in)", 'elev_change': 0}
-    if 71 <= r <= 75: return {'desc': "Minor mineral vein", 'elev_change': 0}
-    if r == 76: return {'desc': "Junction with large underground river/exit/entrance", 'elev_change': 0}
-    
-    if 77 <= r <= 78:
-        # Geothermal (d20)
-        # 1-8 hot or boiling water
-        # 9-10 poisonous/noxious gas
-        # 11-14 Steam vent
-        # 15-20 Hot Air
-        g_roll = random.randint(1, 20)
-        g_desc = "Hot Air"
-        if g_roll <= 8: g_desc = "Hot or boiling water"
-        elif g_roll <= 10: g_desc = "Poisonous/noxious gas"
-        elif g_roll <= 14: g_desc = "Steam vent"
-        return {'desc': f"Geothermal: {g_desc}", 'elev_change': 0}
-        
-    if 79 <= r <= 83: return None
-    
-    if 84 <= r <= 97:
-        # Habitation (d100)
-        h_roll = random.randint(1, 100)
-        h_desc = "DM's Choice"
-        if h_roll <= 10: h_desc = "Cairn marking territory"
-        elif h_roll <= 13: h_desc = "Ruined building"
-        elif h_roll <= 25: h_desc = "Old campsite"
-        elif h_roll <= 29: h_desc = "Small abandoned shrine"
-        elif h_roll <= 34: h_desc = "Dead bodies"
-        elif h_roll <= 36: h_desc = "Shallow grave on land"
-        elif h_roll == 37: h_desc = "Secret stash"
-        elif h_roll == 38: h_desc = "Dam"
-        elif h_roll <= 41: h_desc = "Canal"
-        elif h_roll <= 59: h_desc = "Flotsam/jetsam"
-        elif h_roll <= 63: h_desc = "Intact tools, weapons, armor"
-        elif h_roll <= 74: h_desc = "Worked stone surfaces"
-        elif h_roll <= 80: h_desc = "Abandoned adventurers gear"
-        return {'desc': f"Habitation: {h_desc}", 'elev_change': 0}
-        
-    # 98-00
-    return {'desc': "DM's Choice!", 'elev_change': 0}
+    return gen_special_feature(rng, tables, 'wet_special')
+
+# --- NumPy Batch Engine ---
+
+def _carry_forward(changed, new_codes, carry_code):
+    # Per step code: the latest change at or before the step, else the carry-in
+    n = len(changed)
+    pos = np.where(changed, np.arange(n), -1)
+    last = np.maximum.accumulate(pos)
+    return np.where(last >= 0, new_codes[np.maximum(last, 0)], carry_code)
+
+def _mean_section_len(len_choices):
+    total_w = sum(c['weight'] for c in len_choices)
+    return sum(c['weight'] * ((c['dice'][0] * (c['dice'][1] + 1) / 2) * c['mult'] + c['add']) for c in len_choices) / total_w
+
+class SectionChunk:
+    # A run of finished sections as columns, one row per section: len (int64),
+    # elev (float64), degree (int64, None without a slope), special (codes
+    # into specials, whose code 0 is None) and codes[k], the schema's value
+    # codes for each state key. Consumers that aggregate or write columns
+    # take these instead of Section records; sections() decodes them.
+    __slots__ = ('schema', 'len', 'elev', 'degree', 'special', 'codes', 'specials')
+
+    def __init__(self, schema, length, elev, degree, special, codes, specials):
+        self.schema = schema
+        self.len = length
+        self.elev = elev
+        self.degree = degree
+        self.special = special
+        self.codes = codes
+        self.specials = specials
+
+    def __len__(self):
+        return len(self.len)
+
+    def __getitem__(self, item):
+        # Rows by slice (views, not copies)
+        return SectionChunk(self.schema, self.len[item], self.elev[item], None if self.degree is None else self.degree[item],
+                            self.special[item], {k: v[item] for k, v in self.codes.items()}, self.specials)
+
+    def join(self, other):
+        # This chunk's rows followed by other's
+        def cat(a, b):
+            return np.concatenate((a, b))
+        return SectionChunk(self.schema, cat(self.len, other.len), cat(self.elev, other.elev),
+                            None if self.degree is None else cat(self.degree, other.degree), cat(self.special, other.special),
+                            {k: cat(v, other.codes[k]) for k, v in self.codes.items()}, self.specials)
+
+    def width(self):
+        # Width column, from the size codes
+        widths = np.array([v['w'] for v in self.schema.tables['size'].values], dtype=np.int64)
+        return widths[self.codes['size']]
+
+    def sections(self):
+        schema = self.schema
+        new_section = schema.section
+        pack = schema.pack
+        specials = self.specials
+        degrees = self.degree.tolist() if self.degree is not None else [None] * len(self)
+        rows = zip(*[self.codes[k].tolist() for k in schema.keys])
+        for length, elev, special, degree, row in zip(self.len.tolist(), self.elev.tolist(), self.special.tolist(), degrees, rows):
+            yield new_section(length, elev, specials[special], pack(row, degree))
+
+def chunk_sections(sections, chunk_size=65536):
+    # SectionChunks from a Section stream (any engine), chunk_size rows each
+    if np is None:
+        raise ImportError("chunk_sections requires numpy (pip install numpy)")
+    sections = iter(sections)
+    first = next(sections, None)
+    if first is None:
+        return
+    schema = first.schema
+    shifts = [schema.shifts[k] for k in schema.keys]
+    specials = ValueTable([None])
+    rest = _chain_first(first, sections)
+    while True:
+        rows = list(islice(rest, chunk_size))
+        if not rows:
+            return
+        codes = np.array([[(s.key >> shift) & CODE_MASK for shift in shifts] for s in rows], dtype=np.int64).reshape(len(rows), len(shifts))
+        yield SectionChunk(schema, np.array([s.len for s in rows], dtype=np.int64), np.array([s.elev for s in rows], dtype=np.float64),
+                           np.array([s.degree for s in rows], dtype=np.int64) if schema.has_degree else None,
+                           np.array([specials.intern(s.special) for s in rows], dtype=np.int64),
+                           {k: codes[:, i] for i, k in enumerate(schema.keys)}, specials.values)
+
+def iter_chunks(length_miles, tunnel_type='dry', min_height=0, min_width=0, engine='python', seed=None, tables=None, chunk_size=65536):
+    # A tunnel as SectionChunks: drawn as columns by the numpy engine, grouped
+    # from the section stream by the others
+    if engine == 'numpy':
+        return iter_chunks_numpy(length_miles, tunnel_type, min_height, min_width, seed=seed, chunk_size=chunk_size, tables=tables)
+    return chunk_sections(ENGINES[engine](length_miles, tunnel_type, min_height, min_width, seed=seed, tables=tables), chunk_size)
+
+def iter_sections_numpy(length_miles, tunnel_type='dry', min_height=0, min_width=0, seed=None, rng=None, chunk_size=65536, tables=None, on_special=None):
+    # The numpy engine as a Section stream, decoded from iter_chunks_numpy
+    for chunk in iter_chunks_numpy(length_miles, tunnel_type, min_height, min_width, seed, rng, chunk_size, tables, on_special):
+        yield from chunk.sections()
+
+def iter_chunks_numpy(length_miles, tunnel_type='dry', min_height=0, min_width=0, seed=None, rng=None, chunk_size=65536, tables=None, on_special=None):
+    # Same state machine as iter_sections, drawn in bulk with a numpy Generator.
+    # Change counts, changed attributes, table picks, slope degrees and section
+    # lengths are drawn per chunk of raw sections, values are carried forward
+    # with maximum.accumulate and merges are found by comparing neighbouring
+    # rows. Die table values and special features are rolled in bulk too
+    # (DieValueCodes, SpecialFeatures), as are mutators with a bulk
+    # version in BULK_MUTATORS. Custom getters, other mutators and sub-table
+    # entries stay scalar but are only called for the rows where they fire,
+    # using rng. A seeded run gets a numpy stream derived from the same seed.
+    # The finished sections come out
+    # as SectionChunks, up to one per chunk of raw sections; the last section
+    # of a chunk is held back until the next one can no longer extend it.
+    if np is None:
+        raise ImportError("The numpy engine requires numpy (pip install numpy)")
+
+    if rng is None:
+        rng = make_rng(seed)
+    gen = np.random.default_rng(derive_seed(seed, 'numpy') if seed is not None else None)
+    total_feet = miles_to_feet(length_miles)
+    current_feet = 0
+
+    config = get_config(tunnel_type, min_height, min_width, tables)
+    table_set = config['tables']
+    attr_map = config['attributes']
+    special_spec = table_set.types[tunnel_type]['special']
+    special_features = SpecialFeatures(special_spec.get('table', special_spec.get('die_table')), table_set)
+    attr_keys = list(attr_map.keys())
+    state_keys = [k for k in attr_keys if k != 'special']
+    len_choices = config['len_choices']
+    mean_len = _mean_section_len(len_choices)
+
+    # Interned values per attribute; table attributes get code == table index
+    schema = SectionSchema(config)
+    tables = schema.tables
+    special_table = ValueTable([None])
+    die_values = {k: DieValueCodes(attr_map[k]['die_table'], tables[k], table_set)
+                  for k in state_keys if 'die_table' in attr_map[k]}
+
+    # Slope lookups by slope code
+    if 'slope' in attr_map:
+        slope_choices = attr_map['slope']['choices']
+        slope_lo = np.array([c['range'][0] for c in slope_choices])
+        slope_hi = np.array([c['range'][1] for c in slope_choices])
+        slope_sign = np.array([-1 if "Down" in c['name'] else 1 for c in slope_choices])
+        # sin by signed degree, offset by the steepest slope
+        steepest = int(max(np.abs(slope_lo).max(), np.abs(slope_hi).max()))
+        slope_sin = np.array([SIN_BY_DEGREE[d] for d in range(-steepest, steepest + 1)])
+
+    # Change count per num_changes sampler index
+    change_counts = np.array(config['num_change_sampler'].items, dtype=np.int64)
+
+    # Initial State (scalar, as in iter_sections)
+    carry = {}
+    for k in state_keys:
+        carry[k] = tables[k].intern(attr_map[k]['getter'](rng))
+    carry_degree = 0
+    if 'slope' in attr_map:
+        min_deg, max_deg = tables['slope'].values[carry['slope']]['range']
+        carry_degree = rng.randint(min_deg, max_deg)
+    # Last row of the previous chunk, for merging across chunk boundaries
+    carry_special = None
+    # Last section so far (a one-row chunk), still open for merging
+    prev = None
+    first = True
+
+    while current_feet < total_feet:
+        n = int(min(chunk_size, (total_feet - current_feet) / mean_len * 1.2 + 16))
+
+        num_changes = change_counts[config['num_change_sampler'].draw_many(n, gen)]
+        if first:
+            num_changes[0] = 0
+        # One pick per change, tagged with its row
+        pick_rows = np.repeat(np.arange(n), num_changes)
+        picks = config['change_sampler'].draw_many(len(pick_rows), gen)
+
+        # Section lengths
+        len_cat = config['len_sampler'].draw_many(n, gen)
+        lens = np.empty(n, dtype=np.int64)
+        for ci, c in enumerate(len_choices):
+            rows = len_cat == ci
+            m = int(rows.sum())
+            if m:
+                num_dice, sides = c['dice']
+                lens[rows] = roll_many(num_dice, sides, m, gen) * c['mult'] + c['add']
+
+        # Stop at the end of the tunnel, clipping the last section
+        cum = np.cumsum(lens)
+        remaining = total_feet - current_feet
+        end = int(np.searchsorted(cum, remaining, side='left'))
+        if end < n:
+            n = end + 1
+            kept = pick_rows < n
+            picks = picks[kept]
+            pick_rows = pick_rows[kept]
+            lens = lens[:n]
+            lens[end] = remaining - (cum[end - 1] if end > 0 else 0)
+
+        # Times each attribute was picked in each row, all counted at once
+        hit_counts = np.bincount(picks * n + pick_rows, minlength=len(attr_keys) * n).reshape(len(attr_keys), n)
+
+        # Attribute codes per row
+        codes = {}
+        for k in state_keys:
+            hits = hit_counts[attr_keys.index(k)]
+            changed = hits > 0
+            attr_config = attr_map[k]
+            new_codes = np.zeros(n, dtype=np.int64)
+            changed_rows = np.flatnonzero(changed)
+
+            if 'sampler' in attr_config and 'mutator' not in attr_config:
+                new_codes[changed_rows] = attr_config['sampler'].draw_many(len(changed_rows), gen)
+            elif 'die_table' in attr_config:
+                new_codes[changed_rows] = die_values[k].roll_many(len(changed_rows), gen, rng)
+            elif 'mutator' in attr_config:
+                # Mutators depend on the previous value, walk the changed rows in order
+                value = tables[k].values[carry[k]]
+                counts = hits[changed_rows].tolist()
+                if 'mutator_many' in attr_config:
+                    values = attr_config['mutator_many'](value, counts, gen)
+                else:
+                    values = []
+                    for count in counts:
+                        for _ in range(count):
+                            value = attr_config['mutator'](value, rng)
+                        values.append(value)
+                # Bulk mutators hand back the same object for the same value
+                by_id = {}
+                for i, value in zip(changed_rows.tolist(), values):
+                    code = by_id.get(id(value))
+                    if code is None:
+                        code = by_id[id(value)] = tables[k].intern(value)
+                    new_codes[i] = code
+            else:
+                for i in changed_rows:
+                    new_codes[i] = tables[k].intern(attr_config['getter'](rng))
+
+            codes[k] = _carry_forward(changed, new_codes, carry[k])
+
+            if k == 'slope':
+                new_deg = np.zeros(n, dtype=np.int64)
+                new_slopes = new_codes[changed_rows]
+                new_deg[changed_rows] = gen.integers(slope_lo[new_slopes], slope_hi[new_slopes] + 1)
+                degree = _carry_forward(changed, new_deg, carry_degree)
+
+        # Special features, one per row that picked 'special' (the last roll wins)
+        special_codes = np.zeros(n, dtype=np.int64)
+        special_elev = np.zeros(n)
+        if 'special' in attr_keys:
+            si = attr_keys.index('special')
+            rows = np.flatnonzero(hit_counts[si])
+            if on_special is not None:
+                row_feet = (current_feet + np.cumsum(lens) - lens).tolist()
+            features = special_features.roll_many(len(rows), gen, rng)
+            # Equal rolls share a feature, so most codes come from by_id
+            by_id = {}
+            for i, feature in zip(rows.tolist(), features):
+                if feature:
+                    code = by_id.get(id(feature))
+                    if code is None:
+                        code = by_id[id(feature)] = special_table.intern(feature['desc'])
+                    special_codes[i] = code
+                    special_elev[i] = feature.get('elev_change') or 0
+                    if on_special is not None:
+                        on_special(row_feet[i], feature)
+
+        # Elevation per row
+        elev = np.zeros(n)
+        if 'slope' in attr_map:
+            elev = lens * slope_sin[degree * slope_sign[codes['slope']] + steepest]
+        if 'flow' in attr_map:
+            drops = np.array([v['drop_ft_per_mile'] for v in tables['flow'].values])
+            elev = elev - lens / 5280.0 * drops[codes['flow']]
+        elev = elev + special_elev
+
+        # Section starts: any attribute or the special differs from the row before
+        starts = np.zeros(n, dtype=bool)
+        starts[0] = prev is None
+        key_rows = [codes[k] for k in state_keys] + [special_codes]
+        if 'slope' in attr_map:
+            key_rows.append(degree)
+        for arr in key_rows:
+            starts[1:] |= arr[1:] != arr[:-1]
+        if prev is not None:
+            carry_row = [carry[k] for k in state_keys] + [carry_special]
+            if 'slope' in attr_map:
+                carry_row.append(carry_degree)
+            starts[0] = any(int(arr[0]) != c for arr, c in zip(key_rows, carry_row))
+
+        start_rows = np.flatnonzero(starts)
+        group_len = np.add.reduceat(lens, start_rows) if len(start_rows) else np.zeros(0, dtype=np.int64)
+        group_elev = np.add.reduceat(elev, start_rows) if len(start_rows) else np.zeros(0)
+
+        # Rows before the first start extend the section left open by the last chunk
+        head = start_rows[0] if len(start_rows) else n
+        if head:
+            prev.len[0] += lens[:head].sum()
+            prev.elev[0] += elev[:head].sum()
+
+        if len(start_rows):
+            groups = SectionChunk(schema, group_len, group_elev, degree[start_rows] if 'slope' in attr_map else None,
+                                  special_codes[start_rows], {k: codes[k][start_rows] for k in state_keys}, special_table.values)
+            if prev is not None:
+                yield prev.join(groups[:-1])
+            elif len(groups) > 1:
+                yield groups[:-1]
+            prev = groups[-1:]
+
+        for k in state_keys:
+            carry[k] = int(codes[k][-1])
+        if 'slope' in attr_map:
+            carry_degree = int(degree[-1])
+        carry_special = int(special_codes[-1])
+        current_feet += int(lens.sum())
+        first = False
+
+    if prev is not None:
+        yield prev
+
+# --- Markov Engine ---
+# The section process as a Markov chain on the attribute state. A raw section
+# changes nothing when every attribute picked for it is re-rolled to the
+# value it already has and no special feature turns up; such a section just
+# merges. For table attributes and special features that chance is known
+# from the tables, so for as long as the state stays the same every raw
+# section is trivial with the same probability, and the run of trivial
+# sections before the next change is geometric. The total length of that run
+# is drawn in a few steps (see RunLengths), so the work goes with the number
+# of changes rather than the number of raw sections; the next changing
+# section is drawn conditionally on not being trivial. Attributes with
+# generated values, die tables or mutators count as changing whenever they
+# are picked: they are called as usual and a section they happen to leave
+# unchanged merges as usual. Same distributions as iter_sections, not the
+# same sequence. Needs numpy, for building the run length tables.
+
+RUN_BLOCK = 16
+RUN_TABLE_MAX = 1 << 20
+_run_lengths = {}
+
+class RunLengths:
+    # Total length of a run of raw sections without drawing each one. The
+    # distribution of the sum of 2**j section lengths, for each 2**j up to
+    # RUN_BLOCK, is worked out once per lengths table as an FFT power of the
+    # single length distribution (exact up to float rounding; sums less
+    # likely than 1e-14 are dropped) and kept as an inverse CDF. A run of k
+    # sections takes one draw per set bit of k, RUN_BLOCK sections at a time
+    # beyond that. Blocks are smaller when RUN_BLOCK sums would need more than
+    # RUN_TABLE_MAX points, and lengths wider than that are drawn one by one.
+    def __init__(self, len_choices, draw_one):
+        self.draw_one = draw_one
+        total_weight = float(sum(c['weight'] for c in len_choices))
+        lowest = min(c['dice'][0] * c['mult'] + c['add'] for c in len_choices)
+        top = max(c['dice'][0] * c['dice'][1] * c['mult'] + c['add'] for c in len_choices)
+        self.block = 1
+        while self.block * 2 <= RUN_BLOCK and self.block * 2 * top < RUN_TABLE_MAX:
+            self.block *= 2
+        self.tables = []
+        if top >= RUN_TABLE_MAX:
+            return
+        pmf = np.zeros(top + 1)
+        for c in len_choices:
+            num_dice, sides = c['dice']
+            total = sides ** num_dice
+            probs = np.array([k / total for k in dice_distribution(num_dice, sides)])
+            pmf[num_dice * c['mult'] + c['add'] + c['mult'] * np.arange(len(probs))] += probs * (c['weight'] / total_weight)
+        size = 1
+        while size <= self.block:
+            points = size * top + 1
+            fft_len = 1 << (points - 1).bit_length()
+            dist = np.fft.irfft(np.fft.rfft(pmf, fft_len) ** size, fft_len)[size * lowest:points]
+            dist[dist < 1e-14] = 0.0
+            self.tables.append((size * lowest, np.cumsum(dist).tolist()))
+            size *= 2
+
+    @classmethod
+    def for_config(cls, config):
+        key = tuple((tuple(c['dice']), c['mult'], c['add'], c['weight']) for c in config['len_choices'])
+        run_lengths = _run_lengths.get(key)
+        if run_lengths is None:
+            draw_len = config['len_sampler'].draw
+            run_lengths = _run_lengths.setdefault(key, cls(config['len_choices'], lambda rng: draw_len(rng)['gen'](rng)))
+        return run_lengths
+
+    def _draw(self, j, rng):
+        start, cdf = self.tables[j]
+        return start + bisect.bisect_right(cdf, rng.random() * cdf[-1])
+
+    def draw(self, count, rng, limit):
+        # Sum of count section lengths (count may be math.inf), cut short as
+        # soon as it reaches limit: the run is clipped there anyway
+        total = 0
+        if not self.tables:
+            while count > 0 and total < limit:
+                total += self.draw_one(rng)
+                count -= 1
+            return total
+        top = len(self.tables) - 1
+        while count >= self.block and total < limit:
+            total += self._draw(top, rng)
+            count -= self.block
+        j = 0
+        while count and total < limit:
+            if count & 1:
+                total += self._draw(j, rng)
+            count >>= 1
+            j += 1
+        return total
+
+def iter_sections_markov(length_miles, tunnel_type='dry', min_height=0, min_width=0, seed=None, rng=None, tables=None, on_special=None):
+    if np is None:
+        raise ImportError("The markov engine requires numpy (pip install numpy)")
+    if rng is None:
+        rng = make_rng(seed)
+    total_feet = miles_to_feet(length_miles)
+    current_feet = 0
+
+    config = get_config(tunnel_type, min_height, min_width, tables)
+    table_set = config['tables']
+    attr_map = config['attributes']
+    special_gen = config['special_gen']
+    draw_attr = config['change_sampler'].draw
+    draw_len = config['len_sampler'].draw
+    run_lengths = RunLengths.for_config(config)
+
+    schema = SectionSchema(config)
+    new_section = schema.section
+    state_keys = schema.keys
+    state_pos = {k: i for i, k in enumerate(state_keys)}
+    tables = [schema.tables[k] for k in state_keys]
+    slope_pos = state_pos.get('slope')
+    flow_pos = state_pos.get('flow')
+
+    # Chance of each change count (change_probs[k]) and of each attribute
+    # being picked for a change
+    num_changes = config['num_change_sampler']
+    total = float(sum(num_changes.weights))
+    change_probs = [0.0] * (max(num_changes.items) + 1)
+    for k, w in zip(num_changes.items, num_changes.weights):
+        change_probs[k] += w / total
+    change_sampler = config['change_sampler']
+    total = float(sum(change_sampler.weights))
+    pick_names = list(change_sampler.items)
+    pick_probs = [w / total for w in change_sampler.weights]
+
+    # Chance that a pick keeps the value, by current code, for table
+    # attributes (a slope also has to land on the same degree)
+    keep = {}
+    for pos, name in enumerate(state_keys):
+        attr = attr_map[name]
+        if 'sampler' not in attr or 'mutator' in attr:
+            continue
+        sampler = attr['sampler']
+        total = float(sum(sampler.weights))
+        by_code = {}
+        for item, w in zip(sampler.items, sampler.weights):
+            p = w / total
+            if pos == slope_pos:
+                lo, hi = item['range']
+                p /= hi - lo + 1
+            code = tables[pos].intern(item)
+            by_code[code] = by_code.get(code, 0.0) + p
+        keep[pos] = by_code
+
+    # Chance that a special feature roll comes up empty
+    special_spec = table_set.types[tunnel_type]['special']
+    if 'table' in special_spec:
+        rows = table_set.tables[special_spec['table']]
+        special_none = sum(r['weight'] for r in rows if r.get('none')) / float(sum(r['weight'] for r in rows))
+    else:
+        die_table = table_set.die_tables[special_spec['die_table']]
+        special_none = sum(p for e, p in zip(die_table.entries, die_table.probabilities()) if e.get('none'))
+
+    state = [tables[i].intern(attr_map[k]['getter'](rng)) for i, k in enumerate(state_keys)]
+    degree = None
+    if schema.has_degree:
+        min_deg, max_deg = tables[slope_pos].values[state[slope_pos]]['range']
+        degree = rng.randint(min_deg, max_deg)
+    key = schema.pack(state, degree)
+
+    # keep_terms[i]: chance that the i-th pickable attribute is picked and
+    # changes nothing, kept up to date as the state changes
+    pick_index = {name: i for i, name in enumerate(pick_names)}
+    keep_terms = [0.0] * len(pick_names)
+    if 'special' in pick_index:
+        keep_terms[pick_index['special']] = pick_probs[pick_index['special']] * special_none
+    for pos, by_code in keep.items():
+        i = pick_index[state_keys[pos]]
+        keep_terms[i] = pick_probs[i] * by_code.get(state[pos], 0.0)
+
+    def elev_per_foot():
+        per_foot = 0.0
+        if degree is not None:
+            angle = -degree if "Down" in tables[slope_pos].values[state[slope_pos]]['name'] else degree
+            per_foot = SIN_BY_DEGREE[angle]
+        if flow_pos is not None:
+            per_foot -= tables[flow_pos].values[state[flow_pos]]['drop_ft_per_mile'] / 5280.0
+        return per_foot
+
+    # Elevation change per foot and the chances derived from keep_terms,
+    # recomputed only when the state they depend on changes
+    per_foot = elev_per_foot()
+    terms_changed = True
+
+    def change(name, force):
+        # Re-rolls (or mutates) an attribute; force draws until the value or
+        # degree differs, for attributes whose keep chance is known
+        nonlocal key, degree, per_foot, terms_changed
+        pos = state_pos[name]
+        attr = attr_map[name]
+        force = force and pos in keep
+        while True:
+            if 'mutator' in attr:
+                new_val = attr['mutator'](tables[pos].values[state[pos]], rng)
+            else:
+                new_val = attr['getter'](rng)
+            code = tables[pos].intern(new_val)
+            new_degree = rng.randint(*new_val['range']) if pos == slope_pos else degree
+            if not force or code != state[pos] or new_degree != degree:
+                break
+        if code != state[pos]:
+            state[pos] = code
+            key = schema.set_code(key, pos, code)
+            if pos in keep:
+                i = pick_index[name]
+                keep_terms[i] = pick_probs[i] * keep[pos].get(code, 0.0)
+                terms_changed = True
+            if pos in (flow_pos, slope_pos):
+                # An Up/Down twin can come back with the same degree
+                per_foot = elev_per_foot()
+        if new_degree != degree:
+            degree = new_degree
+            key = schema.set_degree(key, degree)
+            per_foot = elev_per_foot()
+
+    max_changes = len(change_probs) - 1
+    prev = None
+    while current_feet < total_feet:
+        special_feature = None
+        if prev is not None:
+            # same: chance that one pick changes nothing. rest[r]: weight of
+            # r picks following the first pick that changes something, summed
+            # over the change counts; trivial: chance the section changes
+            # nothing. Both weight lists are kept as running sums to bisect.
+            if terms_changed:
+                same = sum(keep_terms)
+                rest = [0.0] * max_changes
+                acc = 0.0
+                for r in range(max_changes - 1, -1, -1):
+                    acc = change_probs[r + 1] + same * acc
+                    rest[r] = acc
+                rest_cum = list(accumulate(rest))
+                change_cum = list(accumulate(map(float.__sub__, pick_probs, keep_terms)))
+                trivial = change_probs[0] + same * acc
+                log_trivial = math.log(trivial) if 0.0 < trivial < 1.0 else None
+                terms_changed = False
+
+            # Trivial sections until the next change, merged into one
+            if log_trivial is not None:
+                run = int(math.log(1.0 - rng.random()) / log_trivial)
+            else:
+                run = math.inf if trivial >= 1.0 else 0
+            run_len = run_lengths.draw(run, rng, total_feet - current_feet) if run else 0
+            if run_len:
+                run_len = min(run_len, total_feet - current_feet)
+                run_elev = run_len * per_foot
+                if prev.key == key and prev.special is None:
+                    prev.len += run_len
+                    prev.elev += run_elev
+                else:
+                    yield prev
+                    prev = new_section(run_len, run_elev, None, key)
+                current_feet += run_len
+                if current_feet >= total_feet:
+                    break
+
+            # The changing section: the picks before its first change are
+            # skipped (they change nothing), that pick is drawn among the
+            # changing outcomes, the picks after it run as usual
+            after = bisect.bisect_right(rest_cum, rng.random() * rest_cum[-1])
+            name = pick_names[bisect.bisect_right(change_cum, rng.random() * change_cum[-1])]
+            if name == 'special':
+                while special_feature is None:
+                    special_feature = special_gen(rng)
+            else:
+                change(name, True)
+            for _ in range(after):
+                name = draw_attr(rng)
+                if name == 'special':
+                    special_feature = special_gen(rng)
+                else:
+                    change(name, False)
+
+        section_len = min(draw_len(rng)['gen'](rng), total_feet - current_feet)
+        elev_change = section_len * per_foot
+        special = None
+        if special_feature:
+            elev_change += special_feature.get('elev_change') or 0
+            special = special_feature['desc']
+            if on_special is not None:
+                on_special(current_feet, special_feature)
+
+        if prev is not None and prev.key == key and prev.special == special:
+            prev.len += section_len
+            prev.elev += elev_change
+        else:
+            if prev is not None:
+                yield prev
+            prev = new_section(section_len, elev_change, special, key)
+        current_feet += section_len
+
+    if prev is not None:
+        yield prev
+
+# Section engines selectable from generate_tunnel and the command line
+ENGINES = {
+    'python': iter_sections,
+    'numpy': iter_sections_numpy,
+    'markov': iter_sections_markov,
+}
+
+# --- Columnar Export ---
+# One column per attribute plus len, elev, degree, width and special, written
+# in chunks so a tunnel of any length streams straight to disk. Categorical
+# columns are dictionary encoded: int32 codes plus a list of labels.
+
+def value_label(value):
+    # Text used for an attribute value in exports
+    return value['name'] if isinstance(value, dict) else str(value)
+
+class _LabelEncoder:
+    # Maps schema value codes (or raw text) to codes into a label dictionary
+    def __init__(self):
+        self.labels = []
+        self.by_label = {}
+        self.by_value_code = {}
+
+    def label_code(self, label):
+        code = self.by_label.get(label)
+        if code is None:
+            code = len(self.labels)
+            self.by_label[label] = code
+            self.labels.append(label)
+        return code
+
+    def value_code(self, table, value_code):
+        code = self.by_value_code.get(value_code)
+        if code is None:
+            code = self.label_code(value_label(table.values[value_code]))
+            self.by_value_code[value_code] = code
+        return code
+
+def _encode_codes(codes, encode):
+    # codes (an int array) mapped through encode(code), which is called once per
+    # distinct code in order of first appearance, so growing label tables come
+    # out in the same order as when the rows are encoded one at a time
+    if not len(codes):
+        return np.zeros(0, dtype=np.int32)
+    distinct, first = np.unique(codes, return_index=True)
+    lut = np.zeros(distinct[-1] + 1, dtype=np.int32)
+    for code in distinct[np.argsort(first)].tolist():
+        lut[code] = encode(code)
+    return lut[codes]
+
+def _chunk_columns(chunk, encoders):
+    # export_columns' numeric and code columns for a SectionChunk
+    schema = chunk.schema
+    numeric_cols = {'len': chunk.len, 'elev': chunk.elev}
+    if chunk.degree is not None:
+        numeric_cols['degree'] = chunk.degree
+    numeric_cols['width'] = chunk.width()
+    codes_cols = {}
+    for name in schema.keys:
+        table, encoder = schema.tables[name], encoders[name]
+        codes_cols[name] = _encode_codes(chunk.codes[name], lambda code: encoder.value_code(table, code))
+    specials, encoder = chunk.specials, encoders['special']
+    codes_cols['special'] = _encode_codes(chunk.special, lambda code: -1 if code == 0 else encoder.label_code(specials[code]))
+    return numeric_cols, codes_cols
+
+class _ParquetColumnWriter:
+    def __init__(self, path, numeric, categorical):
+        self.path = path
+        self.numeric = numeric
+        self.categorical = categorical
+        fields = [pa.field(name, pa.int64() if typecode == 'q' else pa.float64()) for name, typecode in numeric]
+        fields += [pa.field(name, pa.dictionary(pa.int32(), pa.string())) for name in categorical]
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write_chunk(self, numeric_cols, codes_cols, encoders):
+        arrays = [pa.array(numeric_cols[name]) for name, _ in self.numeric]
+        for name in self.categorical:
+            # -1 marks a missing value (no special feature)
+            col = codes_cols[name]
+            if np is not None and isinstance(col, np.ndarray):
+                codes = pa.array(col, type=pa.int32(), mask=col < 0)
+            else:
+                codes = pa.array([c if c >= 0 else None for c in col], type=pa.int32())
+            arrays.append(pa.DictionaryArray.from_arrays(codes, pa.array(encoders[name].labels, type=pa.string())))
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self, encoders):
+        self.writer.close()
+
+class _NpzColumnWriter:
+    # Streams each column to a raw temp file, then wraps them as .npy members
+    # of the .npz without loading them back. Labels go in '<column>_labels'.
+    def __init__(self, path, numeric, categorical):
+        self.path = path
+        self.dtypes = {name: ('<i8' if typecode == 'q' else '<f8') for name, typecode in numeric}
+        self.dtypes.update({name: '<i4' for name in categorical})
+        self.categorical = categorical
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = {name: open(os.path.join(self.tmpdir.name, name), 'wb') for name in self.dtypes}
+        self.rows = 0
+
+    def write_chunk(self, numeric_cols, codes_cols, encoders):
+        for name, col in list(numeric_cols.items()) + list(codes_cols.items()):
+            col.tofile(self.files[name])
+        self.rows += len(next(iter(numeric_cols.values())))
+
+    def close(self, encoders):
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for name, f in self.files.items():
+                f.close()
+                with zf.open(name + '.npy', 'w', force_zip64=True) as member:
+                    header = {'descr': self.dtypes[name], 'fortran_order': False, 'shape': (self.rows,)}
+                    np.lib.format.write_array_header_2_0(member, header)
+                    with open(f.name, 'rb') as raw:
+                        shutil.copyfileobj(raw, member)
+            for name in self.categorical:
+                with zf.open(name + '_labels.npy', 'w', force_zip64=True) as member:
+                    np.save(member, np.array(encoders[name].labels, dtype=str))
+        self.tmpdir.cleanup()
+
+def export_columns(sections, path, chunk_size=65536):
+    # Writes a section stream to Parquet (needs pyarrow) or .npz (needs numpy)
+    # by file suffix and returns the number of sections written. A stream of
+    # SectionChunks is written a chunk at a time, without building sections.
+    if path.endswith('.parquet'):
+        if pa is None:
+            raise ImportError("Parquet export requires pyarrow (pip install pyarrow), or use a .npz path")
+        writer_cls = _ParquetColumnWriter
+    elif path.endswith('.npz'):
+        if np is None:
+            raise ImportError(".npz export requires numpy (pip install numpy)")
+        writer_cls = _NpzColumnWriter
+    else:
+        raise ValueError(f"Unknown export format for {path} (use .parquet or .npz)")
+
+    sections = iter(sections)
+    first = next(sections, None)
+    schema = first.schema if first is not None else None
+    attr_keys = schema.keys if schema is not None else []
+
+    numeric = [('len', 'q'), ('elev', 'd')]
+    if schema is not None and schema.has_degree:
+        numeric.append(('degree', 'q'))
+    numeric.append(('width', 'q'))
+    categorical = attr_keys + ['special']
+    encoders = {name: _LabelEncoder() for name in categorical}
+    writer = writer_cls(path, numeric, categorical)
+
+    def new_chunk():
+        return {name: array(typecode) for name, typecode in numeric}, {name: array('i') for name in categorical}
+
+    count = 0
+    numeric_cols, codes_cols = new_chunk()
+    if isinstance(first, SectionChunk):
+        for chunk in _chain_first(first, sections):
+            if len(chunk):
+                writer.write_chunk(*_chunk_columns(chunk, encoders), encoders)
+                count += len(chunk)
+        if count == 0:
+            writer.write_chunk(numeric_cols, codes_cols, encoders)
+    else:
+        for s in (_chain_first(first, sections) if first is not None else ()):
+            numeric_cols['len'].append(s.len)
+            numeric_cols['elev'].append(s.elev)
+            if 'degree' in numeric_cols:
+                numeric_cols['degree'].append(s.degree)
+            numeric_cols['width'].append(s.width)
+            key = s.key
+            for name in attr_keys:
+                codes_cols[name].append(encoders[name].value_code(schema.tables[name], schema.code(key, name)))
+            codes_cols['special'].append(-1 if s.special is None else encoders['special'].label_code(s.special))
+            count += 1
+            if count % chunk_size == 0:
+                writer.write_chunk(numeric_cols, codes_cols, encoders)
+                numeric_cols, codes_cols = new_chunk()
+        if count % chunk_size or count == 0:
+            writer.write_chunk(numeric_cols, codes_cols, encoders)
+    writer.close(encoders)
+    return count
+
+def _chain_first(first, rest):
+    yield first
+    yield from rest
+
+# --- Statistics Mode ---
+# Runs many tunnels through the same state machine and keeps only running
+# moments and histograms, never the sections themselves.
+
+class RunningStats:
+    # Welford's online mean/variance plus min/max
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def add_many(self, xs):
+        # A numpy array of values at once, merged with Chan et al.'s update
+        n = len(xs)
+        if not n:
+            return
+        mean = float(xs.mean())
+        m2 = float(np.square(xs - mean).sum())
+        count = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / count
+        self.m2 += m2 + delta * delta * self.count * n / count
+        self.count = count
+        low, high = xs.min().item(), xs.max().item()
+        if self.min is None or low < self.min:
+            self.min = low
+        if self.max is None or high > self.max:
+            self.max = high
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'stdev': self.stdev, 'min': self.min, 'max': self.max}
+
+def stationary_probabilities(config):
+    # Exact long-run share of each value for table attributes. A table value is
+    # drawn fresh whenever the attribute changes and the initial state uses the
+    # same draw, so every raw section (and every foot) follows the table weights.
+    # Die table entries count when their label does not depend on rolled values.
+    result = {}
+    for name, attr in config['attributes'].items():
+        if 'die_table' in attr and 'mutator' not in attr:
+            die_table = attr['die_table']
+            probs = {}
+            for entry, fixed, p in zip(die_table.entries, die_table.fixed, die_table.probabilities()):
+                if fixed is not None:
+                    label = value_label(fixed)
+                elif 'format' not in entry and 'name' in entry:
+                    label = entry['name']
+                else:
+                    continue
+                probs[label] = probs.get(label, 0) + p
+            result[name] = probs
+            continue
+        if 'choices' not in attr or 'mutator' in attr:
+            continue
+        total = sum(c['weight'] for c in attr['choices'])
+        probs = {}
+        for c in attr['choices']:
+            label = value_label(c)
+            probs[label] = probs.get(label, 0) + c['weight'] / total
+        result[name] = probs
+    return result
+
+STATS_ELEV_BINS = 20
+
+def _elevation_bin(low, high):
+    # Smallest 1, 2 or 5 times a power of ten (1 ft at least) that covers
+    # low..high in STATS_ELEV_BINS bins
+    target = (high - low) / STATS_ELEV_BINS
+    if target <= 1:
+        return 1
+    scale = 10 ** math.floor(math.log10(target))
+    for step in (1, 2, 5, 10):
+        if step * scale >= target:
+            return step * scale
+
+def _tally_sections(sections, section_len):
+    # One tunnel's totals for simulate_stats: schema, sections, feet, elevation,
+    # sections with a special feature and {name: {value code: [feet, sections]}}.
+    # Section lengths go straight into section_len.
+    schema = None
+    num_sections = 0
+    feet = 0
+    elev = 0.0
+    specials = 0
+    # Same key means same value codes, so count whole keys
+    feet_by_key = {}
+    count_by_key = {}
+    for s in sections:
+        schema = s.schema
+        num_sections += 1
+        elev += s.elev
+        section_len.add(s.len)
+        feet += s.len
+        if s.special is not None:
+            specials += 1
+        feet_by_key[s.key] = feet_by_key.get(s.key, 0) + s.len
+        count_by_key[s.key] = count_by_key.get(s.key, 0) + 1
+    by_value = {}
+    if schema is not None:
+        for key, key_feet in feet_by_key.items():
+            for name in schema.keys:
+                tally = by_value.setdefault(name, {}).setdefault(schema.code(key, name), [0, 0])
+                tally[0] += key_feet
+                tally[1] += count_by_key[key]
+    return schema, num_sections, feet, elev, specials, by_value
+
+def _tally_chunks(chunks, section_len):
+    # _tally_sections for a tunnel as SectionChunks, counted per column
+    schema = None
+    num_sections = 0
+    feet = 0
+    elev = 0.0
+    specials = 0
+    feet_by_code = {}
+    count_by_code = {}
+
+    def add(totals, counts):
+        if totals is None:
+            return counts
+        if len(counts) > len(totals):
+            totals, counts = counts, totals
+        totals[:len(counts)] += counts
+        return totals
+
+    for chunk in chunks:
+        schema = chunk.schema
+        num_sections += len(chunk)
+        elev += float(chunk.elev.sum())
+        section_len.add_many(chunk.len)
+        feet += int(chunk.len.sum())
+        specials += int(np.count_nonzero(chunk.special))
+        for name, codes in chunk.codes.items():
+            feet_by_code[name] = add(feet_by_code.get(name), np.bincount(codes, weights=chunk.len))
+            count_by_code[name] = add(count_by_code.get(name), np.bincount(codes))
+    by_value = {}
+    for name, counts in count_by_code.items():
+        by_value[name] = {code: [int(feet_by_code[name][code]), int(counts[code])] for code in np.flatnonzero(counts).tolist()}
+    return schema, num_sections, feet, elev, specials, by_value
+
+def simulate_stats(length_miles, tunnel_type='dry', runs=100, min_height=0, min_width=0, seed=None, engine='python', elev_bin=None, tables=None):
+    # Aggregates over 'runs' tunnels: section counts, section lengths,
+    # elevation moments and a histogram of total elevation change, plus the
+    # share of feet and of sections for every attribute value. elev_bin (feet)
+    # defaults to a 1, 2 or 5 times a power of ten giving about
+    # STATS_ELEV_BINS bins over the elevations observed. The numpy engine is
+    # tallied a SectionChunk at a time, without building sections.
+    section_iter = ENGINES[engine]
+    sections_per_tunnel = RunningStats()
+    section_len = RunningStats()
+    tunnel_elev = RunningStats()
+    tunnel_elevs = []
+    feet_by_label = {}
+    sections_by_label = {}
+    special_sections = 0
+    total_feet = 0
+    total_sections = 0
+
+    for run in range(runs):
+        run_seed = tunnel_seed(seed, run) if seed is not None else None
+        if engine == 'numpy':
+            tally = _tally_chunks(iter_chunks_numpy(length_miles, tunnel_type, min_height, min_width, seed=run_seed, tables=tables), section_len)
+        else:
+            tally = _tally_sections(section_iter(length_miles, tunnel_type, min_height, min_width, seed=run_seed, tables=tables), section_len)
+        schema, num_sections, feet, elev, specials, by_value = tally
+        total_feet += feet
+        special_sections += specials
+        total_sections += num_sections
+        sections_per_tunnel.add(num_sections)
+        tunnel_elev.add(elev)
+        tunnel_elevs.append(elev)
+
+        # Per tunnel counts by value code, folded into labels once the tunnel ends
+        for name, by_code in by_value.items():
+            values = schema.tables[name].values
+            feet_labels = feet_by_label.setdefault(name, {})
+            section_labels = sections_by_label.setdefault(name, {})
+            for code, (code_feet, code_sections) in by_code.items():
+                label = value_label(values[code])
+                feet_labels[label] = feet_labels.get(label, 0) + code_feet
+                section_labels[label] = section_labels.get(label, 0) + code_sections
+
+    if elev_bin is None:
+        elev_bin = _elevation_bin(min(tunnel_elevs, default=0.0), max(tunnel_elevs, default=0.0))
+    elev_hist = {}
+    for elev in tunnel_elevs:
+        b = math.floor(elev / elev_bin) * elev_bin
+        elev_hist[b] = elev_hist.get(b, 0) + 1
+
+    config = get_config(tunnel_type, min_height, min_width, tables)
+    mean_len = _mean_section_len(config['len_choices'])
+    return {
+        'length_miles': length_miles,
+        'type': tunnel_type,
+        'runs': runs,
+        'seed': seed,
+        'sections_per_tunnel': sections_per_tunnel.as_dict(),
+        'section_len': section_len.as_dict(),
+        'tunnel_elevation': tunnel_elev.as_dict(),
+        'elevation_histogram': dict(sorted(elev_hist.items())),
+        'elevation_bin': elev_bin,
+        'special_share': special_sections / total_sections if total_sections else 0.0,
+        'feet_share': {name: {label: feet / total_feet for label, feet in labels.items()} for name, labels in feet_by_label.items()},
+        'section_share': {name: {label: n / total_sections for label, n in labels.items()} for name, labels in sections_by_label.items()},
+        'expected_raw_section_len': mean_len,
+        'expected_raw_sections': miles_to_feet(length_miles) / mean_len,
+        'stationary': stationary_probabilities(config),
+    }
+
+def print_stats(stats, out=None):
+    def moments(m):
+        return f"mean {m['mean']:,.1f}, stdev {m['stdev']:,.1f}, min {m['min']:,.1f}, max {m['max']:,.1f}" if m['count'] else "n/a"
+
+    print(f"Statistics for {stats['runs']} {stats['type']} tunnels of {stats['length_miles']} miles (seed {stats['seed']})", file=out)
+    print(f"Sections per tunnel: {moments(stats['sections_per_tunnel'])}", file=out)
+    print(f"Expected raw sections before merging: {stats['expected_raw_sections']:,.1f} (mean raw length {stats['expected_raw_section_len']:.1f} ft)", file=out)
+    print(f"Section length (ft): {moments(stats['section_len'])}", file=out)
+    print(f"Total elevation change (ft): {moments(stats['tunnel_elevation'])}", file=out)
+    print(f"Sections with a special feature: {stats['special_share']:.2%}", file=out)
+
+    print(f"\n--- Total Elevation Change ({stats['elevation_bin']:g} ft bins) ---", file=out)
+    runs = stats['runs'] or 1
+    for b, n in stats['elevation_histogram'].items():
+        print(f"{b:>+9,.0f} to {b + stats['elevation_bin']:>+9,.0f}: {n:>6} ({n / runs:6.1%})", file=out)
+
+    for name, shares in stats['feet_share'].items():
+        exact = stats['stationary'].get(name, {})
+        print(f"\n--- {name} (share of feet / of sections / exact) ---", file=out)
+        for label, share in sorted(shares.items(), key=lambda kv: -kv[1]):
+            exact_txt = f"{exact[label]:7.2%}" if label in exact else "      -"
+            print(f"{share:7.2%} {stats['section_share'][name][label]:7.2%} {exact_txt}  {label}", file=out)
+
+# --- Batch Mode ---
+
+def load_manifest(path):
+    # A manifest is a JSON list of tunnel specs:
+    # {"length": 5, "type": "wet", "min_height": 0, "min_width": 0, "seed": 1}
+    with open(path) as f:
+        specs = json.load(f)
+    if not isinstance(specs, list):
+        raise ValueError(f"Manifest {path} must be a JSON list of tunnel specs")
+    return specs
+
+def normalize_spec(spec, index, base_seed=None):
+    # Fill in defaults; a spec without a seed gets the index-th sub-seed of base_seed
+    unknown = set(spec) - {'length', 'type', 'min_height', 'min_width', 'seed'}
+    if unknown:
+        raise ValueError(f"Tunnel spec {index} has unknown keys: {', '.join(sorted(unknown))}")
+    if 'length' not in spec:
+        raise ValueError(f"Tunnel spec {index} is missing 'length'")
+    tunnel_type = spec.get('type', 'dry')
+    if not isinstance(tunnel_type, str):
+        raise ValueError(f"Tunnel spec {index} has unknown type {tunnel_type!r}")
+    seed = spec.get('seed')
+    if seed is None and base_seed is not None:
+        seed = tunnel_seed(base_seed, index)
+    return {
+        'length': float(spec['length']),
+        'type': tunnel_type,
+        'min_height': int(spec.get('min_height', 0)),
+        'min_width': int(spec.get('min_width', 0)),
+        'seed': seed,
+    }
+
+def render_tunnel(spec, engine='python', tables=None, fmt='text'):
+    # Full generate_tunnel text for one normalized spec (runs in a worker process).
+    # tables comes from table_source; each worker loads it once, from the cache.
+    out = io.StringIO()
+    generate_tunnel(spec['length'], spec['type'], spec['min_height'], spec['min_width'], engine, spec['seed'], out=out, tables=tables, fmt=fmt)
+    return out.getvalue()
+
+def generate_batch(specs, workers=None, engine='python', base_seed=None, tables=None, fmt='text'):
+    # Fans the specs out over a process pool and yields each tunnel's text in
+    # manifest order as soon as it (and everything before it) is done.
+    specs = [normalize_spec(spec, i, base_seed) for i, spec in enumerate(specs)]
+    tables = table_source(tables)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(render_tunnel, specs, [engine] * len(specs), [tables] * len(specs), [fmt] * len(specs))
+
+# --- Shared-Memory Transport ---
+# Batch workers can also hand tunnels back as sections rather than text.
+# Pickling a long list of sections back to the parent costs more than
+# generating it, so instead a worker writes fixed-width records into a
+# shared memory block and returns only the block's name and the side tables:
+# the values behind each attribute's codes (the worker's SectionSchema
+# tables) and the special feature strings. The parent maps the block and
+# reads the records in place.
+#
+# Record layout, little-endian without padding: len (q), elev (d, so it
+# comes back as a float), width (q), degree (i, 0 without a slope), special
+# (i, -1 for none, else an index into the string table), then one code (I)
+# per attribute in schema order.
+
+RECORD_HEAD = '<qdqii'
+
+# Blocks start this much larger than the expected section count (merging
+# only makes tunnels shorter in sections), so one seldom has to be regrown
+SHARED_SLACK = 1.1
+
+def record_struct(num_attributes):
+    return struct.Struct(RECORD_HEAD + 'I' * num_attributes)
+
+def record_dtype(keys):
+    # numpy dtype of the same records, one field per column
+    return np.dtype([('len', '<i8'), ('elev', '<f8'), ('width', '<i8'), ('degree', '<i4'), ('special', '<i4')]
+                    + [(k, '<u4') for k in keys])
+
+def pack_section(pack, shifts, s, specials, *where):
+    # One record for s; specials maps special strings to their index and grows.
+    # where is passed before the fields, for a pack_into's buffer and offset.
+    key = s.key
+    special = -1 if s.special is None else specials.setdefault(s.special, len(specials))
+    return pack(*where, s.len, s.elev, s.width, s.degree or 0, special, *[(key >> shift) & CODE_MASK for shift in shifts])
+
+def decode_records(records, schema, specials):
+    # Sections from record tuples
+    has_degree = schema.has_degree
+    new_section = schema.section
+    for length, elev, width, degree, special, *codes in records:
+        if not has_degree:
+            degree = None
+        yield new_section(length, elev, None if special < 0 else specials[special], schema.pack(codes, degree))
+
+def share_tunnel(spec, engine='python', tables=None):
+    # Generates one normalized spec into a new shared memory block (runs in a
+    # worker process). Records are packed straight into the block, sized for
+    # the expected section count and doubled when it runs out. The block
+    # outlives the worker: it is taken off this process's resource tracker,
+    # and the parent unlinks it once read.
+    sections = iter(ENGINES[engine](spec['length'], spec['type'], spec['min_height'], spec['min_width'], seed=spec['seed'], tables=tables))
+    result = {'spec': spec, 'name': None, 'count': 0, 'values': {}, 'specials': []}
+    first = next(sections, None)
+    if first is None:
+        return result
+    schema = first.schema
+    shifts = [schema.shifts[k] for k in schema.keys]
+    record = record_struct(len(shifts))
+    pack_into = record.pack_into
+    specials = {}
+    config = get_config(spec['type'], spec['min_height'], spec['min_width'], resolve_tables(tables))
+    expected = miles_to_feet(spec['length']) / _mean_section_len(config['len_choices'])
+    capacity = (int(expected * SHARED_SLACK) + 64) * record.size
+    shm = shared_memory.SharedMemory(create=True, size=capacity)
+    offset = 0
+    try:
+        for s in _chain_first(first, sections):
+            if offset + record.size > capacity:
+                capacity *= 2
+                shm = _grow_shared(shm, capacity, offset)
+            pack_section(pack_into, shifts, s, specials, shm.buf, offset)
+            offset += record.size
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    _untrack_shared(shm)
+    shm.close()
+    result.update(name=shm.name, count=offset // record.size, specials=list(specials))
+    result['values'] = {k: schema.tables[k].values for k in schema.keys}
+    return result
+
+def _grow_shared(shm, size, used):
+    # A block cannot be resized in place: copy the first used bytes into a
+    # new one of the given size and unlink the old one
+    try:
+        grown = shared_memory.SharedMemory(create=True, size=size)
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    grown.buf[:used] = shm.buf[:used]
+    shm.close()
+    shm.unlink()
+    return grown
+
+def _untrack_shared(shm):
+    # The tracker knows a POSIX block by its full name, with the leading
+    # slash that SharedMemory.name leaves off
+    resource_tracker.unregister('/' + shm.name, 'shared_memory')
+
+def _unlink_shared(name):
+    shm = shared_memory.SharedMemory(name)
+    shm.close()
+    shm.unlink()
+
+class SharedTunnel:
+    # Parent side of share_tunnel: one tunnel's records in shared memory.
+    # Iterating yields Sections decoded straight from the block, records()
+    # the raw tuples and array() a numpy view of it without a copy. close()
+    # (or leaving a with block) unlinks the block; numpy views and record
+    # iterators must be dropped first.
+    def __init__(self, result):
+        self.spec = result['spec']
+        self.count = result['count']
+        self.specials = result['specials']
+        # Codes and packed keys match the worker's
+        self.schema = SectionSchema.from_values(result['values'])
+        self._record = record_struct(len(self.schema.keys))
+        self._shm = None
+        self._view = memoryview(b'')
+        if result['name'] is not None:
+            self._shm = shared_memory.SharedMemory(result['name'])
+            self._view = self._shm.buf[:self.count * self._record.size]
+
+    def __len__(self):
+        return self.count
+
+    def records(self):
+        # (len, elev, width, degree, special, *codes) per section
+        return self._record.iter_unpack(self._view)
+
+    def __iter__(self):
+        return decode_records(self.records(), self.schema, self.specials)
+
+    def array(self):
+        # Structured numpy array over the block, one field per record column
+        if np is None:
+            raise ImportError("SharedTunnel.array requires numpy (pip install numpy)")
+        return np.frombuffer(self._view, dtype=record_dtype(self.schema.keys))
+
+    def close(self):
+        if self._shm is not None:
+            self._view.release()
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def generate_batch_shared(specs, workers=None, engine='python', base_seed=None, tables=None):
+    # generate_batch for sections: yields a SharedTunnel per spec in manifest
+    # order, which the caller closes. Blocks of tunnels not yet handed out when
+    # the generator is closed early are unlinked here.
+    specs = [normalize_spec(spec, i, base_seed) for i, spec in enumerate(specs)]
+    tables = table_source(tables)
+    # Started before the pool forks, so the workers share the parent's tracker
+    resource_tracker.ensure_running()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = iter([pool.submit(share_tunnel, spec, engine, tables) for spec in specs])
+        try:
+            for future in pending:
+                yield SharedTunnel(future.result())
+        finally:
+            for future in pending:
+                if future.cancel():
+                    continue
+                try:
+                    result = future.result()
+                except Exception:
+                    continue
+                if result['name'] is not None:
+                    _unlink_shared(result['name'])
+
+# --- Tunnel Store ---
+# A generated tunnel kept on disk as the fixed-width records of the
+# shared-memory transport, so it can be queried without regenerating or
+# parsing it. Attribute codes index the value lists of the tunnel's
+# SectionSchema (table values first, in get_config order, then generated
+# values as they turned up) and specials index a string table. Both are
+# kept in a pickled footer with the generation parameters and a sparse
+# offset index: the start feet and elevation of every 'every'-th section.
+#
+# File layout: header (magic, version, record size, section count, footer
+# offset), the records from STORE_HEADER.size on, then the footer. Readers
+# map the file and unpack records in place.
+
+STORE_MAGIC = b'UDTSTORE'
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct('<8sIIQQ')
+
+class TunnelStoreWriter:
+    # Writes a section stream to a store file, through a temporary file that
+    # replaces path on close(). meta is kept in the footer as is.
+    def __init__(self, path, every=1024, meta=None):
+        if every < 1:
+            raise ValueError("Index interval must be at least one section")
+        self.path = path
+        self.every = every
+        self.meta = meta or {}
+        self.count = 0
+        self.feet = 0
+        self.elev = 0.0
+        self._index_feet = array('q')
+        self._index_elev = array('d')
+        self._specials = {}
+        self._schema = None
+        self._tmp = f"{path}.{os.getpid()}.tmp"
+        self._file = open(self._tmp, 'wb')
+        self._file.write(bytes(STORE_HEADER.size))
+
+    def _start(self, schema):
+        self._schema = schema
+        self._shifts = [schema.shifts[k] for k in schema.keys]
+        self._record = record_struct(len(self._shifts))
+
+    def write(self, s):
+        if self._schema is None:
+            self._start(s.schema)
+        if self.count % self.every == 0:
+            self._index_feet.append(self.feet)
+            self._index_elev.append(self.elev)
+        self._file.write(pack_section(self._record.pack, self._shifts, s, self._specials))
+        self.count += 1
+        self.feet += s.len
+        self.elev += s.elev
+
+    def write_chunk(self, chunk):
+        # The records write() would give for each row of a SectionChunk, packed
+        # as one numpy array
+        n = len(chunk)
+        if not n:
+            return
+        if self._schema is None:
+            self._start(chunk.schema)
+        records = np.empty(n, dtype=record_dtype(chunk.schema.keys))
+        records['len'] = chunk.len
+        records['elev'] = chunk.elev
+        records['width'] = chunk.width()
+        records['degree'] = 0 if chunk.degree is None else chunk.degree
+        specials, store_specials = chunk.specials, self._specials
+        records['special'] = _encode_codes(chunk.special, lambda code: -1 if code == 0 else store_specials.setdefault(specials[code], len(store_specials)))
+        for k in chunk.schema.keys:
+            records[k] = chunk.codes[k]
+        # Start feet and elevation of each row; cumsum adds in row order, as write() does
+        feet = np.cumsum(np.concatenate(([self.feet], chunk.len)))
+        elev = np.cumsum(np.concatenate(([self.elev], chunk.elev)))
+        rows = np.arange(-self.count % self.every, n, self.every)
+        self._index_feet.extend(feet[rows].tolist())
+        self._index_elev.extend(elev[rows].tolist())
+        self._file.write(records.tobytes())
+        self.count += n
+        self.feet = int(feet[-1])
+        self.elev = float(elev[-1])
+
+    def close(self):
+        schema = self._schema
+        footer = {
+            'meta': self.meta,
+            'every': self.every,
+            'values': {k: schema.tables[k].values for k in schema.keys} if schema is not None else {},
+            'specials': list(self._specials),
+            'index_feet': self._index_feet,
+            'index_elev': self._index_elev,
+            'feet': self.feet,
+            'elev': self.elev,
+        }
+        f = self._file
+        footer_offset = f.tell()
+        pickle.dump(footer, f, protocol=pickle.HIGHEST_PROTOCOL)
+        record_size = self._record.size if schema is not None else 0
+        f.seek(0)
+        f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, record_size, self.count, footer_offset))
+        f.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def write_store(sections, path, every=1024, meta=None):
+    # Writes a section stream (or SectionChunks) to a store and returns the
+    # number of sections
+    with TunnelStoreWriter(path, every, meta) as writer:
+        for s in sections:
+            if isinstance(s, SectionChunk):
+                writer.write_chunk(s)
+            else:
+                writer.write(s)
+    return writer.count
+
+class TunnelStore:
+    # Read side of a store file. Indexing and slicing go by position (store[0]
+    # is section 1); section numbers as printed are used by locate() and
+    # filter(). Criteria are attribute=text pairs matching the start of the
+    # label used in exports (air='Poison' for 'Poison/noxious gas') or, for
+    # special=, of the special feature text; a list matches any of them.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            head = f.read(STORE_HEADER.size)
+            if len(head) < STORE_HEADER.size or head[:8] != STORE_MAGIC:
+                raise ValueError(f"{path} is not a tunnel store")
+            _, version, record_size, count, footer_offset = STORE_HEADER.unpack(head)
+            if version != STORE_VERSION:
+                raise ValueError(f"{path} was written by another version of the tunnel store")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        footer = pickle.loads(self._mmap[footer_offset:])
+        self.count = count
+        self.meta = footer['meta']
+        self.every = footer['every']
+        self.specials = footer['specials']
+        self.total_feet = footer['feet']
+        self.total_elev = footer['elev']
+        self._index_feet = footer['index_feet']
+        self._index_elev = footer['index_elev']
+        self.schema = SectionSchema.from_values(footer['values'])
+        self._record = record_struct(len(self.schema.keys))
+        self._view = memoryview(self._mmap)[STORE_HEADER.size:STORE_HEADER.size + count * record_size]
+
+    def __len__(self):
+        return self.count
+
+    def records(self, start=0, stop=None):
+        # (len, elev, width, degree, special, *codes) for positions start..stop
+        start, stop, _ = slice(start, stop).indices(self.count)
+        size = self._record.size
+        return self._record.iter_unpack(self._view[start * size:max(start, stop) * size])
+
+    def sections(self, start=0, stop=None):
+        return decode_records(self.records(start, stop), self.schema, self.specials)
+
+    def __iter__(self):
+        return self.sections()
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            positions = range(*item.indices(self.count))
+            if positions.step == 1:
+                return list(self.sections(positions.start, positions.stop))
+            unpack, size = self._record.unpack_from, self._record.size
+            return list(decode_records((unpack(self._view, i * size) for i in positions), self.schema, self.specials))
+        if item < 0:
+            item += self.count
+        if not 0 <= item < self.count:
+            raise IndexError("store index out of range")
+        return next(self.sections(item, item + 1))
+
+    def array(self):
+        # Structured numpy array over the mapped records, no copy
+        if np is None:
+            raise ImportError("TunnelStore.array requires numpy (pip install numpy)")
+        return np.frombuffer(self._view, dtype=record_dtype(self.schema.keys))
+
+    def _matcher(self, criteria):
+        # Record positions to test and the set of accepted values for each
+        tests = []
+        for name, prefixes in criteria.items():
+            prefixes = (prefixes,) if isinstance(prefixes, str) else tuple(prefixes)
+            if name == 'special':
+                tests.append((4, {i for i, text in enumerate(self.specials) if text.startswith(prefixes)}))
+            elif name in self.schema.shifts:
+                values = self.schema.tables[name].values
+                tests.append((5 + self.schema.keys.index(name), {i for i, v in enumerate(values) if value_label(v).startswith(prefixes)}))
+            else:
+                raise ValueError(f"Unknown attribute {name!r} (choose from {', '.join(self.schema.keys + ['special'])})")
+        return tests
+
+    def _matching(self, criteria, start=0, stop=None):
+        # (position, record) of the records meeting every criterion
+        tests = self._matcher(criteria)
+        start = slice(start, stop).indices(self.count)[0]
+        for i, rec in enumerate(self.records(start, stop), start):
+            if all(rec[pos] in accepted for pos, accepted in tests):
+                yield i, rec
+
+    def filter(self, start=0, stop=None, **criteria):
+        # (section number, section) of the sections meeting every criterion
+        for i, rec in self._matching(criteria, start, stop):
+            yield i + 1, next(decode_records((rec,), self.schema, self.specials))
+
+    def totals(self, start=0, stop=None, **criteria):
+        # {'sections', 'feet', 'elev'} over the sections meeting every criterion
+        totals = {'sections': 0, 'feet': 0, 'elev': 0.0}
+        for _, rec in self._matching(criteria, start, stop):
+            totals['sections'] += 1
+            totals['feet'] += rec[0]
+            totals['elev'] += rec[1]
+        return totals
+
+    def breakdown(self, name, start=0, stop=None, **criteria):
+        # {label: {'sections', 'feet'}} by the value of one attribute (or
+        # 'special', None for sections without one)
+        if name == 'special':
+            pos, labels = 4, self.specials
+        elif name in self.schema.shifts:
+            pos, labels = 5 + self.schema.keys.index(name), [value_label(v) for v in self.schema.tables[name].values]
+        else:
+            raise ValueError(f"Unknown attribute {name!r} (choose from {', '.join(self.schema.keys + ['special'])})")
+        result = {}
+        for _, rec in self._matching(criteria, start, stop):
+            code = rec[pos]
+            row = result.setdefault(labels[code] if code >= 0 else None, {'sections': 0, 'feet': 0})
+            row['sections'] += 1
+            row['feet'] += rec[0]
+        return result
+
+    def locate(self, miles):
+        # (section number, start feet, start elevation, section) at a distance;
+        # the very end of the tunnel belongs to the last section
+        feet = miles * 5280
+        if not self.count or not 0 <= feet <= self.total_feet:
+            raise ValueError(f"{miles:g} miles is outside the tunnel (0 to {self.total_feet / 5280:g} miles)")
+        block = bisect.bisect_right(self._index_feet, feet) - 1
+        start = block * self.every
+        at, elev = self._index_feet[block], self._index_elev[block]
+        for number, rec in enumerate(self.records(start, start + self.every), start + 1):
+            if feet < at + rec[0] or number == self.count:
+                return number, at, elev, next(decode_records((rec,), self.schema, self.specials))
+            at += rec[0]
+            elev += rec[1]
+
+    def section_at(self, miles):
+        # (section number, section) at a distance
+        number, _, _, s = self.locate(miles)
+        return number, s
+
+    def elevation_at(self, miles):
+        # Elevation relative to the tunnel start, spread evenly along each section
+        number, start, elev, s = self.locate(miles)
+        return elev + s.elev * (miles * 5280 - start) / s.len
+
+    def close(self):
+        if self._mmap is not None:
+            self._view.release()
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# --- Tunnel Networks ---
+# Side tunnels and junctions (special features with a 'branch') lead into
+# tunnels of their own. generate_network follows them a level at a time:
+# every tunnel of a level runs in a worker process, the branches it turns up
+# make the next level, down to max_depth levels and up to max_miles in all.
+#
+# The graph: nodes are the ends of tunnels and the junctions where a branch
+# leaves its parent, edges are the stretches of one tunnel between two of its
+# nodes. A branch starts at the junction node it leaves from, which is how
+# tunnels share junctions. Node kinds: 'entrance' and 'end' for the first
+# tunnel, 'junction', 'dead_end' for branches that stop and 'open' for
+# branches that run on (a junction's passage goes through to somewhere else).
+
+def network_tunnel(job):
+    # One tunnel of a network (runs in a worker process): its totals, the
+    # branches found along it and, when job['fmt'] is set, the rendered text
+    branches = []
+    def on_special(feet, feature):
+        if 'branch' in feature:
+            branches.append({'feet': feet, 'desc': feature['desc'], **feature['branch']})
+    args = (job['length'], job['type'], job['min_height'], job['min_width'])
+    text = None
+    if job['fmt'] is None:
+        totals = {'sections': 0, 'feet': 0, 'elev': 0}
+        for s in ENGINES[job['engine']](*args, seed=job['seed'], tables=job['tables'], on_special=on_special):
+            totals['sections'] += 1
+            totals['feet'] += s.len
+            totals['elev'] += s.elev
+    else:
+        out = io.StringIO()
+        totals = generate_tunnel(*args, job['engine'], job['seed'], out=out, tables=job['tables'], fmt=job['fmt'], on_special=on_special)
+        text = out.getvalue()
+    return {'totals': totals, 'branches': branches, 'text': text}
+
+def generate_network(length_miles, tunnel_type='dry', min_height=0, min_width=0, seed=None, tables=None,
+                     max_depth=2, max_miles=None, workers=None, engine='python', fmt=None):
+    # Returns {'seed', 'tunnels', 'nodes', 'edges'}. Tunnel 0 is the one asked
+    # for, generated with seed itself so it matches a plain run; branch tunnels
+    # are numbered in the order they are found (level, parent, distance) and
+    # seeded from it, so a seed always gives the same network whatever the
+    # number of workers. Branches deeper than max_depth, or that would take
+    # the total past max_miles, are left as unexplored junctions
+    # (their 'tunnel' is None). min_height/min_width hold for every tunnel.
+    tables = resolve_tables(tables)
+    source = table_source(tables)
+    if seed is None:
+        seed = random.randrange(2**32)
+    tunnels, nodes, edges = [], [], []
+
+    def add_node(kind, tunnel, feet):
+        nodes.append({'id': len(nodes), 'kind': kind, 'tunnel': tunnel, 'feet': feet})
+        return len(nodes) - 1
+
+    level = [{
+        'id': 0, 'type': tunnel_type, 'length': length_miles, 'seed': seed, 'depth': 0,
+        'parent': None, 'start_node': add_node('entrance', 0, 0), 'through': True,
+    }]
+    total_miles = length_miles
+    next_id = 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while level:
+            jobs = [{
+                'length': t['length'], 'type': t['type'], 'min_height': min_height, 'min_width': min_width,
+                'seed': t['seed'], 'tables': source, 'engine': engine, 'fmt': fmt,
+            } for t in level]
+            next_level = []
+            for tunnel, result in zip(level, pool.map(network_tunnel, jobs)):
+                tid = tunnel['id']
+                # Walk the tunnel: start node, a junction per branch, then the far end
+                path = [tunnel['start_node']]
+                for branch in result['branches']:
+                    node = add_node('junction', tid, branch['feet'])
+                    path.append(node)
+                    branch['node'] = node
+                    branch['tunnel'] = None
+                    if tunnel['depth'] >= max_depth:
+                        continue
+                    bid = next_id
+                    miles = branch['miles']
+                    if not isinstance(miles, (int, float)):
+                        miles = eval_value(miles, {}, make_rng(derive_seed(seed, 'branch-miles', bid)), tables)
+                    branch['miles'] = miles
+                    if max_miles is not None and total_miles + miles > max_miles:
+                        continue
+                    total_miles += miles
+                    next_id += 1
+                    branch['tunnel'] = bid
+                    next_level.append({
+                        'id': bid, 'type': branch['type'], 'length': miles, 'seed': tunnel_seed(seed, bid),
+                        'depth': tunnel['depth'] + 1, 'parent': tid, 'start_node': node, 'through': branch['through'],
+                    })
+                if tid == 0:
+                    end_kind = 'end'
+                else:
+                    end_kind = 'open' if tunnel['through'] else 'dead_end'
+                path.append(add_node(end_kind, tid, result['totals']['feet']))
+                for a, b in zip(path, path[1:]):
+                    from_feet = 0 if a == tunnel['start_node'] else nodes[a]['feet']
+                    edges.append({
+                        'id': len(edges), 'tunnel': tid, 'from': a, 'to': b,
+                        'from_feet': from_feet, 'to_feet': nodes[b]['feet'],
+                    })
+                tunnels.append({
+                    'id': tid, 'type': tunnel['type'], 'miles': tunnel['length'], 'seed': tunnel['seed'],
+                    'depth': tunnel['depth'], 'parent': tunnel['parent'], 'start_node': tunnel['start_node'],
+                    'end_node': path[-1], 'branches': result['branches'], **result['totals'], 'text': result['text'],
+                })
+            level = next_level
+    return {'seed': seed, 'tunnels': tunnels, 'nodes': nodes, 'edges': edges}
+
+def network_adjacency(network):
+    # Node id -> [[neighbour node id, edge id], ...], edges both ways
+    adjacency = [[] for _ in network['nodes']]
+    for edge in network['edges']:
+        adjacency[edge['from']].append([edge['to'], edge['id']])
+        adjacency[edge['to']].append([edge['from'], edge['id']])
+    return adjacency
+
+def write_network_json(network, path):
+    # The graph as JSON: tunnels (without their text), nodes, edges and adjacency
+    data = {
+        'seed': network['seed'],
+        'tunnels': [{k: v for k, v in t.items() if k != 'text'} for t in network['tunnels']],
+        'nodes': network['nodes'],
+        'edges': network['edges'],
+        'adjacency': network_adjacency(network),
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1)
+
+# --- Server Mode ---
+# A local HTTP server for backends that would otherwise run this script once
+# per request: GET /tunnel?length=5&type=wet&seed=7 streams the sections back
+# as chunked NDJSON (the jsonl format). The event loop only does I/O. Sections
+# are generated a chunk at a time in a process pool, each chunk resuming from
+# the snapshot the one before ended on, so a stream is the same as a single
+# run. Identical seeded requests share one stream while it is generated, and
+# finished streams are kept in an LRU cache bounded by total size. A request
+# without a seed gets a random one (sent back as X-Tunnel-Seed) and is never
+# shared. GET /stats reports the request, coalescing and cache counters.
+
+SERVE_CHUNK_SECTIONS = 2000
+
+class _ChunkHook(SnapshotHook):
+    # Captures the snapshot once 'end' sections have been handed out
+    def __init__(self, end):
+        self.end = end
+        self.snapshot = None
+
+    def due(self, emitted, emitted_feet):
+        return self.snapshot is None and emitted >= self.end
+
+    def save(self, snapshot):
+        self.snapshot = snapshot
+
+def render_chunk(job):
+    # Up to job['sections'] sections as JSON Lines, from job['snapshot'] (None
+    # at the start of the tunnel). Runs in a worker process. Returns the text
+    # and the snapshot to go on from, None once the tunnel is complete.
+    snapshot = job['snapshot']
+    number = 1 if snapshot is None else snapshot['emitted'] + 1
+    hook = _ChunkHook(number - 1 + job['sections'])
+    out = io.StringIO()
+    renderer = JsonLinesRenderer(out)
+    sections = iter_sections(job['length'], job['type'], job['min_height'], job['min_width'], seed=job['seed'],
+                             tables=job['tables'], checkpointer=hook, resume=snapshot)
+    for s in sections:
+        if hook.snapshot is not None:
+            break # s opens the next chunk
+        renderer.write(number, s)
+        number += 1
+    sections.close()
+    renderer.flush()
+    return out.getvalue(), hook.snapshot
+
+class _Stream:
+    # A tunnel being generated for one or more readers. Chunk i is
+    # chunks[i - base]; readers maps each reader to the next chunk it wants.
+    # Once a stream is too big to cache it stops being shared and drops the
+    # chunks every reader has passed.
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.base = 0
+        self.size = 0
+        self.shared = key is not None
+        self.done = False
+        self.error = None
+        self.readers = {}
+        self.task = None
+        self._changed = asyncio.Event()
+
+    @property
+    def end(self):
+        return self.base + len(self.chunks)
+
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self):
+        await self._changed.wait()
+
+    def trim(self):
+        if self.shared:
+            return
+        low = min(self.readers.values(), default=self.end)
+        if low > self.base:
+            del self.chunks[:low - self.base]
+            self.base = low
+
+class TunnelServer:
+    # cache_bytes bounds the finished streams kept for repeat requests; a
+    # single stream is cached (and shared with later requests) only while it
+    # stays under a quarter of that. A stream is generated at most read_ahead
+    # chunks ahead of its slowest reader.
+    def __init__(self, tables=None, workers=None, cache_bytes=64 * 2**20, chunk_sections=SERVE_CHUNK_SECTIONS, read_ahead=4):
+        self.tables = resolve_tables(tables)
+        self.source = table_source(self.tables)
+        self.workers = workers
+        self.cache_bytes = cache_bytes
+        self.chunk_sections = chunk_sections
+        self.read_ahead = read_ahead
+        self.cache = OrderedDict() # key -> (chunks, size)
+        self.cache_size = 0
+        self.streams = {}
+        self.pool = None
+        self.stats = {'requests': 0, 'coalesced': 0, 'cache_hits': 0, 'chunks': 0, 'evictions': 0}
+
+    def parse_params(self, query):
+        # The command line settings from a parsed query string (min_height or
+        # min-height and so on). Returns (params, key); key is None when the
+        # request has no seed and can't be shared.
+        def get(name, convert, default):
+            values = query.get(name) or query.get(name.replace('_', '-'))
+            if not values:
+                return default
+            try:
+                return convert(values[-1])
+            except ValueError:
+                raise ValueError(f"bad value for {name}: {values[-1]!r}")
+        length = get('length', float, None)
+        if length is None or not 0 < length < math.inf:
+            raise ValueError("length must be a positive number of miles")
+        try:
+            miles_to_feet(length)
+        except OverflowError:
+            raise ValueError(f"length of {length:g} miles is too long") from None
+        tunnel_type = get('type', str, 'dry')
+        if tunnel_type not in self.tables.types:
+            raise ValueError(f"unknown tunnel type {tunnel_type!r} (choose from {', '.join(sorted(self.tables.types))})")
+        params = {
+            'length': length, 'type': tunnel_type, 'min_height': get('min_height', int, 0),
+            'min_width': get('min_width', int, 0), 'seed': get('seed', int, None),
+        }
+        key = None
+        if params['seed'] is None:
+            params['seed'] = random.randrange(2**32)
+        else:
+            key = tuple(params.values())
+        return params, key
+
+    def _cache_put(self, key, chunks, size):
+        self.cache[key] = (chunks, size)
+        self.cache_size += size
+        while self.cache_size > self.cache_bytes:
+            _, (_, evicted) = self.cache.popitem(last=False)
+            self.cache_size -= evicted
+            self.stats['evictions'] += 1
+
+    async def _produce(self, stream, params):
+        loop = asyncio.get_running_loop()
+        job = dict(params, tables=self.source, snapshot=None, sections=self.chunk_sections)
+        try:
+            while True:
+                while stream.readers and stream.end - min(stream.readers.values()) >= self.read_ahead:
+                    await stream.wait()
+                text, job['snapshot'] = await loop.run_in_executor(self.pool, render_chunk, job)
+                self.stats['chunks'] += 1
+                stream.chunks.append(text)
+                stream.size += len(text)
+                if stream.shared and stream.size > self.cache_bytes // 4:
+                    stream.shared = False
+                    if self.streams.get(stream.key) is stream:
+                        del self.streams[stream.key]
+                stream.trim()
+                stream.notify()
+                if job['snapshot'] is None:
+                    break
+            if stream.shared:
+                self._cache_put(stream.key, stream.chunks, stream.size)
+        except Exception as e:
+            stream.error = e
+        finally:
+            stream.done = True
+            if self.streams.get(stream.key) is stream:
+                del self.streams[stream.key]
+            stream.notify()
+
+    async def chunks(self, params, key=None):
+        # The NDJSON text of a tunnel, chunk by chunk, from the cache, a
+        # stream already under way or a new one
+        self.stats['requests'] += 1
+        stream = None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                self.stats['cache_hits'] += 1
+                for chunk in cached[0]:
+                    yield chunk
+                return
+            stream = self.streams.get(key)
+            if stream is not None:
+                self.stats['coalesced'] += 1
+        if stream is None:
+            stream = _Stream(key)
+            if key is not None:
+                self.streams[key] = stream
+            stream.task = asyncio.ensure_future(self._produce(stream, params))
+        reader = object()
+        stream.readers[reader] = pos = stream.base
+        try:
+            while True:
+                while pos >= stream.end and not stream.done:
+                    await stream.wait()
+                if pos < stream.end:
+                    chunk = stream.chunks[pos - stream.base]
+                elif stream.error is not None:
+                    raise stream.error
+                else:
+                    return
+                pos += 1
+                stream.readers[reader] = pos
+                stream.trim()
+                stream.notify()
+                yield chunk
+        finally:
+            del stream.readers[reader]
+            if not stream.readers and not stream.done:
+                # Nobody is left to read it
+                stream.task.cancel()
+                if self.streams.get(stream.key) is stream:
+                    del self.streams[stream.key]
+            stream.notify()
+
+    async def handle(self, reader, writer):
+        # One HTTP/1.1 request per connection
+        try:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+                method, target, _ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+            except (asyncio.LimitOverrunError, ValueError):
+                return await self._respond(writer, 400, {'error': 'bad request'})
+            url = urllib.parse.urlsplit(target)
+            if url.path not in ('/tunnel', '/stats'):
+                return await self._respond(writer, 404, {'error': f'no such path {url.path}'})
+            if method != 'GET':
+                return await self._respond(writer, 405, {'error': 'only GET is supported'})
+            if url.path == '/stats':
+                return await self._respond(writer, 200, dict(self.stats, cached=len(self.cache), cache_bytes=self.cache_size, streams=len(self.streams)))
+            try:
+                params, key = self.parse_params(urllib.parse.parse_qs(url.query))
+            except ValueError as e:
+                return await self._respond(writer, 400, {'error': str(e)})
+            writer.write((
+                "HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n"
+                f"X-Tunnel-Seed: {params['seed']}\r\nConnection: close\r\n\r\n").encode('latin-1'))
+            chunks = self.chunks(params, key)
+            try:
+                async for chunk in chunks:
+                    if chunk:
+                        data = chunk.encode('utf-8')
+                        writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+                        await writer.drain()
+            finally:
+                await chunks.aclose() # Stops the stream now if this was its last reader
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass # Client went away
+        except Exception as e:
+            # Headers are out already, closing without the last chunk tells the client
+            print(f"Tunnel stream failed: {e!r}", file=sys.stderr)
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, body):
+        data = (json.dumps(body) + '\n').encode('utf-8')
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}[status]
+        writer.write((f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                      f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n").encode('latin-1') + data)
+        await writer.drain()
+
+    async def serve(self, host='127.0.0.1', port=8080, ready=None):
+        # Runs until cancelled; ready(server) is called once it listens.
+        # Workers ignore Ctrl-C and are shut down by the pool on the way out.
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN)) as pool:
+            self.pool = pool
+            # Start the workers (and load the tables in them) before listening:
+            # workers forked later would inherit client sockets and keep them open
+            await asyncio.get_running_loop().run_in_executor(pool, resolve_tables, self.source)
+            server = await asyncio.start_server(self.handle, host, port)
+            if ready is not None:
+                ready(server)
+            async with server:
+                await server.serve_forever()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a tunnel description.")
-    parser.add_argument("length", type=float, help="Total length of the tunnel in miles")
-    parser.add_argument("--type", choices=['dry', 'wet'], default='dry', help="Type of tunnel (dry or wet)")
+    parser.add_argument("length", type=float, nargs='?', help="Total length of the tunnel in miles")
+    parser.add_argument("--type", default='dry', help="Type of tunnel (dry or wet, or any type in --tables)")
     parser.add_argument("--min-height", type=int, default=0, help="Minimum height in feet")
     parser.add_argument("--min-width", type=int, default=0, help="Minimum width in feet")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default='python', help="Section engine (numpy draws in bulk, needs numpy)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed, the same seed regenerates the same tunnel")
+    parser.add_argument("--format", choices=sorted(RENDERERS), default='text', help="Output format for sections: text lines, JSON Lines or CSV")
+    parser.add_argument("--export", metavar="PATH", help="Write sections as columns to a .parquet (needs pyarrow) or .npz (needs numpy) file instead of printing")
+    parser.add_argument("--elevation", metavar="PATH", help="Write the elevation profile (feet along the tunnel, elevation) to a CSV or .npy (needs numpy) file instead of printing")
+    parser.add_argument("--elevation-every", type=float, metavar="FEET", default=None, help="Sample the --elevation profile every FEET feet (default: at each section end)")
+    parser.add_argument("--store", metavar="PATH", help="Write sections to a memory-mapped store file instead of printing (with --at or --where: read it)")
+    parser.add_argument("--where", metavar="NAME=LABEL", action='append', help="Print the sections in --store whose attribute (or special) label starts with LABEL, and their totals; repeat for more attributes (all must match) or more labels of one (any may match)")
+    parser.add_argument("--stats", type=int, metavar="N", help="Simulate N tunnels and print aggregate statistics instead of sections")
+    parser.add_argument("--elev-bin", type=float, metavar="FEET", default=None, help="Bin width of the --stats elevation histogram (default: about 20 bins over the elevations seen)")
+    parser.add_argument("--batch", metavar="MANIFEST", help="Generate every tunnel in a JSON manifest instead of a single tunnel")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for --batch and --network (default: all cores)")
+    parser.add_argument("--network", action='store_true', help="Also generate the tunnels that side tunnels and junctions lead into")
+    parser.add_argument("--max-depth", type=int, metavar="N", default=2, help="Levels of branches to follow with --network (default: 2)")
+    parser.add_argument("--max-miles", type=float, metavar="MILES", default=None, help="Total miles of tunnel to generate with --network")
+    parser.add_argument("--network-json", metavar="PATH", help="Write the --network graph (nodes, edges, adjacency) as JSON to PATH")
+    parser.add_argument("--tables", metavar="PATH", default=None, help="Table file to roll on (default: underdark_tables.json)")
+    parser.add_argument("-o", "--output", metavar="PATH", help="Write the tunnel to a file instead of stdout")
+    parser.add_argument("--checkpoint", metavar="PATH", help="Save a checkpoint to PATH while generating, removed once the tunnel is complete")
+    parser.add_argument("--checkpoint-every", type=int, metavar="N", default=None, help="Checkpoint every N sections")
+    parser.add_argument("--checkpoint-interval", type=float, metavar="SECONDS", default=60.0, help="Checkpoint every SECONDS seconds (default: 60)")
+    parser.add_argument("--resume", metavar="PATH", help="Continue the tunnel saved in a checkpoint; all settings come from the checkpoint")
+    parser.add_argument("--index", metavar="PATH", help="Write a sparse index of the tunnel to PATH (with --at: read it)")
+    parser.add_argument("--index-every", type=int, metavar="K", default=1000, help="Sections between index entries (default: 1000)")
+    parser.add_argument("--profile", metavar="PATH", help="Write call counts and timings per phase and attribute getter as JSON to PATH (python engine)")
+    parser.add_argument("--serve", action='store_true', help="Run a local HTTP server streaming tunnels as NDJSON (GET /tunnel?length=5&type=wet&seed=7)")
+    parser.add_argument("--host", default='127.0.0.1', help="Address for --serve (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="Port for --serve (default: 8080)")
+    parser.add_argument("--cache-mb", type=float, default=64, help="Size of the --serve result cache in MiB (default: 64)")
+    parser.add_argument("--at", type=float, metavar="MILES", help="Look up the section and elevation at MILES in --index instead of generating")
     
     args = parser.parse_args()
-    
-    generate_tunnel(args.length, args.type, args.min_height, args.min_width)
+    if args.store and (args.at is not None or args.where):
+        criteria = {}
+        for pair in args.where or ():
+            name, sep, label = pair.partition('=')
+            if not sep:
+                parser.error(f"--where needs NAME=LABEL, got {pair!r}")
+            criteria.setdefault(name, []).append(label)
+        try:
+            with TunnelStore(args.store) as store:
+                if args.at is not None:
+                    number, start, elev, s = store.locate(args.at)
+                    print(format_section(number, s))
+                    print(f"Starts at mile {start / 5280:,.3f}, elevation at mile {args.at:,.3f}: {store.elevation_at(args.at):+.1f} ft")
+                else:
+                    for number, s in store.filter(**criteria):
+                        print(format_section(number, s))
+                    totals = store.totals(**criteria)
+                    print(f"{totals['sections']} of {len(store)} sections, {totals['feet']:,.0f} feet, {totals['elev']:+.1f} ft elevation change")
+        except (OSError, ValueError, pickle.UnpicklingError) as e:
+            parser.error(f"cannot query store: {e}")
+        sys.exit(0)
+    if args.where:
+        parser.error("--where needs --store")
+
+    if args.at is not None:
+        if not args.index:
+            parser.error("--at needs --index (or --store)")
+        try:
+            index = TunnelIndex.load(args.index, args.tables)
+            number, start, elev, s = index.locate(args.at)
+            offset = index.offset_at(args.at)
+        except (OSError, ValueError, TableError, pickle.UnpicklingError) as e:
+            parser.error(f"cannot query index: {e}")
+        print(format_section(number, s))
+        print(f"Starts at mile {start / 5280:,.3f}, elevation at mile {args.at:,.3f}: {index.elevation_at(args.at):+.1f} ft")
+        if offset is not None:
+            print(f"Byte offset in {index.meta.get('output') or 'the output'}: {offset}")
+        sys.exit(0)
+
+    if args.serve:
+        try:
+            server = TunnelServer(args.tables, args.workers, int(args.cache_mb * 2**20))
+        except (OSError, TableError) as e:
+            parser.error(f"cannot load tables: {e}")
+        ready = lambda srv: print(f"Serving tunnels on http://{args.host}:{args.port}/tunnel", file=sys.stderr)
+        try:
+            asyncio.run(server.serve(args.host, args.port, ready))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    snapshot = None
+    if args.resume:
+        try:
+            snapshot = load_snapshot(args.resume)
+        except (OSError, ValueError, pickle.UnpicklingError) as e:
+            parser.error(f"cannot resume: {e}")
+        params, meta = snapshot['params'], snapshot['meta']
+        args.length, args.type, args.seed = params['length_miles'], params['tunnel_type'], params['seed']
+        args.min_height, args.min_width = params['min_height'], params['min_width']
+        args.engine, args.format, args.output, args.tables = 'python', meta['format'], meta['output'], meta['tables']
+        args.checkpoint, args.checkpoint_every, args.checkpoint_interval = args.resume, meta['every'], meta['interval']
+        args.index, args.index_every = meta['index'], meta['index_every']
+    if args.batch is None and args.length is None:
+        parser.error("the length argument is required unless --batch or --resume is given")
+    try:
+        tables = load_tables(args.tables)
+    except (OSError, TableError) as e:
+        parser.error(f"cannot load tables: {e}")
+    if args.type not in tables.types:
+        parser.error(f"unknown tunnel type {args.type!r} (choose from {', '.join(sorted(tables.types))})")
+    if snapshot is not None and snapshot['params']['tables'] != tables.digest:
+        parser.error(f"cannot resume: {tables.path} has changed since the checkpoint was saved")
+    if (args.checkpoint or args.index) and args.engine != 'python':
+        parser.error("--checkpoint and --index need the python engine")
+    if args.profile and (args.engine != 'python' or args.batch or args.stats or args.export or args.elevation or args.store or args.network):
+        parser.error("--profile needs the python engine and a single tunnel")
+    if args.elev_bin is not None and args.elev_bin <= 0:
+        parser.error("--elev-bin must be positive")
+    if args.elevation_every is not None and args.elevation_every <= 0:
+        parser.error("--elevation-every must be positive")
+    if args.network and args.format != 'text':
+        parser.error("--network prints text; use --network-json for the graph")
+
+    # Always run seeded so any printed tunnel can be regenerated
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+
+    if args.batch:
+        for i, text in enumerate(generate_batch(load_manifest(args.batch), args.workers, args.engine, seed, tables.path, args.format)):
+            if i and args.format == 'text':
+                print()
+            sys.stdout.write(text)
+    elif args.network:
+        network = generate_network(args.length, args.type, args.min_height, args.min_width, seed, tables,
+                                   args.max_depth, args.max_miles, args.workers, args.engine, fmt='text')
+        for tunnel in network['tunnels']:
+            if tunnel['parent'] is None:
+                print(f"=== Tunnel {tunnel['id']} ===")
+            else:
+                start = network['nodes'][tunnel['start_node']]['feet']
+                print(f"\n=== Tunnel {tunnel['id']}: branch of tunnel {tunnel['parent']} at mile {start / 5280:,.2f} ===")
+            sys.stdout.write(tunnel['text'])
+        unexplored = sum(1 for t in network['tunnels'] for b in t['branches'] if b['tunnel'] is None)
+        print(f"\nNetwork: {len(network['tunnels'])} tunnels, {len(network['nodes'])} nodes, {len(network['edges'])} edges, {unexplored} unexplored junctions")
+        if args.network_json:
+            write_network_json(network, args.network_json)
+    elif args.stats:
+        print_stats(simulate_stats(args.length, args.type, args.stats, args.min_height, args.min_width, seed, args.engine, args.elev_bin, tables=tables))
+    elif args.elevation:
+        sections = ENGINES[args.engine](args.length, args.type, args.min_height, args.min_width, seed=seed, tables=tables)
+        count = write_elevation_profile(elevation_profile(sections, args.elevation_every), args.elevation)
+        print(f"Wrote {count} elevation points to {args.elevation} (seed {seed})")
+    elif args.store:
+        # The numpy engine's columns are written as they are drawn, without building sections
+        section_iter = iter_chunks_numpy if args.engine == 'numpy' else ENGINES[args.engine]
+        sections = section_iter(args.length, args.type, args.min_height, args.min_width, seed=seed, tables=tables)
+        meta = {'length': args.length, 'type': args.type, 'min_height': args.min_height, 'min_width': args.min_width,
+                'seed': seed, 'engine': args.engine, 'tables': tables.path}
+        count = write_store(sections, args.store, meta=meta)
+        print(f"Wrote {count} sections to {args.store} (seed {seed})")
+    elif args.export:
+        # The numpy engine's columns are written as they are drawn, without building sections
+        section_iter = iter_chunks_numpy if args.engine == 'numpy' else ENGINES[args.engine]
+        sections = section_iter(args.length, args.type, args.min_height, args.min_width, seed=seed, tables=tables)
+        count = export_columns(sections, args.export)
+        print(f"Wrote {count} sections to {args.export} (seed {seed})")
+    else:
+        out = None
+        if args.output:
+            if snapshot is not None and snapshot.get('out_offset') is not None:
+                # Drop anything written after the checkpoint, then append
+                os.truncate(args.output, snapshot['out_offset'])
+                out = open(args.output, 'a', encoding='utf-8')
+            else:
+                out = open(args.output, 'w', encoding='utf-8')
+        checkpointer = None
+        if args.checkpoint:
+            meta = {
+                'format': args.format, 'output': args.output and os.path.abspath(args.output), 'tables': tables.path,
+                'every': args.checkpoint_every, 'interval': args.checkpoint_interval,
+                'index': args.index and os.path.abspath(args.index), 'index_every': args.index_every,
+            }
+            checkpointer = Checkpointer(args.checkpoint, args.checkpoint_every, args.checkpoint_interval, meta=meta)
+        index = None
+        if args.index:
+            meta = {'format': args.format, 'output': args.output and os.path.abspath(args.output), 'tables': tables.path}
+            index = SectionIndexWriter(args.index, args.index_every, meta=meta, resume=snapshot)
+        try:
+            profiler = Profiler() if args.profile else None
+            generate_tunnel(args.length, args.type, args.min_height, args.min_width, args.engine, seed, out=out, tables=tables,
+                            fmt=args.format, checkpointer=checkpointer, resume=snapshot, index=index, profiler=profiler)
+            if profiler is not None:
+                meta = {'length': args.length, 'type': args.type, 'min_height': args.min_height, 'min_width': args.min_width,
+                        'seed': seed, 'format': args.format, 'tables': tables.path}
+                profiler.write(args.profile, meta)
+        finally:
+            if out is not None:
+                out.close()